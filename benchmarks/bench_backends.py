@@ -0,0 +1,49 @@
+'''
+speed and accuracy of the ephemeris backends (backends.py) over a set of sites for one eclipse
+
+    python3 benchmarks/bench_backends.py [--date 20231014] [--eph de430t.bsp] [--tolerance 1] [--json results.json]
+
+contacts are compared with the skyfield backend's, positions/s is topocentric Sun and Moon positions across each
+site's eclipse, contacts/s is how many sites' full set of contacts each finds per second.  the last line is the
+fastest backend whose contacts all fall within --tolerance seconds of skyfield's.
+'''
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'solar_eclipse_animation'))
+from backends import BACKENDS, benchmark, get_backend, select_backend  # noqa: E402
+from skyfieldcalcs import ts  # noqa: E402
+
+# the 2023 annular path, either side of it and well away from it
+SITES = [(38.57264, -112.24428, 1800), (29.4241, -98.4936, 198), (35.7796, -78.6382, 99), (47.6062, -122.3321, 50),
+         (40.7128, -74.0060, 10), (25.7617, -80.1918, 2), (44.9778, -93.2650, 264), (19.4326, -99.1332, 2240)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='speed and accuracy of the ephemeris backends')
+    parser.add_argument('--date', default='20231014', help='date of the solar eclipse YYYYMMDD (default 20231014)')
+    parser.add_argument('--eph', default='de430t.bsp', help='SPK file for the skyfield and besselian backends')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), help='backends to compare (default all)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='contact accuracy needed, seconds (default 1)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    backends = {}
+    for name in ['skyfield'] + [name for name in args.backends if name != 'skyfield']:
+        try:
+            backends[name] = get_backend(name, ephfilename=args.eph)
+        except ImportError as e:
+            print(f"skipping {name}: {e}")
+    date = ts.utc(int(args.date[:4]), int(args.date[4:6]), int(args.date[6:8]))
+    results = benchmark(backends, SITES, date)
+
+    print(f"{'backend':<10} {'positions/s':>12} {'contacts/s':>11} {'max dev s':>10} {'mean dev s':>11} {'mismatched':>10}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['positions_per_second']:>12.0f} {1 / r['seconds_per_contacts']:>11.1f} "
+              f"{r['max_deviation']:>10.3f} {r['mean_deviation']:>11.3f} {r['mismatched']:>10}")
+    print(f"fastest within {args.tolerance:g}s: {select_backend(results, args.tolerance)}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, default=float)
@@ -0,0 +1,108 @@
+'''
+per-frame cost of imaging.compositing before and after the Renderer cache, and of the NumPy DiskRenderer
+
+    python3 benchmarks/bench_compositing.py [--frames 20] [--fontfile path/to/font.ttf]
+
+"before" decodes the background, Sun and Moon, rebuilds the masks and loads the font for every frame the way
+compositing used to, "after" renders from a warm Renderer.  Neither saves the PNG, that cost is the same for both.
+"disk" is DiskRenderer.render_pixels against Renderer.render_pixels, the packed pixels a streamed frame is written as.
+the sky is a generated 3840x2160 #87CEEB image (see images/README.md), the Sun and Moon are the ones in images/
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'solar_eclipse_animation'))
+from imaging import DiskRenderer, Renderer, prep_image  # noqa: E402
+
+IMAGES = os.path.join(os.path.dirname(__file__), '..', 'images')
+
+
+def make_assets(dirname):
+    Image.new('RGB', (3840, 2160), '#87CEEB').save(f'{dirname}/bluesky_4k.png')
+    for name in ['sun.png', 'newmoon.png']:
+        shutil.copyfile(f'{IMAGES}/{name}', f'{dirname}/{name}')
+
+
+def legacy_frame(imagedir, fontfile, sun_radius, moon_radius, moon_alt_delta_deg, moon_az_delta_deg, label, fontsize=100):
+    # compositing as it was, minus the save
+    ratio = moon_radius / sun_radius
+    moon_az_delta_deg *= .725
+    imb, imb_size, bg_center, imb_mask = prep_image(f'{imagedir}/bluesky_4k.png', None, 1)
+    ims, ims_size, sun_center, ims_mask = prep_image(f'{imagedir}/sun.png', None, 1)
+    imm, imm_size, moon_center, imm_mask = prep_image(f'{imagedir}/newmoon.png', ims, ratio)
+    imb.paste(ims, (bg_center[0] - sun_center[0], bg_center[1] - sun_center[1]), ims_mask)
+    pixels_per_degree = round(ims_size[0] / (sun_radius * 2))
+    new_moon_x = round(bg_center[0] - moon_center[0] + (moon_az_delta_deg * pixels_per_degree))
+    new_moon_y = round(bg_center[1] - moon_center[1] + (moon_alt_delta_deg * pixels_per_degree))
+    imb.paste(imm, (new_moon_x, new_moon_y), imm_mask)
+    if label is not None:
+        border = fontsize * 1.3
+        font = ImageFont.truetype(fontfile, fontsize) if fontfile else None
+        ImageDraw.Draw(imb).text((border, imb_size[1] - border), label, font=font, fill=(0, 0, 0), anchor='ls')
+    return imb
+
+
+def frames(n):
+    # the Moon sweeping across the Sun, Oct 14 2023 sizes
+    for i in range(n):
+        offset = -0.6 + 1.2 * i / max(n - 1, 1)
+        yield 0.2671, 0.2533 + 0.0001 * i / n, offset, offset * 0.4, f"{i}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per-frame compositing cost, before and after the Renderer cache, '
+                                                 'and of the DiskRenderer')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--fontfile', help='true type font for the labels (default: no labels)')
+    args = parser.parse_args()
+    label = None if args.fontfile is None else 'label'
+
+    with tempfile.TemporaryDirectory() as imagedir:
+        make_assets(imagedir)
+
+        start = time.perf_counter()
+        for sun_r, moon_r, dalt, daz, text in frames(args.frames):
+            legacy_frame(imagedir, args.fontfile, sun_r, moon_r, dalt, daz, label and text)
+        before = (time.perf_counter() - start) / args.frames
+
+        start = time.perf_counter()
+        renderer = Renderer(imagedir, fontfile=args.fontfile)
+        setup = time.perf_counter() - start
+        start = time.perf_counter()
+        for sun_r, moon_r, dalt, daz, text in frames(args.frames):
+            renderer.render(sun_r, moon_r, dalt, daz, label_ll=label and text)
+        after = (time.perf_counter() - start) / args.frames
+
+        # same pixels either way
+        args_last = list(frames(args.frames))[-1]
+        same = legacy_frame(imagedir, args.fontfile, *args_last[:4], label and args_last[4]).tobytes() == \
+            renderer.render(*args_last[:4], label_ll=label and args_last[4]).tobytes()
+
+        start = time.perf_counter()
+        for sun_r, moon_r, dalt, daz, text in frames(args.frames):
+            renderer.render_pixels(sun_r, moon_r, dalt, daz, label_ll=label and text)
+        pixels = (time.perf_counter() - start) / args.frames
+        start = time.perf_counter()
+        disk = DiskRenderer(imagedir, fontfile=args.fontfile)
+        disk_setup = time.perf_counter() - start
+        start = time.perf_counter()
+        for sun_r, moon_r, dalt, daz, text in frames(args.frames):
+            disk.render_pixels(sun_r, moon_r, dalt, daz, label_ll=label and text)
+        disk_pixels = (time.perf_counter() - start) / args.frames
+
+    print(f"before: {before * 1000:8.1f} ms/frame")
+    print(f"after:  {after * 1000:8.1f} ms/frame  (+{setup * 1000:.1f} ms once to decode the assets)")
+    print(f"speedup {before / after:.1f}x, identical output: {same}")
+    print(f"pixels: {pixels * 1000:8.1f} ms/frame  Renderer, packed RGB for ffmpeg")
+    print(f"disk:   {disk_pixels * 1000:8.1f} ms/frame  DiskRenderer (+{disk_setup * 1000:.1f} ms once), "
+          f"{pixels / disk_pixels:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+how long the command line takes to start and what it imports doing it, each command a fresh interpreter
+
+    python3 benchmarks/bench_startup.py [--json results.json] [--repeat 5]
+
+    help           solar_eclipse_animation --help
+    bad_args       a latitude out of range, rejected before anything is loaded
+    circumstances  the contacts at a site from data/de421_20231014.bsp (an SPK excerpt, nothing is downloaded)
+    import_main    import main, what every animation pays before it starts
+
+best and median are seconds per run.  heavy lists which of the slow imports (pandas, PIL, timezonefinder and the
+renderers in imaging) the command loaded, circumstances should load none of them but timezonefinder.
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'solar_eclipse_animation'))
+SPK = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'de421_20231014.bsp'))
+HEAVY = ['pandas', 'PIL', 'timezonefinder', 'imaging']
+# printed to stderr as the interpreter exits, after whatever the command printed
+REPORT = f"import atexit, sys; atexit.register(lambda: print('HEAVY', *[m for m in {HEAVY!r} if m in sys.modules], " \
+         f"file=sys.stderr))"
+
+COMMANDS = {
+    'help': [PACKAGE, '--help'],
+    'bad_args': [PACKAGE, '35.78', '-278.66'],
+    'circumstances': [PACKAGE, 'circumstances', '35.78255', '-78.63899', '--ele', '97', '--eph', SPK],
+    'import_main': ['-c', 'import main'],
+}
+
+
+def timed(arguments, env):
+    '''
+    :return: seconds, list of the heavy modules it loaded
+    '''
+    if arguments[0] == '-c':
+        command = [sys.executable, '-c', f"{REPORT}; {arguments[1]}"]
+    else:
+        # runs the package as python3 solar_eclipse_animation would, with the report registered first
+        command = [sys.executable, '-c', f"{REPORT}; import runpy; sys.argv = {arguments!r}; "
+                                         f"runpy.run_path({arguments[0]!r}, run_name='__main__')"]
+    started = time.perf_counter()
+    done = subprocess.run(command, capture_output=True, text=True, env=env, cwd=PACKAGE)
+    seconds = time.perf_counter() - started
+    heavy = [line.split()[1:] for line in done.stderr.splitlines() if line.startswith('HEAVY')]
+    return seconds, heavy[-1] if heavy else None
+
+
+def run(repeat):
+    results = {}
+    data = tempfile.mkdtemp(prefix='bench_startup_')
+    env = dict(os.environ, SOLAR_ECLIPSE_DATA=data, PYTHONPATH=PACKAGE)
+    try:
+        timed(COMMANDS['help'], env)  # the first run pays for reading the bytecode from disk
+        for name, arguments in COMMANDS.items():
+            seconds = []
+            for _ in range(repeat):
+                elapsed, heavy = timed(arguments, env)
+                seconds.append(elapsed)
+            results[name] = {'best': min(seconds), 'median': statistics.median(seconds), 'heavy': heavy}
+            print(f"{name:<16} {min(seconds) * 1000:>9.1f} ms {statistics.median(seconds) * 1000:>9.1f} ms  "
+                  f"{' '.join(heavy) if heavy else '-'}", flush=True)
+    finally:
+        shutil.rmtree(data, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='command line start up time and the heavy modules each command loads')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each command (default 5)')
+    args = parser.parse_args()
+    results = run(args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'repeat': args.repeat, 'commands': results}, f, indent=1)
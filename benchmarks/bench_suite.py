@@ -0,0 +1,185 @@
+'''
+the numeric and rendering hot paths timed offline, with results as JSON to compare between versions
+
+    python3 benchmarks/bench_suite.py [--json results.json] [--baseline previous.json] [--threshold 0.25]
+                                      [--cases circumstances animation ...] [--repeat 5] [--size 1920x1080]
+
+nothing is downloaded or read from /var/data: the Sun, Earth and Moon come from data/de421_20231014.bsp, an SPK
+excerpt of DE421 for 2023-10-11 to 2023-10-17 (skyfieldcalcs.excerpt_ephemeris), and the sky, Sun and Moon are
+generated at --size.  anything the runs write (excerpts, caches, frames, MP4s) goes to a temporary directory,
+SOLAR_ECLIPSE_DATA points there.
+
+each case is run --repeat times after one untimed run (but for animation, by far the longest, which has nothing
+left to warm), best and median are seconds per run and rate is how many of its operations (calls, elements,
+frames) that is per second at best.  with --baseline, any case whose best is more than --threshold slower than the
+baseline's is reported as a regression and the exit status is 1.
+'''
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+if 'SOLAR_ECLIPSE_DATA' not in os.environ:
+    os.environ['SOLAR_ECLIPSE_DATA'] = tempfile.mkdtemp(prefix='bench_suite_')
+    atexit.register(shutil.rmtree, os.environ['SOLAR_ECLIPSE_DATA'], ignore_errors=True)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'solar_eclipse_animation'))
+from imaging import DiskRenderer, Renderer, compositing, prep_image  # noqa: E402
+from main import main as animation  # noqa: E402
+from skyfieldcalcs import circumstances, contact_points, eclipse_fraction, eclipse_fraction_array, load_ephemeris, \
+    ts  # noqa: E402
+
+SPK = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'de421_20231014.bsp'))
+SITE = (35.78255, -78.63899, 97)  # Raleigh, NC, a partial eclipse
+DATE = ts.utc(2023, 10, 14)
+
+
+def make_assets(dirname, size=(1920, 1080)):
+    '''
+    the sky as images/README.md describes it, a limb darkened Sun and a grey Moon disk, each the Sun's share of the
+    height the 4K images have (1000 of 2160 pixels)
+    '''
+    Image.new('RGB', size, '#87CEEB').save(f'{dirname}/bluesky_4k.png')
+    diameter = round(size[1] * 1000 / 2160)
+    yx = (np.indices((diameter, diameter)) + 0.5 - diameter / 2) / (diameter / 2)
+    r = np.minimum(np.hypot(*yx), 1)
+    inside = (r < 1).astype(np.float32)
+    darkening = 1 - 0.6 * (1 - np.sqrt(1 - r ** 2))
+    sun = np.dstack([255 * darkening, 200 * darkening, 60 * darkening, 255 * inside])
+    Image.fromarray(np.rint(sun).astype(np.uint8), 'RGBA').save(f'{dirname}/sun.png')
+    moon = np.dstack([np.full_like(r, 40), np.full_like(r, 40), np.full_like(r, 45), 255 * inside])
+    Image.fromarray(np.rint(moon).astype(np.uint8), 'RGBA').save(f'{dirname}/newmoon.png')
+
+
+def sweep(n):
+    # the Moon across the Sun, Oct 14 2023 sizes
+    for i in range(n):
+        offset = -0.6 + 1.2 * i / max(n - 1, 1)
+        yield 0.2671, 0.2533, offset, offset * 0.4
+
+
+def cases(imagedir, workdir):
+    '''
+    name: (function, operations per call, whether to run it once untimed first), set up before any timing
+    '''
+    eph = load_ephemeris(SPK)
+    rng = np.random.default_rng(20231014)
+    s, moon_r, sun_r = rng.uniform(0, 0.6, 10 ** 6), rng.uniform(0.24, 0.28, 10 ** 6), rng.uniform(0.24, 0.28, 10 ** 6)
+    scalars = list(zip(s[:10 ** 4].tolist(), moon_r[:10 ** 4].tolist(), sun_r[:10 ** 4].tolist()))
+    table = circumstances(DATE, *SITE, eph=eph, columnar=True)[5]
+    frame = table.to_frame()
+    renderer, disk = Renderer(imagedir), DiskRenderer(imagedir)
+    frames = list(sweep(20))
+
+    def fraction():
+        for args in scalars:
+            eclipse_fraction(*args)
+
+    def composite():
+        for n, (sun_radius, moon_radius, dalt, daz) in enumerate(frames[:5]):
+            compositing(frame=True, title='bench', iso=f'20231014T1200{n:02d}', sun_radius=sun_radius,
+                        moon_radius=moon_radius, moon_alt_delta_deg=dalt, moon_az_delta_deg=daz, basedir=workdir,
+                        renderer=renderer)
+
+    def prep():
+        sun = prep_image(f'{imagedir}/sun.png', None, 1)[0]
+        prep_image(f'{imagedir}/bluesky_4k.png', None, 1)
+        prep_image(f'{imagedir}/newmoon.png', sun, 0.95)
+
+    return {
+        'eclipse_fraction': (fraction, len(scalars), True),
+        'eclipse_fraction_array': (lambda: eclipse_fraction_array(s, moon_r, sun_r), len(s), True),
+        'circumstances': (lambda: circumstances(DATE, *SITE, eph=eph, columnar=True), 1, True),
+        'contact_points_frame': (lambda: contact_points(frame.copy()), 1, True),
+        'contact_points_table': (lambda: contact_points(table), 1, True),
+        'prep_image': (prep, 1, True),
+        'compositing': (composite, 5, True),
+        'render_pil': (lambda: [renderer.render_pixels(*f) for f in frames], len(frames), True),
+        'render_disk': (lambda: [disk.render_pixels(*f) for f in frames], len(frames), True),
+        'animation': (lambda: animation(lat=SITE[0], lon=SITE[1], ele=SITE[2], ephfilename=SPK, cache=False,
+                                        basedir=workdir, imagedir=imagedir, compositor='disk'), 1, False),
+    }
+
+
+def run(selected, repeat, size):
+    results = {}
+    with tempfile.TemporaryDirectory(dir=os.environ['SOLAR_ECLIPSE_DATA']) as workdir:
+        imagedir = f'{workdir}/images'
+        os.mkdir(imagedir)
+        make_assets(imagedir, size)
+        available = cases(imagedir, workdir)
+        for name in selected or available:
+            f, operations, warm = available[name]
+            if warm:
+                f()  # caches and lazy imports aren't what's measured
+            seconds = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                f()
+                seconds.append(time.perf_counter() - started)
+            results[name] = {'best': min(seconds), 'median': statistics.median(seconds), 'operations': operations,
+                             'rate': operations / min(seconds)}
+            print(f"{name:<24} {min(seconds) * 1000:>10.2f} ms {statistics.median(seconds) * 1000:>10.2f} ms "
+                  f"{operations / min(seconds):>12.4g} /s", flush=True)
+    return results
+
+
+def environment(size):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    from importlib.metadata import version
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'size': list(size),
+            'packages': {name: version(name) for name in ['numpy', 'pandas', 'skyfield', 'jplephem', 'Pillow']}}
+
+
+def regressions(results, baseline, threshold):
+    '''
+    :return: list of (case, baseline best, best) for the cases more than threshold (a fraction) slower
+    '''
+    slower = []
+    for name, result in results.items():
+        before = baseline.get('cases', {}).get(name)
+        if before is not None and result['best'] > before['best'] * (1 + threshold):
+            slower.append((name, before['best'], result['best']))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmarks of the numeric and rendering hot paths')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run (--json) to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='how much slower than the baseline is a '
+                                                                      'regression (default 0.25, 25%%)')
+    parser.add_argument('--cases', nargs='+', help='just these cases (default all)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each case (default 5)')
+    parser.add_argument('--size', default='1920x1080', help='size of the generated sky (default 1920x1080)')
+    args = parser.parse_args()
+    size = tuple(int(n) for n in args.size.lower().split('x'))
+
+    results = run(args.cases, args.repeat, size)
+    report = {'environment': environment(size), 'repeat': args.repeat, 'cases': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        for name, before, after in slower:
+            print(f"regression: {name} {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({after / before - 1:+.0%})")
+        print(f"{len(slower)} regressions against {args.baseline} ({baseline['environment'].get('commit')})")
+        if slower:
+            sys.exit(1)
@@ -1,7 +1,175 @@
 import argparse
-from main import main
+import sys
+
+
+def map_command(argv):
+    '''
+    solar_eclipse_animation map [date] [--lat S N] [--lon W E] [--size ROWS COLS] ...
+    '''
+    from mapping import CONUS, obscuration_map, save_map
+    from runtime import timescale
+    parser = argparse.ArgumentParser(
+        prog='solar eclipse animation map',
+        description='Maximum obscuration and contact times over a grid of latitudes and longitudes, written as a NumPy .npz, a CSV and a heatmap PNG')
+    parser.add_argument('date', help='date of the solar eclipse YYYYMMDD (default 20231014)', default='20231014', nargs='?')
+    parser.add_argument('--lat', type=float, nargs=2, default=CONUS['lat'], metavar=('SOUTH', 'NORTH'), help='latitude range in degrees (default CONUS)')
+    parser.add_argument('--lon', type=float, nargs=2, default=CONUS['lon'], metavar=('WEST', 'EAST'), help='longitude range in degrees (default CONUS)')
+    parser.add_argument('--size', type=int, nargs=2, default=(1000, 1000), metavar=('ROWS', 'COLS'), help='grid points north-south and east-west (default 1000 1000)')
+    parser.add_argument('--ele', type=float, default=0, help='elevation in meters of every grid point (default 0)')
+    parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes (default 1, 0 for one per core)')
+    parser.add_argument('--fontfile', help='path to true type font file for the heatmap title')
+    parser.add_argument('--out', default='results/maps', help='output directory (default results/maps)')
+    args = parser.parse_args(argv)
+    date = str(args.date)
+    obscuration = obscuration_map(timescale().utc(int(date[:4]), int(date[4:6]), int(date[6:8])), lat_range=args.lat,
+                                  lon_range=args.lon, shape=args.size, ele=args.ele, ephfilename=args.eph,
+                                  workers=args.workers or None)
+    for path in save_map(obscuration, args.out, name=f"{date}_obscuration", fontfile=args.fontfile,
+                         title=f"{date[:4]}-{date[4:6]}-{date[6:8]} maximum obscuration"):
+        print(path)
+
+
+def search_command(argv):
+    '''
+    solar_eclipse_animation search latitude longitude [--from YEAR] [--to YEAR] ...
+    '''
+    from search import search_eclipses
+    parser = argparse.ArgumentParser(
+        prog='solar eclipse animation search',
+        description='Lists every solar eclipse seen from a site over a span of years')
+    parser.add_argument('latitude', type=float, help='decimal latitude in degrees (example:  35.78)')
+    parser.add_argument('longitude', type=float, help='decimal longitude in degrees (example: -78.664')
+    parser.add_argument('--ele', type=float, default=100, help='elevation in meters (default 100)')
+    parser.add_argument('--from', dest='start', type=int, default=1900, help='first year searched (default 1900)')
+    parser.add_argument('--to', dest='end', type=int, default=2100, help='last year searched (default 2100)')
+    parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430, which covers 1550 CE to 2650 CE)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes (default 1, 0 for one per core)')
+    parser.add_argument('--all', dest='visible', action='store_false', help='include eclipses that happen with the Sun below the horizon')
+    parser.add_argument('--csv', help='also write the list to this CSV file')
+    args = parser.parse_args(argv)
+    df = search_eclipses(args.latitude, args.longitude, ele=args.ele, start_year=args.start, end_year=args.end,
+                         ephfilename=args.eph, workers=args.workers or None, visible=args.visible)
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+    print(df[['date', 'kind', 'c1_utc', 'mid_utc', 'c4_utc', 'eclipse_fraction', 'sun_alt']].to_string(index=False))
+
+
+def batch_command(argv):
+    '''
+    solar_eclipse_animation batch cities.csv [--workers N] [--encoders N] [--summary batch.json] ...
+    '''
+    from jobs import read_manifest, run_batch
+    from timeline import parse_interval
+    parser = argparse.ArgumentParser(
+        prog='solar eclipse animation batch',
+        description='Animations for every city in a manifest, sharing one pool of render workers and its caches, each MP4 finishing encoding while the next city renders')
+    parser.add_argument('manifest', help='cities as CSV (name, lat, lon, optionally ele and date), INI (a section per city with city, lat, lon, ele) or JSON')
+    parser.add_argument('--date', default='20231014', help='date of the solar eclipse YYYYMMDD for cities without one (default 20231014)')
+    parser.add_argument('--fontfile', help='path to true type font file for the clock and percent obscuration labels')
+    parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430)')
+    parser.add_argument('--workers', type=int, default=1, help='number of render processes shared by every city (default 1, 0 for one per core)')
+    parser.add_argument('--encoders', type=int, default=1, help='MP4s allowed to finish encoding while the next city renders (default 1)')
+    parser.add_argument('--backend', choices=['skyfield', 'besselian', 'astronomy', 'ephem'], default='skyfield', help='ephemeris backend (default skyfield)')
+    parser.add_argument('--step', help='eclipse time between frames, e.g. 5s, 500ms or 1m (default: a frame for each minute)')
+    parser.add_argument('--fps', type=int, default=25, help='frame rate of the animations (default 25)')
+    parser.add_argument('--compositor', choices=['pil', 'disk'], default='pil', help='pil (default) or disk')
+    parser.add_argument('--quality', choices=['draft', 'preview', 'final'], default='final', help='draft, preview or final (default)')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='write PNG frames and assemble them with ffmpeg afterwards')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='always recompute the circumstances')
+    parser.add_argument('--outputs', nargs='+', default=['mp4'], help='formats to encode each city to, e.g. mp4 webm:1280 gif:480@10 strip (default mp4)')
+    parser.add_argument('--summary', default='batch_summary.json', help='JSON report of every city\'s timings and errors (default batch_summary.json)')
+    args = parser.parse_args(argv)
+    results = run_batch(read_manifest(args.manifest, date=args.date), workers=args.workers or None,
+                        encoders=args.encoders, font=args.fontfile, ephfilename=args.eph, backend=args.backend,
+                        compositor=args.compositor, cache=args.cache, summary=args.summary,
+                        step=None if args.step is None else parse_interval(args.step), fps=args.fps,
+                        quality=args.quality, stream=args.stream, outputs=args.outputs)
+    print(f"{'city':<30} {'status':<7} {'circumstances':>13} {'render':>8} {'encode':>8}")
+    for r in results:
+        seconds = r['seconds']
+        print(f"{r['name']:<30} {r['status']:<7} {seconds['circumstances']:>13.1f} {seconds['render']:>8.1f} "
+              f"{seconds['encode']:>8.1f}  {r['mp4'] or r['error']}")
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
+
+
+def circumstances_command(argv):
+    '''
+    solar_eclipse_animation circumstances [date] latitude longitude [--ele M] [--backend B] [--json]
+
+    just the contacts, nothing is rendered and neither the images nor pandas are loaded
+    '''
+    import json
+    from frameplan import EVENTS
+    from backends import site_circumstances
+    parser = argparse.ArgumentParser(
+        prog='solar eclipse animation circumstances',
+        description='The contact times of a solar eclipse at a site, in UTC and local time, with the altitude and azimuth of the Sun and how much of it is covered at each, without making an animation')
+    parser.add_argument('date', help='date of the solar eclipse YYYYMMDD (default 20231014)', default='20231014', nargs='?')
+    parser.add_argument('latitude', type=float, help='decimal latitude in degrees (example:  35.78)')
+    parser.add_argument('longitude', type=float, help='decimal longitude in degrees (example: -78.664')
+    parser.add_argument('--ele', type=float, default=100, help='elevation in meters (default 100)')
+    parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430)')
+    parser.add_argument('--backend', choices=['skyfield', 'besselian', 'astronomy', 'ephem'], default='skyfield', help='ephemeris backend (default skyfield)')
+    parser.add_argument('--json', action='store_true', help='print the contacts as JSON')
+    args = parser.parse_args(argv)
+    if not -90 <= args.latitude <= 90 or not -180 <= args.longitude <= 180:
+        parser.error('please specify a decimal longitude and latitude')
+    result = site_circumstances(str(args.date), args.latitude, args.longitude, ele=args.ele, backend=args.backend,
+                                ephfilename=args.eph)
+    contacts, zone = result['contacts'], result['timezone']
+    if args.json:
+        print(json.dumps(result, indent=1))
+        return
+    if not contacts:
+        print(f"no eclipse at {args.latitude}, {args.longitude} on {args.date}")
+        return
+    print(f"{'':<26} {'UTC':<21} {zone or 'local':<26} {'sun alt':>8} {'sun az':>7} {'obscured':>9}")
+    for contact in contacts:
+        print(f"{EVENTS[contact['contact']]:<26} {contact['utc_iso']:<21} {contact['local_iso'] or '':<26} "
+              f"{contact['sun_alt']:>8.2f} {contact['sun_az']:>7.2f} {contact['eclipse_fraction']:>9.1%}")
+
+
+def serve_command(argv):
+    '''
+    solar_eclipse_animation serve [--port 8023] [--socket PATH] [--queue N] [--jobs N] ...
+    '''
+    from service import Service, make_server
+    parser = argparse.ArgumentParser(
+        prog='solar eclipse animation serve',
+        description='A local service keeping the ephemeris, timezones and images loaded: circumstances as JSON (GET /circumstances), single frames as PNG (GET /frame) and animations through a bounded queue (POST /animations, GET /animations/ID)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8023, help='port to listen on (default 8023)')
+    parser.add_argument('--socket', help='listen on this Unix socket rather than a port')
+    parser.add_argument('--fontfile', help='path to true type font file for the clock and percent obscuration labels')
+    parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430)')
+    parser.add_argument('--backend', choices=['skyfield', 'besselian', 'astronomy', 'ephem'], default='skyfield', help='ephemeris backend for requests that don\'t name one (default skyfield)')
+    parser.add_argument('--compositor', choices=['pil', 'disk'], default='pil', help='pil (default) or disk for requests that don\'t name one')
+    parser.add_argument('--queue', type=int, default=8, help='animations allowed to wait, more are turned away with 503 (default 8)')
+    parser.add_argument('--jobs', type=int, default=1, help='animations rendered at once (default 1)')
+    parser.add_argument('--workers', type=int, default=1, help='render processes per animation (default 1, 0 for one per core)')
+    args = parser.parse_args(argv)
+    service = Service(ephfilename=args.eph, font=args.fontfile, backend=args.backend, compositor=args.compositor,
+                      queue_size=args.queue, jobs=args.jobs, workers=args.workers or None)
+    service.warm()
+    server = make_server(service, host=args.host, port=args.port, socket=args.socket)
+    print(f"serving on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+COMMANDS = {'map': map_command, 'search': search_command, 'batch': batch_command,
+            'circumstances': circumstances_command, 'serve': serve_command}
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit()
     parser = argparse.ArgumentParser(
         prog='solar eclipse animation',
         description='Calculates the circumstances for a given solar eclipse for a given set of coordinates. Creates frame for each minute, pausing at the beginning and end of the partial eclipse, maximum eclipse, and (for coordinates inside the annular or partial path) at the beginning and end of annularity or totality',
@@ -14,6 +182,18 @@ if __name__ == '__main__':
     parser.add_argument('--fontfile', help='path to true type font file, a (local time) clock to the lower left and percent obscuration to the lower right')
     parser.add_argument('--eph', default='de430t.bsp', help='JPL planetary and lunar ephemerides spice file (default: DE430, which covers 1550 CE to 2650 CE with reasonable delta T)')
     parser.add_argument('--handbrake',  action='store_true', help='optionally launches handbrake to clean up the MP4 file a bit')
+    parser.add_argument('--handbrake-cli', metavar='PATH', help='path of HandBrakeCLI for --handbrake (default: /Applications/HandBrakeCLI)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes rendering frames (default 1, 0 for one per core)')
+    parser.add_argument('--png-frames', action='store_true', help='also write every frame as a PNG under results/.../frames (for debugging)')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='write PNG frames and assemble them with ffmpeg afterwards rather than piping frames straight into ffmpeg')
+    parser.add_argument('--backend', choices=['skyfield', 'besselian', 'astronomy', 'ephem'], default='skyfield', help='observe the Sun and Moon from the site every minute with skyfield (default), evaluate Besselian elements fitted once for the eclipse (besselian, faster), or use astronomy-engine or PyEphem, which need no ephemeris file (see benchmarks/bench_backends.py)')
+    parser.add_argument('--step', help='eclipse time between frames, e.g. 5s, 500ms or 1m (default: a frame for each minute), positions in between the minutes are interpolated from a fitted timeline')
+    parser.add_argument('--fps', type=int, default=25, help='frame rate of the animation (default 25), with --step sets how much faster than real time it plays')
+    parser.add_argument('--compositor', choices=['pil', 'disk'], default='pil', help='pil pastes the Sun and Moon images (default), disk draws them as anti-aliased disks at sub-pixel positions, smoother and several times faster')
+    parser.add_argument('--quality', choices=['draft', 'preview', 'final'], default='final', help='draft (quarter size) and preview (half size) render the same frames quickly from scaled down images into draft/ or preview/, final (default) is full size')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='always recompute the circumstances rather than reusing them from /var/data/solar_eclipse_animation')
+    parser.add_argument('--outputs', nargs='+', default=['mp4'], help='formats to encode from the one pass of rendering, side by side: mp4 (default), webm, gif and strip (a thumbnail strip PNG), each optionally with the width it is scaled down to and its frame rate, e.g. --outputs mp4 webm:1280 gif:480@10 strip')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'], help='add a profile to the run report written beside the MP4: the functions with the most time (cprofile, also saved as .prof) or the lines allocating the most memory (tracemalloc)')
     args = parser.parse_args()
     try:
         longitude = float(args.longitude)
@@ -30,5 +210,10 @@ if __name__ == '__main__':
     else:
         name = args.name
 
-    main(name=name, lat=latitude, lon=longitude, font=args.fontfile, ephfilename=args.eph, handbrake=args.handbrake)
+    from main import main
+    from timeline import parse_interval
+    main(name=name, lat=latitude, lon=longitude, font=args.fontfile, ephfilename=args.eph, handbrake=(args.handbrake_cli or True) if args.handbrake else None, cache=args.cache,
+         workers=args.workers or None, stream=args.stream, save_frames=args.png_frames,
+         backend=args.backend, step=None if args.step is None else parse_interval(args.step), fps=args.fps,
+         compositor=args.compositor, quality=args.quality, profile=args.profile, outputs=args.outputs)
 
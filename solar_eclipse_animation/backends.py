@@ -0,0 +1,315 @@
+import math
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from skyfield.api import wgs84
+
+from runtime import timescale, timezone_at
+from skyfieldcalcs import MOON_RADIUS_KM, SUN_RADIUS_KM, CircumstancesTable, eclipse_fraction_array, find_contacts, \
+    get_ints_for_dt_params, load_ephemeris, observe
+
+AU_KM = 149597870.7
+POSITIONS = ['moon_alt', 'moon_az', 'moon_dist', 'sun_alt', 'sun_az', 'sun_dist']
+CONTACTS = ['c1', 'c2', 'mid', 'c3', 'c4']
+
+
+class Backend(ABC):
+    '''
+    the Sun and Moon as seen from a site: topocentric apparent altitude and azimuth (degrees, no refraction) and
+    distance (km) at TT julian dates.  a backend only has to implement positions(), the circumstances table and the
+    contact points are built on it the same way for all of them.
+    '''
+    name = None
+    needs_spk = False  # whether it reads a JPL SPK file
+
+    @abstractmethod
+    def positions(self, lat, lon, ele, jd):
+        '''
+        :param jd: TT julian dates (array)
+        :return: dict of arrays: moon_alt, moon_az, moon_dist, sun_alt, sun_az, sun_dist
+        '''
+
+    def table(self, lat, lon, ele, jd):
+        '''
+        :return: CircumstancesTable with the same columns as skyfieldcalcs.observe
+        '''
+        jd = np.asarray(jd, dtype=float)
+        return positions_table(jd, self.positions(lat, lon, ele, jd))
+
+    def evaluator(self, lat, lon, ele):
+        '''
+        :return: evaluate(jd) for find_contacts
+        '''
+        def evaluate(jd):
+            table = self.table(lat, lon, ele, jd)
+            return table.separation, table.moon_r, table.sun_r
+        return evaluate
+
+    def contacts(self, start, lat, lon, ele=100, step_minutes=20, tolerance_seconds=0.05):
+        '''
+        :param start: skyfield Time, the day of the eclipse
+        :return: dict of TT julian dates for c1, c2, mid, c3, c4 (None when not applicable), see find_contacts
+        '''
+        day, hour, minute, month, second, year = get_ints_for_dt_params(start)
+        noon = timescale().utc(year, month, day, 12).tt
+        return find_contacts(self.evaluator(lat, lon, ele), noon - 1, noon + 1, step_minutes / 1440,
+                             tolerance_seconds / 86400)
+
+
+class SkyfieldBackend(Backend):
+    '''
+    Skyfield and a JPL SPK ephemeris, the reference the others are measured against
+    '''
+    name = 'skyfield'
+    needs_spk = True
+
+    def __init__(self, eph=None, ephfilename=None):
+        self.eph = load_ephemeris(ephfilename) if eph is None else eph
+
+    def positions(self, lat, lon, ele, jd):
+        table = self.table(lat, lon, ele, jd)
+        return {name: np.asarray(table[name], dtype=float) for name in POSITIONS}
+
+    def table(self, lat, lon, ele, jd):
+        place = self.eph['earth'] + wgs84.latlon(lat, lon, elevation_m=ele)
+        return observe(self.eph, place, timescale().tt_jd(np.asarray(jd, dtype=float)))
+
+
+class BesselianBackend(Backend):
+    '''
+    Besselian elements fitted from Skyfield once per eclipse (see besselian.py), positions are only available during
+    the hours the elements cover (NaN outside them)
+    '''
+    name = 'besselian'
+    needs_spk = True
+
+    def __init__(self, eph=None, ephfilename=None):
+        self.eph = load_ephemeris(ephfilename) if eph is None else eph
+
+    def elements(self, jd):
+        from besselian import besselian_elements
+        return besselian_elements(timescale().tt_jd(float(np.median(jd))), eph=self.eph)
+
+    def positions(self, lat, lon, ele, jd):
+        jd = np.asarray(jd, dtype=float)
+        p = {name: np.full(len(jd), np.nan) for name in POSITIONS}
+        elements = self.elements(jd) if len(jd) else None
+        if elements is not None:
+            hours = elements.hours_from_jd(jd)
+            inside = (hours >= elements.hours[0]) & (hours <= elements.hours[1])
+            table = self._observe(elements, lat, lon, ele, jd[inside])
+            for name in POSITIONS:
+                p[name][inside] = table[name]
+        return p
+
+    def table(self, lat, lon, ele, jd):
+        # just the rows the elements cover, the separation straight from the fundamental plane
+        jd = np.asarray(jd, dtype=float)
+        elements = self.elements(jd) if len(jd) else None
+        if elements is None:
+            return Backend.table(self, lat, lon, ele, jd[:0])
+        hours = elements.hours_from_jd(jd)
+        return self._observe(elements, lat, lon, ele, jd[(hours >= elements.hours[0]) & (hours <= elements.hours[1])])
+
+    def contacts(self, start, lat, lon, ele=100, step_minutes=20, tolerance_seconds=0.05):
+        from besselian import Site, besselian_elements
+        elements = besselian_elements(start, eph=self.eph)
+        if elements is None:
+            return dict.fromkeys(CONTACTS)
+        contacts = elements.contacts(Site(lat, lon, ele), tolerance_seconds=tolerance_seconds)
+        return {k: float(contacts[k]) if np.isfinite(contacts[k]) else None for k in CONTACTS}
+
+    @staticmethod
+    def _observe(elements, lat, lon, ele, jd):
+        from besselian import Site
+        return elements.observe(Site(lat, lon, ele), jd)
+
+
+class AstronomyEngineBackend(Backend):
+    '''
+    astronomy-engine (pip install astronomy-engine), analytic theories rather than an SPK file so there is nothing to
+    download or open.  one position at a time.
+    '''
+    name = 'astronomy'
+
+    def __init__(self):
+        import astronomy
+        self.astronomy = astronomy
+
+    def positions(self, lat, lon, ele, jd):
+        astronomy = self.astronomy
+        observer = astronomy.Observer(lat, lon, ele)
+        p = {name: np.empty(len(jd)) for name in POSITIONS}
+        for n, tt in enumerate(np.asarray(jd, dtype=float)):
+            t = astronomy.Time.FromTerrestrialTime(tt - 2451545.0)
+            for label, body in [('moon', astronomy.Body.Moon), ('sun', astronomy.Body.Sun)]:
+                equator = astronomy.Equator(body, t, observer, True, True)
+                horizon = astronomy.Horizon(t, observer, equator.ra, equator.dec, astronomy.Refraction.Airless)
+                p[f'{label}_alt'][n] = horizon.altitude
+                p[f'{label}_az'][n] = horizon.azimuth
+                p[f'{label}_dist'][n] = equator.dist * AU_KM
+        return p
+
+
+class PyEphemBackend(Backend):
+    '''
+    PyEphem (pip install ephem), libastro's analytic theories.  computed for an observer, earth_distance is already
+    topocentric.  one position at a time.
+    '''
+    name = 'ephem'
+
+    def __init__(self):
+        import ephem
+        self.ephem = ephem
+
+    def positions(self, lat, lon, ele, jd):
+        ephem = self.ephem
+        observer = ephem.Observer()
+        observer.lat, observer.lon, observer.elevation = str(lat), str(lon), ele
+        observer.pressure = 0  # no refraction, like the others
+        bodies = {'moon': ephem.Moon(), 'sun': ephem.Sun()}
+        p = {name: np.empty(len(jd)) for name in POSITIONS}
+        jd = np.asarray(jd, dtype=float)
+        for n, utc in enumerate(timescale().tt_jd(jd).utc_datetime() if len(jd) else []):
+            observer.date = ephem.Date(utc)
+            for label, body in bodies.items():
+                body.compute(observer)
+                p[f'{label}_alt'][n] = math.degrees(float(body.alt))
+                p[f'{label}_az'][n] = math.degrees(float(body.az))
+                p[f'{label}_dist'][n] = body.earth_distance * AU_KM
+        return p
+
+
+BACKENDS = {backend.name: backend for backend in [SkyfieldBackend, BesselianBackend, AstronomyEngineBackend,
+                                                   PyEphemBackend]}
+_backends = {}
+
+
+def get_backend(name, eph=None, ephfilename=None):
+    '''
+    one instance per backend (and ephemeris) for the life of the process
+    :param name: skyfield, besselian, astronomy or ephem
+    '''
+    if name not in BACKENDS:
+        raise ValueError(f"unsupported backend {name}")
+    cls = BACKENDS[name]
+    key = (name, id(eph), ephfilename) if cls.needs_spk else name
+    if key not in _backends:
+        _backends[key] = cls(eph=eph, ephfilename=ephfilename) if cls.needs_spk else cls()
+    return _backends[key]
+
+
+def positions_table(jd, p):
+    '''
+    :param jd: TT julian dates
+    :param p: dict of position arrays at those times, see Backend.positions
+    :return: CircumstancesTable with the same columns as skyfieldcalcs.observe
+    '''
+    table = CircumstancesTable(jd)
+    table['separation'] = angular_separation(p['moon_alt'], p['moon_az'], p['sun_alt'], p['sun_az'])
+    for name in POSITIONS:
+        table[name] = p[name]
+    table['moon_r'] = np.degrees(np.arcsin(MOON_RADIUS_KM / p['moon_dist']))
+    table['sun_r'] = np.degrees(np.arcsin(SUN_RADIUS_KM / p['sun_dist']))
+    table['eclipse_fraction'] = eclipse_fraction_array(table.separation, table.moon_r, table.sun_r)
+    return table
+
+
+def contact_table(backend, start, lat, lon, ele=100):
+    '''
+    the contacts at a site with where the Sun is and how much of it is covered at each, from the backend alone: no
+    dataframes and nothing from the rendering side, for a quick answer
+    :param backend: a Backend, see get_backend
+    :param start: skyfield Time, the day of the eclipse
+    :return: list of a dict per contact there is (contact, jd, utc_iso, sun_alt, sun_az, eclipse_fraction), in order
+    '''
+    contacts = backend.contacts(start, lat, lon, ele)
+    names = [k for k in CONTACTS if contacts[k] is not None]
+    if not names:
+        return []
+    jd = np.array([contacts[k] for k in names], dtype=float)
+    table = positions_table(jd, backend.positions(lat, lon, ele, jd))
+    return [{'contact': k, 'jd': float(jd[n]), 'utc_iso': table.utc_iso[n], 'sun_alt': float(table.sun_alt[n]),
+             'sun_az': float(table.sun_az[n]), 'eclipse_fraction': float(table.eclipse_fraction[n])}
+            for n, k in enumerate(names)]
+
+
+def site_circumstances(date, lat, lon, ele=100, backend='skyfield', ephfilename='de430t.bsp'):
+    '''
+    the contacts at a site with their local times, what the circumstances command prints
+    :param date: YYYYMMDD
+    :return: dict of date, lat, lon, ele, timezone, backend and contacts (see contact_table, plus local_iso)
+    '''
+    start = timescale().utc(int(date[:4]), int(date[4:6]), int(date[6:8]))
+    contacts = contact_table(get_backend(backend, ephfilename=ephfilename), start, lat, lon, ele)
+    zone = timezone_at(lat, lon)
+    for contact in contacts:
+        utc = datetime.fromisoformat(contact['utc_iso'].replace('Z', '+00:00'))
+        contact['local_iso'] = utc.astimezone(ZoneInfo(zone)).isoformat() if zone else None
+    return {'date': date, 'lat': lat, 'lon': lon, 'ele': ele, 'timezone': zone, 'backend': backend,
+            'contacts': contacts}
+
+
+def angular_separation(alt1, az1, alt2, az2):
+    '''
+    separation (degrees) of two alt/az positions, atan2 of the cross and dot products keeps its precision when small
+    '''
+    alt1, az1, alt2, az2 = (np.radians(np.asarray(v, dtype=float)) for v in (alt1, az1, alt2, az2))
+    a = np.stack([np.cos(alt1) * np.cos(az1), np.cos(alt1) * np.sin(az1), np.sin(alt1)], axis=-1)
+    b = np.stack([np.cos(alt2) * np.cos(az2), np.cos(alt2) * np.sin(az2), np.sin(alt2)], axis=-1)
+    return np.degrees(np.arctan2(np.linalg.norm(np.cross(a, b), axis=-1), np.sum(a * b, axis=-1)))
+
+
+def benchmark(backends, sites, start, reference='skyfield', positions_per_site=60):
+    '''
+    throughput and accuracy of each backend over a set of sites for one eclipse
+    :param backends: dict of name: Backend, must include the reference
+    :param sites: list of (lat, lon, ele)
+    :param start: skyfield Time, the day of the eclipse
+    :param positions_per_site: times (evenly spread across the reference's eclipse at each site) positions are timed over
+    :return: dict of name: {positions_per_second, seconds_per_contacts (per site), max_deviation and mean_deviation
+             (seconds from the reference's contacts), mismatched (contacts one has and the other doesn't)}
+    '''
+    expected = [backends[reference].contacts(start, *site) for site in sites]
+    results = {}
+    for name, backend in backends.items():
+        began = time.perf_counter()
+        count = 0
+        for site, contacts in zip(sites, expected):
+            if contacts['c1'] is None:
+                continue
+            jd = np.linspace(contacts['c1'], contacts['c4'], positions_per_site)
+            backend.positions(*site, jd)
+            count += len(jd)
+        positions_seconds = time.perf_counter() - began
+
+        began = time.perf_counter()
+        found = [backend.contacts(start, *site) for site in sites]
+        contacts_seconds = time.perf_counter() - began
+
+        deviations, mismatched = [], 0
+        for mine, theirs in zip(found, expected):
+            for k in CONTACTS:
+                if (mine[k] is None) != (theirs[k] is None):
+                    mismatched += 1
+                elif mine[k] is not None:
+                    deviations.append(abs(mine[k] - theirs[k]) * 86400)
+        results[name] = {'positions_per_second': count / positions_seconds if positions_seconds else float('inf'),
+                         'seconds_per_contacts': contacts_seconds / len(sites),
+                         'max_deviation': max(deviations, default=0.0),
+                         'mean_deviation': float(np.mean(deviations)) if deviations else 0.0,
+                         'mismatched': mismatched}
+    return results
+
+
+def select_backend(results, tolerance_seconds=1.0):
+    '''
+    the fastest backend (by contacts per second) whose contacts are all within tolerance of the reference
+    :param results: from benchmark
+    :return: backend name, None if none meet the tolerance
+    '''
+    eligible = [name for name, r in results.items() if r['mismatched'] == 0 and r['max_deviation'] <= tolerance_seconds]
+    return min(eligible, key=lambda name: results[name]['seconds_per_contacts'], default=None)
@@ -0,0 +1,275 @@
+import numpy as np
+from numpy.polynomial import polynomial
+from skyfield.api import wgs84
+from skyfield.framelib import true_equator_and_equinox_of_date
+
+from runtime import timescale
+from skyfieldcalcs import MOON_RADIUS_KM, SUN_RADIUS_KM, CircumstancesTable, eclipse_fraction_array, \
+    get_ints_for_dt_params, load_ephemeris
+
+EARTH_RADIUS_KM = 6378.137  # WGS84 equatorial radius, the unit of the fundamental plane
+K = MOON_RADIUS_KM / EARTH_RADIUS_KM
+SUN_RADIUS = SUN_RADIUS_KM / EARTH_RADIUS_KM
+ELEMENTS = ['x', 'y', 'z', 'd', 'mu', 'g']
+# the elements are fitted wherever the geocentric Sun and Moon are closer than this, an eclipse can't be seen from
+# anywhere outside it (both radii plus the Moon's largest horizontal parallax, with some margin)
+GEOCENTRIC_LIMIT_DEG = 1.7
+
+_elements = {}
+
+
+class BesselianElements:
+    '''
+    polynomial Besselian elements of a solar eclipse, fitted once from the ephemeris and then evaluated in closed form
+    for any number of sites.  time is hours (TT) from t0, distances are Earth equatorial radii.
+
+    x, y, z: the Moon in the fundamental plane (through the Earth's centre, perpendicular to the Moon-Sun axis)
+    d, mu: declination and Greenwich hour angle of the axis (degrees)
+    g: distance from the Moon to the Sun, which fixes the penumbral and umbral cones (f1, f2, l1, l2)
+
+    the cones are exact, so contacts are where the Skyfield path finds them to well under a second, maximum is the
+    least separation of the centres as seen from the site just as in circumstances.
+    '''
+
+    def __init__(self, t0, coefficients, hours):
+        self.t0 = t0
+        self.coefficients = coefficients
+        self.hours = hours  # (first, last) hours from t0 the fit is good for
+        self.derivatives = {name: polynomial.polyder(c) for name, c in coefficients.items()}
+
+    @classmethod
+    def fit(cls, jd, elements, degree=6):
+        '''
+        :param jd: TT julian dates the elements were sampled at (see geocentric_elements)
+        :param elements: dict of arrays of x, y, z, d, mu and g at each of them
+        :param degree: of the polynomials, lower when there are too few samples for it
+        '''
+        degree = min(degree, len(jd) - 1)
+        t0 = round((jd[0] + jd[-1]) / 2 * 1440) / 1440
+        hours = (jd - t0) * 24
+        coefficients = {name: polynomial.polyfit(hours, elements[name], degree) for name in ELEMENTS}
+        besselian = cls(t0, coefficients, (hours[0], hours[-1]))
+        besselian.residual = max(np.max(np.abs(polynomial.polyval(hours, coefficients[name]) - elements[name]))
+                                 for name in ['x', 'y'])
+        return besselian
+
+    def at(self, t):
+        '''
+        :param t: hours from t0 (array)
+        :return: dict of the elements at t, plus tan_f1, tan_f2, l1 and l2
+        '''
+        values = {name: polynomial.polyval(t, c) for name, c in self.coefficients.items()}
+        sin_f1 = (SUN_RADIUS + K) / values['g']
+        sin_f2 = (SUN_RADIUS - K) / values['g']
+        values['tan_f1'] = sin_f1 / np.sqrt(1 - sin_f1 ** 2)
+        values['tan_f2'] = sin_f2 / np.sqrt(1 - sin_f2 ** 2)
+        values['l1'] = values['z'] * values['tan_f1'] + K / np.sqrt(1 - sin_f1 ** 2)
+        values['l2'] = values['z'] * values['tan_f2'] - K / np.sqrt(1 - sin_f2 ** 2)
+        return values
+
+    def hours_from_jd(self, jd):
+        return (np.asarray(jd, dtype=float) - self.t0) * 24
+
+    def local(self, site, t):
+        '''
+        the site's view at t: everything the contacts, maximum and the circumstances table are worked out from
+        :param site: Site
+        :param t: hours from t0, one per site (or broadcastable against them)
+        '''
+        e = self.at(t)
+        mu_rate = np.radians(polynomial.polyval(t, self.derivatives['mu']))
+        h = np.radians(e['mu'] + site.lon)
+        d = np.radians(e['d'])
+        xi = site.rho_cos * np.sin(h)
+        eta = site.rho_sin * np.cos(d) - site.rho_cos * np.sin(d) * np.cos(h)
+        zeta = site.rho_sin * np.sin(d) + site.rho_cos * np.cos(d) * np.cos(h)
+        local = dict(e, h=h, zeta=zeta, u=e['x'] - xi, v=e['y'] - eta)
+        # hourly rates, d changes too slowly to matter to the iterations
+        local['a'] = polynomial.polyval(t, self.derivatives['x']) - mu_rate * site.rho_cos * np.cos(h)
+        local['b'] = polynomial.polyval(t, self.derivatives['y']) - mu_rate * xi * np.sin(d)
+        local['delta'] = np.hypot(local['u'], local['v'])
+        local['L1'] = e['l1'] - zeta * e['tan_f1']
+        local['L2'] = e['l2'] - zeta * e['tan_f2']
+        return local
+
+    def view(self, site, t):
+        '''
+        :return: separation, moon radius, sun radius (degrees), Moon and Sun distances (km), the Moon and Sun
+                 vectors (fundamental plane axes, Earth radii) from the site and the local values they came from
+        '''
+        local = self.local(site, t)
+        moon = np.stack(np.broadcast_arrays(local['u'], local['v'], local['z'] - local['zeta']), axis=-1)
+        sun = moon + np.stack(np.broadcast_arrays(0, 0, local['g']), axis=-1)
+        moon_dist, sun_dist = np.linalg.norm(moon, axis=-1), np.linalg.norm(sun, axis=-1)
+        # the Sun is straight up the axis from the Moon, so |moon x sun| is just g * delta
+        separation = np.degrees(np.arctan2(local['g'] * local['delta'], np.sum(moon * sun, axis=-1)))
+        moon_r = np.degrees(np.arcsin(K / moon_dist))
+        sun_r = np.degrees(np.arcsin(SUN_RADIUS / sun_dist))
+        return separation, moon_r, sun_r, moon_dist * EARTH_RADIUS_KM, sun_dist * EARTH_RADIUS_KM, moon, sun, local
+
+    def contacts(self, site, iterations=8, tolerance_seconds=0.01):
+        '''
+        contacts, maximum, magnitude and obscuration for every site at once by Newton iteration
+        :param site: Site
+        :return: dict of arrays: TT julian dates for c1, c2, mid, c3, c4 (NaN where there is no such contact),
+                 magnitude and eclipse_fraction at maximum, sun_alt and sun_az at maximum
+        '''
+        tolerance = tolerance_seconds / 3600
+        shape = np.shape(site.lat)
+
+        # closest approach of the site to the shadow axis
+        t = np.zeros(shape)
+        for _ in range(iterations):
+            local = self.local(site, t)
+            step = -(local['u'] * local['a'] + local['v'] * local['b']) / (local['a'] ** 2 + local['b'] ** 2)
+            t = np.clip(t + step, *self.hours)
+            if np.all(np.abs(step) < tolerance):
+                break
+        # then the least separation as seen from the site, a parabola through neighbouring times
+        h = 1 / 60
+        for _ in range(2):
+            before, now, after = (self.view(site, t + dt)[0] for dt in (-h, 0, h))
+            curvature = before - 2 * now + after
+            t = t - np.where(curvature > 0, h * (after - before) / (2 * np.where(curvature > 0, curvature, 1)), 0)
+            h /= 10
+        separation, moon_r, sun_r, _, _, _, sun, local = self.view(site, t)
+        eclipsed = (separation < moon_r + sun_r) & (t > self.hours[0]) & (t < self.hours[1])
+        central = eclipsed & (separation < np.abs(sun_r - moon_r))
+
+        result = {'mid': t}
+        for name, first, limit in [('c1', True, 'L1'), ('c4', False, 'L1'), ('c2', True, 'L2'), ('c3', False, 'L2')]:
+            result[name] = self._contact(site, t, first, limit, iterations, tolerance)
+        for name in ['c1', 'mid', 'c4']:
+            result[name] = np.where(eclipsed, result[name] / 24 + self.t0, np.nan)
+        for name in ['c2', 'c3']:
+            result[name] = np.where(central, result[name] / 24 + self.t0, np.nan)
+        result['magnitude'] = np.where(eclipsed, (local['L1'] - local['delta']) / (local['L1'] + local['L2']), 0)
+        result['eclipse_fraction'] = np.where(eclipsed, eclipse_fraction_array(separation, moon_r, sun_r), 0)
+        result['sun_alt'], result['sun_az'] = site.altaz(sun, local)
+        return result
+
+    def _contact(self, site, t, first, limit, iterations, tolerance):
+        # the site on the penumbral (L1) or umbral (L2) cone, Newton from maximum on the classic closed form
+        sign = -1 if first else 1
+        for _ in range(iterations):
+            local = self.local(site, t)
+            n = np.hypot(local['a'], local['b'])
+            radius = np.abs(local[limit])
+            s = np.clip((local['a'] * local['v'] - local['u'] * local['b']) / (n * radius), -1, 1)
+            step = -(local['u'] * local['a'] + local['v'] * local['b']) / n ** 2 + sign * radius / n * np.sqrt(1 - s ** 2)
+            t = t + step
+            if np.all(np.abs(step) < tolerance):
+                break
+        return t
+
+    def observe(self, site, jd):
+        '''
+        the same columns as skyfieldcalcs.observe for one site at each of the TT julian dates passed
+        :return: CircumstancesTable
+        '''
+        jd = np.asarray(jd, dtype=float)
+        separation, moon_r, sun_r, moon_dist, sun_dist, moon, sun, local = self.view(site, self.hours_from_jd(jd))
+        table = CircumstancesTable(jd)
+        table['separation'] = separation
+        table['moon_alt'], table['moon_az'] = site.altaz(moon, local)
+        table['moon_dist'] = moon_dist
+        table['sun_alt'], table['sun_az'] = site.altaz(sun, local)
+        table['sun_dist'] = sun_dist
+        table['moon_r'] = moon_r
+        table['sun_r'] = sun_r
+        table['eclipse_fraction'] = eclipse_fraction_array(separation, moon_r, sun_r)
+        return table
+
+
+class Site:
+    '''
+    geocentric coordinates of one or more sites (wgs84) in Earth radii: rho sin phi', rho cos phi' and longitude
+    '''
+
+    def __init__(self, lat, lon, ele=100):
+        self.lat, self.lon, self.ele = (np.asarray(v, dtype=float) for v in np.broadcast_arrays(lat, lon, ele))
+        x, y, z = wgs84.latlon(self.lat, self.lon, elevation_m=self.ele).itrs_xyz.km
+        self.rho_cos = np.hypot(x, y) / EARTH_RADIUS_KM
+        self.rho_sin = z / EARTH_RADIUS_KM
+
+    def altaz(self, vector, local):
+        '''
+        :param vector: from the site in fundamental plane axes
+        :param local: BesselianElements.local at the same times, for the hour angle and declination
+        :return: altitude and azimuth (degrees)
+        '''
+        phi, h, d = np.radians(self.lat), local['h'], np.radians(local['d'])
+        zenith = [np.cos(phi) * np.sin(h), np.sin(phi) * np.cos(d) - np.cos(phi) * np.sin(d) * np.cos(h),
+                  np.sin(phi) * np.sin(d) + np.cos(phi) * np.cos(d) * np.cos(h)]
+        north = [-np.sin(phi) * np.sin(h), np.cos(phi) * np.cos(d) + np.sin(phi) * np.sin(d) * np.cos(h),
+                 np.cos(phi) * np.sin(d) - np.sin(phi) * np.cos(d) * np.cos(h)]
+        east = [np.cos(h), np.sin(d) * np.sin(h), -np.cos(d) * np.sin(h)]
+        up, n, e = (sum(vector[..., i] * axis[i] for i in range(3)) for axis in (zenith, north, east))
+        return np.degrees(np.arctan2(up, np.hypot(n, e))), np.degrees(np.arctan2(e, n)) % 360
+
+
+def geocentric_elements(eph, jd):
+    '''
+    unfitted elements at each TT julian date from the geocentric apparent Sun and Moon (true equator and equinox of date),
+    along with their separation (degrees)
+    '''
+    t = timescale().tt_jd(jd)
+    earth = eph['earth'].at(t)
+    moon = earth.observe(eph['moon']).apparent().frame_xyz(true_equator_and_equinox_of_date).km / EARTH_RADIUS_KM
+    sun = earth.observe(eph['sun']).apparent().frame_xyz(true_equator_and_equinox_of_date).km / EARTH_RADIUS_KM
+    axis = sun - moon
+    g = np.linalg.norm(axis, axis=0)
+    a = np.arctan2(axis[1], axis[0])
+    d = np.arcsin(axis[2] / g)
+    x = -np.sin(a) * moon[0] + np.cos(a) * moon[1]
+    y = -np.sin(d) * np.cos(a) * moon[0] - np.sin(d) * np.sin(a) * moon[1] + np.cos(d) * moon[2]
+    z = np.cos(d) * np.cos(a) * moon[0] + np.cos(d) * np.sin(a) * moon[1] + np.sin(d) * moon[2]
+    mu = np.degrees(np.unwrap(np.radians(t.gast * 15) - a))
+    cos = np.sum(moon * sun, axis=0) / np.linalg.norm(moon, axis=0) / np.linalg.norm(sun, axis=0)
+    separation = np.degrees(np.arccos(np.clip(cos, -1, 1)))
+    return {'x': x, 'y': y, 'z': z, 'd': np.degrees(d), 'mu': mu, 'g': g, 'separation': separation}
+
+
+def fit_elements(eph, jd, limit_deg=GEOCENTRIC_LIMIT_DEG):
+    '''
+    elements fitted over the samples (TT julian dates, evenly spaced) where the eclipse can be seen from somewhere
+    :return: BesselianElements, None when the Sun and Moon never get close enough
+    '''
+    elements = geocentric_elements(eph, jd)
+    close = np.flatnonzero(elements['separation'] < limit_deg)
+    if len(close) == 0:
+        return None
+    window = slice(max(close[0] - 2, 0), min(close[-1] + 3, len(jd)))
+    return BesselianElements.fit(jd[window], {name: values[window] for name, values in elements.items()})
+
+
+def besselian_elements(start, eph=None, ephfilename=None):
+    '''
+    elements for the eclipse (if any) around the day of start, fitted over the hours it can be seen from somewhere.
+    fitted once per ephemeris and day, then reused.
+    :param start: skyfield Time, the day of the eclipse
+    :return: BesselianElements, None when there is no solar eclipse that day
+    '''
+    day, hour, minute, month, second, year = get_ints_for_dt_params(start)
+    if eph is None:
+        eph = load_ephemeris(ephfilename)
+    key = (id(eph), year, month, day)
+    if key not in _elements:
+        noon = timescale().utc(year, month, day, 12).tt
+        elements = fit_elements(eph, np.arange(noon - 1, noon + 1, 10 / 1440))
+        _elements[key] = (eph, elements)  # holding eph keeps its id from being reused
+    return _elements[key][1]
+
+
+def local_circumstances(start, lats, lons, eles=100, eph=None, ephfilename=None):
+    '''
+    contacts, maximum, magnitude and obscuration for any number of sites from the Besselian elements
+    :return: dict of arrays as BesselianElements.contacts returns them, all NaN/0 when there is no eclipse that day
+    '''
+    elements = besselian_elements(start, eph=eph, ephfilename=ephfilename)
+    site = Site(lats, lons, eles)
+    if elements is None:
+        result = {name: np.full(np.shape(site.lat), np.nan) for name in ['c1', 'c2', 'mid', 'c3', 'c4', 'sun_alt', 'sun_az']}
+        result.update(magnitude=np.zeros(np.shape(site.lat)), eclipse_fraction=np.zeros(np.shape(site.lat)))
+        return result
+    return elements.contacts(site)
@@ -0,0 +1,163 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from instrument import RunReport
+from runtime import timescale
+from skyfieldcalcs import EPHEMERIS_PATH, CircumstancesTable, circumstances, load_ephemeris
+
+CACHE_VERSION = 1  # bump whenever what circumstances computes changes, old entries are then never read
+CACHE_PATH = os.path.join(EPHEMERIS_PATH, 'solar_eclipse_animation')  # alongside the ephemeris files
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CONTACTS = ['c1', 'c2', 'mid', 'c3', 'c4']
+
+
+class CircumstancesCache:
+    '''
+    persistent cache of circumstances results (the columnar table plus the 5 contact points) in numpy .npz files,
+    one file per eclipse/site/ephemeris.
+
+    safe to share between processes: entries are written to a temporary file and renamed into place, readers
+    treat a missing or unreadable entry as a miss, and eviction is serialized with a lock file.  eviction is least
+    recently used, a hit touches the entry's mtime, once the total size passes max_bytes the oldest go first.
+    '''
+
+    def __init__(self, dirname=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        os.makedirs(dirname, exist_ok=True)
+
+    @staticmethod
+    def key(year, month, day, lat, lon, ele, ephfilename, **options):
+        '''
+        versioned key for an eclipse (date), site (lat, lon, elevation) and ephemeris, along with any other
+        options passed to circumstances
+        '''
+        fields = {'version': CACHE_VERSION, 'date': f"{int(year):04d}{int(month):02d}{int(day):02d}",
+                  'lat': round(float(lat), 6), 'lon': round(float(lon), 6), 'ele': round(float(ele), 1),
+                  'eph': ephfilename}
+        fields.update(options)
+        digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+        return f"v{CACHE_VERSION}-{digest[:32]}"
+
+    def path(self, key):
+        return os.path.join(self.dirname, f"{key}.npz")
+
+    def get(self, key):
+        '''
+        :return: c1, c2, mid, c3, c4, table as circumstances(columnar=True) returns them, or None
+        '''
+        filename = self.path(key)
+        try:
+            with np.load(filename) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            # truncated or from an incompatible numpy, drop it and recompute
+            self._remove(filename)
+            return None
+        return _unpack(arrays)
+
+    def put(self, key, result):
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **_pack(result))
+            os.replace(tmpname, self.path(key))
+        except BaseException:
+            self._remove(tmpname)
+            raise
+        self.evict()
+
+    def evict(self):
+        with open(os.path.join(self.dirname, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for entry in os.scandir(self.dirname):
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(filename)
+                total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.dirname):
+            if entry.name.endswith(('.npz', '.tmp')):
+                self._remove(entry.path)
+
+    @property
+    def nbytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.dirname) if entry.name.endswith('.npz'))
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.unlink(filename)
+        except FileNotFoundError:
+            pass
+
+
+def cached_circumstances(year, month, day, lat, lon, ele=100, ephfilename='de430t.bsp', cache=None, refine=False,
+                         backend='skyfield', report=None):
+    '''
+    circumstances for the eclipse on year-month-day from lat/lon, read from the cache when it has them.
+    on a hit the ephemeris is never opened.
+    :param cache: CircumstancesCache, None to always compute
+    :param backend: skyfield, besselian, astronomy or ephem, see circumstances
+    :param report: optional instrument.RunReport, times the cache, ephemeris and circumstances stages and counts
+                   cache hits and misses
+    :return: c1, c2, mid, c3, c4, CircumstancesTable
+    '''
+    report = RunReport() if report is None else report
+    key = None
+    if cache is not None:
+        key = cache.key(year, month, day, lat, lon, ele, ephfilename, refine=refine, backend=backend)
+        with report.stage('cache'):
+            result = cache.get(key)
+        report.count('circumstances_cache_hits' if result is not None else 'circumstances_cache_misses')
+        if result is not None:
+            return result
+    date = timescale().utc(year, month, day)
+    eph = None
+    if backend in ['skyfield', 'besselian']:
+        # shared handle on just the Sun/Earth/Moon segments for the days around the eclipse
+        with report.stage('ephemeris'):
+            eph = load_ephemeris(ephfilename, start=date.tt - 2, end=date.tt + 2)
+    with report.stage('circumstances'):
+        result = circumstances(date, lat, lon, ele=ele, eph=eph, refine=refine, columnar=True, backend=backend)
+    if cache is not None:
+        with report.stage('cache'):
+            cache.put(key, result)
+    return result
+
+
+def _pack(result):
+    *contacts, table = result
+    arrays = {f"table_{name}": table[name] for name in table.columns}
+    present = [row is not None for row in contacts]
+    arrays['contacts_present'] = np.array(present)
+    for name in table.columns:
+        arrays[f"contacts_{name}"] = np.array([np.nan if row is None else row[name] for row in contacts])
+    return arrays
+
+
+def _unpack(arrays):
+    table = CircumstancesTable(arrays['table_jd'], {name[6:]: values for name, values in arrays.items()
+                                                     if name.startswith('table_') and name != 'table_jd'})
+    rows = CircumstancesTable(arrays['contacts_jd'], {name[9:]: values for name, values in arrays.items()
+                                                       if name.startswith('contacts_') and name not in ['contacts_jd', 'contacts_present']})
+    contacts = [rows.row(n) if present else None for n, present in enumerate(arrays['contacts_present'])]
+    return (*contacts, table)
@@ -0,0 +1,298 @@
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+# what each output is scaled to, width None keeps the frames' own and fps None the animation's, see output_args
+OUTPUTS = {'mp4': dict(extension='.mp4', width=None, fps=None),
+           'webm': dict(extension='.webm', width=1280, fps=None),
+           'gif': dict(extension='.gif', width=480, fps=10),
+           'strip': dict(extension='_strip.png', width=320, fps=None, count=10)}
+
+
+class FFmpegError(RuntimeError):
+    pass
+
+
+def write_concat_list(filename, timeline, fps=25):
+    '''
+    writes an ffmpeg concat demuxer script showing each image for a number of frame-times, so a pause is
+    one line in the script rather than copies of the image
+    :param filename: where to write the script
+    :param timeline: list of (image path, frame-times to show it), relative paths are relative to the script
+    :param fps: frame rate of the animation
+    '''
+    with open(filename, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for path, count in timeline:
+            f.write(f"file '{_quote(path)}'\nduration {count / fps:.6f}\n")
+        if timeline:
+            # the demuxer ignores the duration of the last entry unless another file follows it
+            f.write(f"file '{_quote(timeline[-1][0])}'\n")
+
+
+def parse_output(spec):
+    '''
+    an output as the command line gives it: a format from OUTPUTS, optionally with the width it is scaled down to
+    and its frame rate, e.g. mp4, gif:640, webm:1280@25 or gif:@12.  a strip is a still, it has no frame rate
+    :return: format, dict of its settings
+    '''
+    name, _, scale = spec.partition(':')
+    if name not in OUTPUTS:
+        raise ValueError(f"unsupported output {name}, expected one of {', '.join(OUTPUTS)}")
+    settings = dict(OUTPUTS[name])
+    width, _, fps = scale.partition('@')
+    try:
+        if width:
+            settings['width'] = int(width)
+        if fps:
+            settings['fps'] = float(fps)
+    except ValueError:
+        raise ValueError(f"output {spec} should be format[:width][@fps]") from None
+    if name == 'strip' and fps:
+        # its frames are picked by their number as they're written, a frame rate would renumber them
+        raise ValueError(f"output {spec} should be strip[:width], a strip has no frame rate")
+    return name, settings
+
+
+def output_stem(filename):
+    '''
+    an output's path without its format's ending, what the run's plan and report beside it are named from
+    '''
+    for settings in OUTPUTS.values():
+        if filename.endswith(settings['extension']):
+            return filename[:-len(settings['extension'])]
+    return os.path.splitext(filename)[0]
+
+
+def output_args(name, settings, preset='medium', picks=None):
+    '''
+    ffmpeg's arguments for an output of the raw frames FFmpegWriter pipes in
+    :param name: mp4, webm, gif or strip
+    :param settings: from parse_output
+    :param preset: x264 preset for mp4
+    :param picks: numbers of the frames (counting from 0 as they're written) the strip is made of, without them
+                  it's the first of them
+    '''
+    filters = []
+    if settings.get('fps'):
+        filters.append(f"fps={settings['fps']:g}")
+    if name == 'strip' and picks:
+        chosen = '+'.join(f'eq(n\\,{n})' for n in picks)
+        filters.append(f"select='{chosen}'")
+    if settings.get('width'):
+        # never scaled up, and an even height for yuv420p
+        filters.append(f"scale='min(iw,{settings['width']})':-2:flags=lanczos")
+    if name == 'mp4':
+        codec = ['-c:v', 'libx264', '-preset', preset, '-pix_fmt', 'yuv420p']
+    elif name == 'webm':
+        codec = ['-c:v', 'libvpx-vp9', '-crf', '36', '-b:v', '0', '-deadline', 'realtime', '-cpu-used', '8',
+                 '-row-mt', '1', '-pix_fmt', 'yuv420p']
+    elif name == 'gif':
+        # the palette from every frame in the same pass, ffmpeg holds the (scaled) frames until it's made
+        filters.append('split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse=dither=bayer')
+        codec = []
+    elif name == 'strip':
+        # one tile of at most count frames, written when the input ends (stopping early would break the pipe)
+        filters.append(f"tile={settings['count']}x1")
+        codec = ['-fps_mode', 'passthrough', '-update', '1']
+    else:
+        raise ValueError(f"unsupported output {name}")
+    return (('-vf', ','.join(filters)) if filters else ()) + tuple(codec)
+
+
+def packed_rgb(frame, size):
+    '''
+    :param frame: PIL image (converted to RGB if it isn't), a (height, width, 3) uint8 array or bytes of packed
+                  RGB pixels
+    :param size: (width, height) the frame has to be
+    :return: the packed RGB pixels, a memoryview of an array rather than a copy
+    '''
+    if hasattr(frame, '__array_interface__') and not hasattr(frame, 'mode'):
+        if frame.shape != (size[1], size[0], 3):
+            raise ValueError(f"frame is {frame.shape[1]}x{frame.shape[0]}, expected {size[0]}x{size[1]}")
+        return memoryview(frame).cast('B')  # no copy, the array has to be C contiguous
+    if not isinstance(frame, (bytes, bytearray, memoryview)):
+        if frame.size != tuple(size):
+            raise ValueError(f"frame is {frame.size[0]}x{frame.size[1]}, expected {size[0]}x{size[1]}")
+        return (frame if frame.mode == 'RGB' else frame.convert('RGB')).tobytes()
+    if len(frame) != size[0] * size[1] * 3:
+        raise ValueError(f"frame is {len(frame)} bytes, expected {size[0] * size[1] * 3}")
+    return frame
+
+
+def _quote(path):
+    return str(path).replace("'", "'\\''")
+
+
+class FFmpegWriter:
+    '''
+    streams raw RGB frames into an ffmpeg process through its stdin rather than writing them to disk first.
+    writes block while ffmpeg's pipe is full, so a producer can never get more than a pipe buffer ahead of the
+    encoder.  ffmpeg's messages go to a temporary file and the tail of them is raised as an FFmpegError if it
+    exits early or unsuccessfully.
+
+        with FFmpegWriter('out.mp4', (3840, 2160)) as writer:
+            for image in images:
+                writer.write(image)
+    '''
+
+    def __init__(self, filename, size, fps=25, output_args=('-c:v', 'libx264', '-pix_fmt', 'yuv420p'),
+                 ffmpeg='ffmpeg'):
+        self.filename = filename
+        self.size = tuple(size)
+        self.frame_bytes = self.size[0] * self.size[1] * 3
+        self.frames = 0
+        self.wait_seconds = 0.0  # time write() spent blocked on ffmpeg's pipe
+        self.cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{self.size[0]}x{self.size[1]}', '-r', str(fps),
+                    '-i', '-', *output_args, filename]
+        self._log = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                            stderr=self._log)
+        except OSError as e:
+            self._log.close()
+            raise FFmpegError(f"could not start {ffmpeg}: {e}") from e
+
+    def write(self, frame):
+        '''
+        :param frame: PIL image (converted to RGB if it isn't), a (height, width, 3) uint8 array or bytes of packed
+                      RGB pixels
+        '''
+        frame = packed_rgb(frame, self.size)
+        started = time.perf_counter()
+        try:
+            self.process.stdin.write(frame)
+        except (BrokenPipeError, ValueError):
+            self._fail(f"ffmpeg stopped reading after {self.frames} frames")
+        self.wait_seconds += time.perf_counter() - started
+        self.frames += 1
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            self._fail(f"ffmpeg exited with status {returncode} after {self.frames} frames")
+        self._log.close()
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self._log.close()
+
+    def _fail(self, message):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self._log.seek(0)
+        tail = self._log.read()[-2000:].decode(errors='replace').strip()
+        self._log.close()
+        raise FFmpegError(f"{message} writing {self.filename}\n{' '.join(self.cmd)}\n{tail}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class FanOutWriter:
+    '''
+    one stream of frames into several writers at once (an FFmpegWriter per output), so a frame is rendered once
+    however many formats it's encoded to.  each writer is fed by its own thread from a queue of at most buffer
+    frames, the encoders run side by side and closing waits for the slowest of them rather than all of them in
+    turn.  a write blocks while any queue is full, the producer is never more than buffer frames ahead of the
+    slowest encoder.  the first error of any of the writers is raised from write or close.
+
+        writers = [FFmpegWriter('a.mp4', size), FFmpegWriter('a.gif', size, output_args=output_args('gif', ...))]
+        with FanOutWriter(writers) as writer:
+            for image in images:
+                writer.write(image)
+    '''
+    _DONE = object()
+
+    def __init__(self, writers, buffer=8):
+        self.writers = list(writers)
+        self.size = self.writers[0].size
+        self.frame_bytes = self.writers[0].frame_bytes
+        self.filename = ', '.join(writer.filename for writer in self.writers)
+        self.frames = 0
+        self.wait_seconds = 0.0  # time write() spent blocked on a full queue
+        self._errors = []
+        self._queues = [queue.Queue(maxsize=buffer) for _ in self.writers]
+        self._threads = [threading.Thread(target=self._feed, args=(writer, q), name=f'encode-{n}', daemon=True)
+                         for n, (writer, q) in enumerate(zip(self.writers, self._queues))]
+        for thread in self._threads:
+            thread.start()
+
+    def write(self, frame):
+        '''
+        :param frame: as FFmpegWriter.write takes, copied once unless it's already bytes, a renderer's frame buffer
+                      is drawn over by the next frame while this one is still queued
+        '''
+        if self._errors:
+            raise self._errors[0]
+        pixels = packed_rgb(frame, self.size)
+        if not isinstance(pixels, bytes):
+            pixels = bytes(pixels)
+        started = time.perf_counter()
+        for q in self._queues:
+            q.put(pixels)
+        self.wait_seconds += time.perf_counter() - started
+        self.frames += 1
+
+    def close(self):
+        self._stop()
+        if self._errors:
+            raise self._errors[0]
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+        self._stop()
+
+    def _stop(self):
+        if self._threads:
+            for q in self._queues:
+                q.put(self._DONE)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _feed(self, writer, q):
+        frame = None
+        try:
+            while True:
+                frame = q.get()
+                if frame is self._DONE:
+                    break
+                writer.write(frame)
+            writer.close()
+        except Exception as e:
+            self._errors.append(e)
+            # the rest are taken and dropped so write never waits on a writer that's gone
+            while frame is not self._DONE:
+                frame = q.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
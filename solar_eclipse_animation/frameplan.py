@@ -0,0 +1,138 @@
+import json
+from datetime import datetime, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from runtime import timescale
+
+# how many extra frame-times the animation holds on each contact point and on maximum eclipse, at FPS
+HOLD_FRAMES = {'c1': 100, 'c2': 100, 'mid': 150, 'c3': 100, 'c4': 100}
+FPS = 25
+EVENTS = {'c1': 'start of partial eclipse', 'c2': 'start of annular eclipse', 'mid': 'maximum eclipse',
+          'c3': 'end of annular eclipse', 'c4': 'end of partial eclipse'}
+# what each frame is rendered from, the rest of the columns are there to inspect
+RENDER_COLUMNS = ['label_ll', 'label_lr', 'iso', 'sun_radius', 'moon_radius', 'moon_alt_delta_deg', 'moon_az_delta_deg',
+                  'hold']
+COLUMNS = ['jd', 'utc_iso', 'local_iso', 'event', 'eclipse_fraction'] + RENDER_COLUMNS
+
+
+class FramePlan:
+    '''
+    everything about every frame of an animation, one column per field rather than a dict per frame: the time
+    (TT julian date, UTC and local), which contact it is, the obscuration, the labels, the Sun and Moon sizes and
+    offsets and how long it's held.  iterating over it gives the dicts render_frames takes.
+
+        plan = frame_plan(table, contacts, 'America/New_York', title='Raleigh, NC')
+        render_frames(plan, ...)
+        plan.save('plan.json'); FramePlan.load('plan.json')
+    '''
+
+    def __init__(self, columns, title='unknown', basedir='.'):
+        self.columns = {name: list(columns[name]) for name in COLUMNS}
+        self.title = title
+        self.basedir = basedir
+
+    def __len__(self):
+        return len(self.columns['jd'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        for n in range(len(self)):
+            frame = {name: self.columns[name][n] for name in RENDER_COLUMNS}
+            frame.update(title=self.title, frame=True, basedir=self.basedir)
+            yield frame
+
+    def to_frame(self):
+        '''
+        a pandas dataframe of the plan, one row per frame
+        '''
+        import pandas as pd
+        return pd.DataFrame(self.columns, columns=COLUMNS)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'title': self.title, 'basedir': self.basedir, 'columns': self.columns}, f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            saved = json.load(f)
+        return cls(saved['columns'], title=saved['title'], basedir=saved['basedir'])
+
+
+def frame_plan(table, contacts, timezone, title='unknown', basedir='.', labels=True, hold_scale=1, milliseconds=False):
+    '''
+    the frame plan for a run in one pass over the columns, the timezone's offsets are looked up once per hour
+    of the eclipse rather than once per frame
+    :param table: CircumstancesTable with a row per frame, in order (the eclipsed minutes or a timeline's)
+    :param contacts: dict of c1, c2, mid, c3, c4 TT julian dates (None when there isn't one), a frame is a contact
+                     when its jd is exactly the contact's
+    :param timezone: IANA name for the local time labels and frame names
+    :param labels: the local time in the lower left and the event and obscuration in the lower right
+    :param hold_scale: how many frames the animation has per frame at FPS, so holds last the same time
+    :param milliseconds: frame names (iso) to the millisecond, for frames less than a second apart
+    :return: FramePlan
+    '''
+    jd = np.asarray(table.jd, dtype=float)
+    unit = 'ms' if milliseconds else 's'
+    utc = utc_datetime64(jd, unit=unit)
+    offset, abbreviation = _offsets(utc, ZoneInfo(timezone))
+    local = utc + offset
+    local_iso = np.datetime_as_string(local, unit=unit)
+    iso = np.char.replace(np.char.replace(np.char.replace(local_iso, '-', ''), ':', ''), '.', '')
+
+    event = np.full(len(jd), '', dtype=object)
+    for name in EVENTS:
+        if contacts.get(name) is not None:
+            event[(jd == contacts[name]) & (event == '')] = name
+    fraction = np.asarray(table.eclipse_fraction, dtype=float)
+    hold = [round(HOLD_FRAMES.get(e, 0) * hold_scale) for e in event]
+    if labels:
+        minutes = (local.astype('datetime64[m]') - local.astype('datetime64[D]')).astype(int)
+        hour, minute = np.divmod(minutes, 60)
+        label_ll = [f"{(h - 1) % 12 + 1}:{m:02d} {'AM' if h < 12 else 'PM'} {a}"
+                    for h, m, a in zip(hour.tolist(), minute.tolist(), abbreviation)]
+        label_lr = [f"{EVENTS.get(e, '')} {f * 100:.1f}%" for e, f in zip(event, fraction.tolist())]
+    else:
+        label_ll = label_lr = [None] * len(jd)
+    columns = dict(jd=jd.tolist(), utc_iso=list(np.datetime_as_string(utc, unit=unit)), local_iso=list(local_iso),
+                   event=list(event), eclipse_fraction=fraction.tolist(), label_ll=label_ll, label_lr=label_lr,
+                   iso=list(iso), sun_radius=np.asarray(table.sun_r, dtype=float).tolist(),
+                   moon_radius=np.asarray(table.moon_r, dtype=float).tolist(),
+                   moon_alt_delta_deg=(np.asarray(table.sun_alt, dtype=float) -
+                                       np.asarray(table.moon_alt, dtype=float)).tolist(),
+                   moon_az_delta_deg=(np.asarray(table.moon_az, dtype=float) -
+                                      np.asarray(table.sun_az, dtype=float)).tolist(),
+                   hold=hold)
+    return FramePlan(columns, title=title, basedir=basedir)
+
+
+def utc_datetime64(jd, unit='ms'):
+    '''
+    :param jd: TT julian dates
+    :param unit: s or ms, rounded to the nearest, as skyfield's utc_iso does
+    :return: UTC as numpy datetime64, leap seconds as skyfield has them
+    '''
+    year, month, day, hour, minute, second = timescale().tt_jd(np.asarray(jd, dtype=float)).utc
+    months = (np.asarray(year, dtype=int) - 1970) * 12 + np.asarray(month, dtype=int) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (np.asarray(day, dtype=int) - 1)
+    ms = np.rint(((np.asarray(hour) * 60 + np.asarray(minute)) * 60 + np.asarray(second)) * 1000).astype(np.int64)
+    if unit == 's':
+        ms = (ms + 500) // 1000 * 1000
+    return (days.astype('datetime64[ms]') + ms.astype('timedelta64[ms]')).astype(f'datetime64[{unit}]')
+
+
+def _offsets(utc, zone):
+    # the zone's UTC offset and abbreviation for each time, looked up once for each hour in the run
+    hours = utc.astype('datetime64[h]')
+    offset = np.empty(len(utc), dtype='timedelta64[ms]')
+    abbreviation = np.empty(len(utc), dtype=object)
+    for hour in np.unique(hours):
+        local = datetime.fromtimestamp(int(hour.astype('datetime64[s]').astype(np.int64)), dt_timezone.utc).astimezone(zone)
+        inside = hours == hour
+        offset[inside] = np.timedelta64(int(local.utcoffset().total_seconds() * 1000), 'ms')
+        abbreviation[inside] = local.strftime('%Z')
+    return offset, list(abbreviation)
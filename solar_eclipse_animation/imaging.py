@@ -1,12 +1,57 @@
+from collections import OrderedDict
 from pathlib import Path
-import shutil
+import hashlib
 import os
+import tempfile
+import threading
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 
 # https://note.nkmk.me/en/python-pillow-paste/
 
+ASSETS = ['bluesky_4k.png', 'sun.png', 'newmoon.png']
+# render tiers: how far the assets (and with them the frame, font and label positions) are scaled down, and how
+# hard x264 works on the result
+QUALITY = {'draft': dict(scale=0.25, preset='ultrafast'),
+           'preview': dict(scale=0.5, preset='veryfast'),
+           'final': dict(scale=1, preset='medium')}
+# alongside the circumstances cache (cache.CACHE_PATH)
+PYRAMID_PATH = os.path.join(os.environ.get('SOLAR_ECLIPSE_DATA', '/var/data'), 'solar_eclipse_animation', 'assets')
+
+
+def asset_pyramid(imagedir='./images', quality='final', dirname=PYRAMID_PATH):
+    '''
+    the background, Sun and Moon images scaled down for a render tier, built once and kept under dirname in a
+    directory named for the size and modification time of the originals, so editing one builds a new set
+    :param quality: draft, preview or final (the originals themselves)
+    :return: image directory to render from
+    '''
+    if quality not in QUALITY:
+        raise ValueError(f"unsupported quality {quality}")
+    scale = QUALITY[quality]['scale']
+    if scale == 1:
+        return imagedir
+    key = hashlib.sha256()
+    for name in ASSETS:
+        stat = os.stat(os.path.join(imagedir, name))
+        key.update(f"{os.path.abspath(os.path.join(imagedir, name))} {stat.st_size} {stat.st_mtime_ns}".encode())
+    pyramid = os.path.join(dirname, f"{key.hexdigest()[:16]}_{quality}")
+    if all(os.path.isfile(os.path.join(pyramid, name)) for name in ASSETS):
+        return pyramid
+    Path(pyramid).mkdir(parents=True, exist_ok=True)
+    for name in ASSETS:
+        img = Image.open(os.path.join(imagedir, name))
+        # even dimensions, which yuv420p needs for the frame and keeps the Sun and Moon centered
+        size = tuple(max(2, 2 * round(n * scale / 2)) for n in img.size)
+        fd, tmpname = tempfile.mkstemp(dir=pyramid, suffix='.png')
+        with os.fdopen(fd, 'wb') as f:
+            img.resize(size, Image.LANCZOS).save(f, format='PNG')
+        os.replace(tmpname, os.path.join(pyramid, name))
+    return pyramid
+
+
 def makemask(pixels=1000):
     mask_im = Image.new("L", (pixels, pixels), 0)
     draw = ImageDraw.Draw(mask_im)
@@ -14,66 +59,343 @@ def makemask(pixels=1000):
     return mask_im
 
 
+class Renderer:
+    '''
+    decodes the background, Sun and Moon images, builds their masks and loads the font once, then renders
+    as many frames as needed from them.  Moon sprites are resized per Moon/Sun ratio, quantized to the whole
+    pixel size the sprite ends up at, and kept in a small least recently used cache (sprite_cache_size entries).
+    '''
+
+    def __init__(self, imagedir='./images', fontfile=None, fontsize=100, sprite_cache_size=8):
+        self.imagedir = imagedir
+        self.fontsize = fontsize
+        self.sprite_cache_size = sprite_cache_size
+        background, self.size, self.center, _ = prep_image(f'{imagedir}/bluesky_4k.png', None, 1, make_mask=False)
+        self.sun, self.sun_size, self.sun_center, sun_mask = prep_image(f'{imagedir}/sun.png', None, 1)
+        self.moon = Image.open(f'{imagedir}/newmoon.png')
+        self.moon.load()
+        self.font = None if fontfile is None else ImageFont.truetype(fontfile, fontsize)
+
+        # the Sun never moves, so every frame starts from the sky with the Sun already on it
+        background.load()
+        background.paste(self.sun, (self.center[0] - self.sun_center[0], self.center[1] - self.sun_center[1]), sun_mask)
+        self.background = background
+        self._sprites = OrderedDict()
+        self._lock = threading.Lock()
+
+    def moon_sprite(self, ratio):
+        '''
+        the Moon image (and its mask) sized ratio times the Sun image
+        :return: image, size, center, mask
+        '''
+        new_size = (int(self.sun_size[0] * ratio), int(self.sun_size[1] * ratio))
+        with self._lock:
+            sprite = self._sprites.get(new_size)
+            if sprite is not None:
+                self._sprites.move_to_end(new_size)
+                return sprite
+        img = self.moon.resize(new_size)
+        sprite = img, new_size, (int(new_size[0] / 2), int(new_size[1] / 2)), makemask(pixels=new_size[0])
+        with self._lock:
+            self._sprites[new_size] = sprite
+            while len(self._sprites) > self.sprite_cache_size:
+                self._sprites.popitem(last=False)
+        return sprite
+
+    def render(self, sun_radius, moon_radius, moon_alt_delta_deg=0, moon_az_delta_deg=0, label_ll=None, label_lr=None):
+        '''
+        a single frame
+        :return: PIL image
+        '''
+        ratio = moon_radius / sun_radius
+        moon_az_delta_deg *= .725  # rough adjustment for 2D representation
+        imb = self.background.copy()
+        imm, imm_size, moon_center, imm_mask = self.moon_sprite(ratio)
+
+        # start with the Moon centered over the Sun
+        centered_moon_x = self.center[0] - moon_center[0]
+        centered_moon_y = self.center[1] - moon_center[1]
+
+        # move the Moon's position based on the difference in altitude and azimum to the Sun, converted from degrees to pixels
+        pixels_per_degree = round(self.sun_size[0] / (sun_radius * 2))
+        new_moon_x = round(centered_moon_x + (moon_az_delta_deg * pixels_per_degree))
+        new_moon_y = round(centered_moon_y + (moon_alt_delta_deg * pixels_per_degree))
+        imb.paste(imm, (new_moon_x, new_moon_y), imm_mask)
+
+        border = self.fontsize * 1.3
+        I1 = ImageDraw.Draw(imb)
+        if label_ll is not None:
+            I1.text((border, self.size[1] - border), label_ll, font=self.font, fill=(0, 0, 0), anchor='ls')
+        if label_lr is not None:
+            I1.text((self.size[0] - border, self.size[1] - border), f"{label_lr}", font=self.font, fill=(0, 0, 0),
+                    anchor='rs')
+        return imb
+
+    def render_pixels(self, sun_radius, moon_radius, moon_alt_delta_deg=0, moon_az_delta_deg=0, label_ll=None,
+                      label_lr=None):
+        '''
+        a single frame as packed RGB bytes, what FFmpegWriter takes
+        '''
+        imb = self.render(sun_radius, moon_radius, moon_alt_delta_deg=moon_alt_delta_deg,
+                          moon_az_delta_deg=moon_az_delta_deg, label_ll=label_ll, label_lr=label_lr)
+        return (imb if imb.mode == 'RGB' else imb.convert('RGB')).tobytes()
+
+
+class DiskRenderer:
+    '''
+    draws into one preallocated NumPy frame rather than pasting PIL images.  the Sun is blended onto the sky once
+    with an anti-aliased disk, each frame then only touches the pixels where the Moon's disk meets the Sun's (and
+    the labels): the Moon's edge is anti-aliased from its exact distance to each pixel center, so its position
+    and size are sub-pixel, nothing is rounded to whole pixels.  the Moon is only drawn where it covers the Sun,
+    against a daytime sky a new Moon can't be seen anywhere else.  its texture is the Moon image sized to the
+    nearest whole pixel and cached like Renderer's sprites.
+
+    render_pixels returns the frame buffer itself, which is overwritten by the next frame.
+    '''
+
+    def __init__(self, imagedir='./images', fontfile=None, fontsize=100, sprite_cache_size=8):
+        self.imagedir = imagedir
+        self.fontsize = fontsize
+        self.sprite_cache_size = sprite_cache_size
+        sky = Image.open(f'{imagedir}/bluesky_4k.png').convert('RGB')
+        sun = Image.open(f'{imagedir}/sun.png').convert('RGB')
+        self.size = sky.size
+        self.center = (int(self.size[0] / 2), int(self.size[1] / 2))
+        self.sun_size = sun.size
+        self.font = None if fontfile is None else ImageFont.truetype(fontfile, fontsize)
+        moon = Image.open(f'{imagedir}/newmoon.png')
+        moon.load()
+        self.moon = moon.convert('RGB')
+        # the Moon's color past the edge of its image, so anti-aliased edge pixels blend toward it rather than black
+        self.moon_edge = np.asarray(moon, dtype=np.float32)[..., :3][np.asarray(moon)[..., 3] > 0].mean(axis=0)
+
+        # the Sun's box in the frame, clipped to it, and the Sun's coverage of each of its pixels
+        left, top = self.center[0] - int(self.sun_size[0] / 2), self.center[1] - int(self.sun_size[1] / 2)
+        self.sun_box = (max(top, 0), min(top + self.sun_size[1], self.size[1]),
+                        max(left, 0), min(left + self.sun_size[0], self.size[0]))
+        y0, y1, x0, x1 = self.sun_box
+        self.sun_pixels = np.asarray(sun, dtype=np.float32)[y0 - top:y1 - top, x0 - left:x1 - left]
+        self.sun_cover = disk_coverage(y0, y1, x0, x1, self.center, self.sun_size[0] / 2)
+        self.sun_spans = disk_spans(y0, y1, self.center, self.sun_size[0] / 2)
+        background = np.array(sky, dtype=np.uint8)
+        sky_box = background[y0:y1, x0:x1].astype(np.float32)
+        self.sun_background = sky_box + self.sun_cover[..., None] * (self.sun_pixels - sky_box)
+        background[y0:y1, x0:x1] = np.rint(self.sun_background)
+        self.background = background
+        self.frame = background.copy()
+        self._scratch = Image.new('L', (1, 1))
+        self._dirty = []
+        self._sprites = OrderedDict()
+        self._lock = threading.Lock()
+
+    def moon_sprite(self, diameter):
+        '''
+        the Moon image diameter pixels across (uint8 RGB), in the middle of a border of its edge color three pixels
+        wide, so any box around the Moon's disk falls inside it
+        '''
+        with self._lock:
+            sprite = self._sprites.get(diameter)
+            if sprite is not None:
+                self._sprites.move_to_end(diameter)
+                return sprite
+        sprite = np.empty((diameter + 6, diameter + 6, 3), dtype=np.uint8)
+        sprite[:] = np.rint(self.moon_edge)
+        sprite[3:-3, 3:-3] = np.asarray(self.moon.resize((diameter, diameter)))
+        with self._lock:
+            self._sprites[diameter] = sprite
+            while len(self._sprites) > self.sprite_cache_size:
+                self._sprites.popitem(last=False)
+        return sprite
+
+    def render_pixels(self, sun_radius, moon_radius, moon_alt_delta_deg=0, moon_az_delta_deg=0, label_ll=None,
+                      label_lr=None):
+        '''
+        a single frame
+        :return: the frame buffer, a (height, width, 3) uint8 array
+        '''
+        frame = self.frame
+        for y0, y1, x0, x1 in self._dirty:
+            frame[y0:y1, x0:x1] = self.background[y0:y1, x0:x1]
+        self._dirty = []
+
+        pixels_per_degree = self.sun_size[0] / (sun_radius * 2)
+        radius = moon_radius * pixels_per_degree
+        cx = self.center[0] + moon_az_delta_deg * .725 * pixels_per_degree  # rough adjustment for 2D representation
+        cy = self.center[1] + moon_alt_delta_deg * pixels_per_degree
+        sy0, sy1, sx0, sx1 = self.sun_box
+        y0, y1 = max(sy0, int(np.floor(cy - radius - 1))), min(sy1, int(np.ceil(cy + radius + 1)))
+        x0, x1 = max(sx0, int(np.floor(cx - radius - 1))), min(sx1, int(np.ceil(cx + radius + 1)))
+        if y0 < y1 and x0 < x1:
+            sprite = self.moon_sprite(max(1, round(2 * radius)))
+            top, left = round(cy - sprite.shape[0] / 2), round(cx - sprite.shape[1] / 2)
+            # each row's columns the Moon touches at all and those it and the Sun both cover completely
+            rows = np.arange(y0, y1)
+            lo, hi, inner_lo, inner_hi = disk_spans(y0, y1, (cx, cy), radius)
+            sun_lo, sun_hi, sun_inner_lo, sun_inner_hi = (span[y0 - sy0:y1 - sy0] for span in self.sun_spans)
+            lo, hi = np.maximum(np.maximum(lo, sun_lo), x0), np.minimum(np.minimum(hi, sun_hi), x1)
+            inner_lo = np.maximum(np.maximum(inner_lo, sun_inner_lo), x0)
+            inner_hi = np.minimum(np.minimum(inner_hi, sun_inner_hi), x1)  # a Sun wider than the frame is cut off
+            inner = inner_lo < inner_hi
+            for y, a, b in zip(rows[inner].tolist(), inner_lo[inner].tolist(), inner_hi[inner].tolist()):
+                frame[y, a:b] = sprite[y - top, a - left:b - left]
+
+            # everything else the Moon touches is blended by how much of the pixel it and the Sun cover
+            starts = np.concatenate([lo, np.where(inner, inner_hi, hi)])
+            ends = np.concatenate([np.where(inner, inner_lo, hi), hi])
+            lengths = np.maximum(ends - starts, 0)
+            y = np.repeat(np.concatenate([rows, rows]), lengths)
+            x = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            distance = np.hypot(x + 0.5 - cx, y + 0.5 - cy)
+            cover = np.clip(radius + 0.5 - distance, 0, 1).astype(np.float32) * self.sun_cover[y - sy0, x - sx0]
+            sun = self.sun_pixels[y - sy0, x - sx0]
+            edge = self.sun_background[y - sy0, x - sx0] + cover[:, None] * (sprite[y - top, x - left] - sun)
+            frame[y, x] = np.rint(edge)
+            self._dirty.append((y0, y1, x0, x1))
+
+        border = self.fontsize * 1.3
+        if label_ll is not None:
+            self._label((border, self.size[1] - border), label_ll, 'ls')
+        if label_lr is not None:
+            self._label((self.size[0] - border, self.size[1] - border), f"{label_lr}", 'rs')
+        return frame
+
+    def _label(self, xy, text, anchor):
+        # black text drawn as a coverage mask the size of the text, only those pixels are touched
+        left, top, right, bottom = ImageDraw.Draw(self._scratch).textbbox(xy, text, font=self.font, anchor=anchor)
+        left, top = max(0, int(left)), max(0, int(top))
+        right, bottom = min(self.size[0], int(np.ceil(right))), min(self.size[1], int(np.ceil(bottom)))
+        if left >= right or top >= bottom:
+            return
+        mask = Image.new('L', (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((xy[0] - left, xy[1] - top), text, font=self.font, fill=255, anchor=anchor)
+        box = self.frame[top:bottom, left:right]
+        box[:] = np.rint(box * (1 - np.asarray(mask, dtype=np.float32)[..., None] / 255))
+        self._dirty.append((top, bottom, left, right))
+
+    def render(self, sun_radius, moon_radius, moon_alt_delta_deg=0, moon_az_delta_deg=0, label_ll=None, label_lr=None):
+        '''
+        a single frame
+        :return: PIL image (a copy of the frame buffer)
+        '''
+        return Image.fromarray(self.render_pixels(sun_radius, moon_radius, moon_alt_delta_deg=moon_alt_delta_deg,
+                                                  moon_az_delta_deg=moon_az_delta_deg, label_ll=label_ll,
+                                                  label_lr=label_lr))
+
+
+def disk_spans(y0, y1, center, radius):
+    '''
+    for each row from y0 to y1, the columns a disk covers any of [lo, hi) and the columns it covers all of
+    [inner_lo, inner_hi), a pixel short of the edge on either side, see disk_coverage
+    :return: four int arrays, empty spans have hi <= lo
+    '''
+    dy = np.arange(y0, y1) + 0.5 - center[1]
+    outer = np.sqrt(np.maximum((radius + 0.5) ** 2 - dy ** 2, 0))
+    inner = np.sqrt(np.maximum((radius - 0.5) ** 2 - dy ** 2, 0))
+    lo = np.floor(center[0] - outer - 0.5).astype(int)
+    hi = np.ceil(center[0] + outer - 0.5).astype(int) + 1
+    inner_lo = np.ceil(center[0] - inner - 0.5).astype(int) + 1
+    inner_hi = np.floor(center[0] + inner - 0.5).astype(int)
+    inner_hi[(radius - 0.5) ** 2 - dy ** 2 <= 0] = np.iinfo(int).min
+    return lo, hi, inner_lo, inner_hi
+
+
+def disk_coverage(y0, y1, x0, x1, center, radius):
+    '''
+    how much of each pixel of a box a disk covers, from the distance of the pixel's center to the disk's edge
+    :param center: (x, y) of the disk in pixels, the pixel at column x covers x to x + 1
+    :return: float32 array (y1 - y0, x1 - x0) of 0 to 1
+    '''
+    dy = np.arange(y0, y1, dtype=np.float32) + np.float32(0.5 - center[1])
+    dx = np.arange(x0, x1, dtype=np.float32) + np.float32(0.5 - center[0])
+    distance = np.sqrt(dy[:, None] ** 2 + dx[None, :] ** 2)
+    return np.clip(np.float32(radius + 0.5) - distance, 0, 1)
+
+
+COMPOSITORS = {'pil': Renderer, 'disk': DiskRenderer}
+_renderers = threading.local()
+
+
+def get_renderer(imagedir='./images', fontfile=None, fontsize=100, compositor='pil'):
+    '''
+    one renderer per image directory, font, size and compositor for the life of the process, and per thread: a
+    DiskRenderer draws every frame into the same buffer, so animations rendering at once in one process (the
+    service's jobs) can't share one
+    :param compositor: pil (Renderer) or disk (DiskRenderer)
+    '''
+    if compositor not in COMPOSITORS:
+        raise ValueError(f"unsupported compositor {compositor}")
+    renderers = getattr(_renderers, 'cache', None)
+    if renderers is None:
+        renderers = _renderers.cache = {}
+    key = (os.path.abspath(imagedir), fontfile, fontsize, compositor)
+    renderer = renderers.get(key)
+    if renderer is None:
+        renderer = renderers[key] = COMPOSITORS[compositor](imagedir, fontfile=fontfile, fontsize=fontsize)
+    return renderer
+
+
 def compositing( frame=False, title='unknown', filename=None,
                 label_ll=None, label_lr=None,
                 sun_radius=None, moon_radius=None, iso=None,
                 moon_alt_delta_deg=0, moon_az_delta_deg=0,
                 fontsize=100, basedir='.',
-                imagedir=f'./images'):
-    ratio = moon_radius / sun_radius
-    moon_az_delta_deg *= .725  # rough adjustment for 2D representation
-    imb, imb_size, bg_center, imb_mask = prep_image(f'{imagedir}/bluesky_4k.png',
-                                                    None, 1)
-    ims, ims_size, sun_center, ims_mask = prep_image(f'{imagedir}/sun.png',
-                                                     None, 1)
-    imm, imm_size, moon_center, imm_mask = prep_image(f'{imagedir}/newmoon.png',
-                                                      ims, ratio)
-
-    imb.paste(ims, (bg_center[0] - sun_center[0], bg_center[1] - sun_center[1]), ims_mask)
-
-    # start with the Moon centered over the Sun
-    centered_moon_x = bg_center[0] - moon_center[0]
-    centered_moon_y = bg_center[1] - moon_center[1]
-
-    # move the Moon's position based on the difference in altitude and azimum to the Sun, converted from degrees to pixels
-    pixels_per_degree = round(ims_size[0] / (sun_radius * 2))
-    x_offset = int(moon_az_delta_deg * pixels_per_degree)
-    y_offset = int(moon_alt_delta_deg * pixels_per_degree)
-
-    new_moon_x = round(centered_moon_x + (moon_az_delta_deg * pixels_per_degree))
-    new_moon_y = round(centered_moon_y + (moon_alt_delta_deg * pixels_per_degree))
-    imb.paste(imm, (new_moon_x, new_moon_y), imm_mask)
-
-    border = fontsize * 1.3
-    I1 = ImageDraw.Draw(imb)
-    if label_ll is not None:
-        myFont = ImageFont.truetype(filename, fontsize)
-        I1.text((border, imb_size[1] - border), label_ll, font=myFont, fill=(0, 0, 0), anchor='ls')
-
-    if label_lr is not None:
-        text = f"{label_lr}"
-        I1.text((imb_size[0] - border, imb_size[1] - border), text, font=myFont, fill=(0, 0, 0), anchor='rs')
+                imagedir=f'./images', renderer=None, compositor='pil'):
+    if renderer is None:
+        renderer = get_renderer(imagedir, fontfile=filename, fontsize=fontsize, compositor=compositor)
+    imb = renderer.render(sun_radius, moon_radius, moon_alt_delta_deg=moon_alt_delta_deg,
+                          moon_az_delta_deg=moon_az_delta_deg, label_ll=label_ll, label_lr=label_lr)
+
+    return save_frame(imb, title=title, iso=iso, frame=frame, basedir=basedir)
+
+
+# obscuration to color, dark blue for a sliver through to white for total
+HEATMAP_STOPS = [(0.0, (24, 32, 96)), (0.25, (32, 112, 184)), (0.5, (56, 176, 120)), (0.75, (240, 200, 40)),
+                 (0.9, (248, 112, 32)), (1.0, (255, 255, 255))]
+
 
+def heatmap(fraction, filename, fontfile=None, fontsize=24, title=None, contours=10):
+    '''
+    renders a grid of obscuration (northernmost row first) as a PNG, one pixel per grid point, with a line every
+    1/contours of obscuration and gray where there is no eclipse
+    :param fraction: 2D array of eclipse fractions, 0 to 1
+    :param title: optional label in the upper left
+    '''
+    fraction = np.nan_to_num(np.asarray(fraction, dtype=float))
+    stops = np.array([stop for stop, _ in HEATMAP_STOPS])
+    colors = np.array([color for _, color in HEATMAP_STOPS], dtype=float)
+    pixels = np.stack([np.interp(fraction, stops, colors[:, n]) for n in range(3)], axis=-1)
+    pixels[fraction <= 0] = 200
+    level = np.floor(fraction * contours)
+    edge = np.zeros(fraction.shape, dtype=bool)
+    edge[:-1] |= level[:-1] != level[1:]
+    edge[:, :-1] |= level[:, :-1] != level[:, 1:]
+    pixels[edge & (fraction > 0)] = 0
+    img = Image.fromarray(pixels.astype(np.uint8), 'RGB')
+    if title is not None:
+        font = ImageFont.load_default() if fontfile is None else ImageFont.truetype(fontfile, fontsize)
+        ImageDraw.Draw(img).text((fontsize / 2, fontsize / 2), title, font=font, fill=(0, 0, 0), anchor='lt')
+    img.save(filename)
+    return img
+
+
+def results_subdir(title, frame=False):
     atoms=title.split(', ')
     if len(atoms) == 1:
         subdir = title
     else:
         subdir = f"US/{atoms[1]}/{title}"
     if frame:
-        fullpath, dirname, filename = get_fullpath(basedir, iso, f"{subdir}/frames", filename=None)
-    else:
-        fullpath, dirname, filename = get_fullpath(basedir, iso, subdir, filename=None)
-    if not os.path.isfile(fullpath):
-        imb.save(fullpath, quality=95)
-
-    if label_lr is not None and 'eclipse' in label_lr:
-        if 'maximum' in label_lr:
-            cnt = 150
-        else:
-            cnt = 100
-        for x in range(cnt):
-            dest = shutil.copyfile(fullpath, fullpath.replace('.png', f'{x:04}.png'))
-    # fp = open (f"{dirname}/input.txt", 'a')
+        subdir = f"{subdir}/frames"
+    return subdir
+
+
+def save_frame(imb, title='unknown', iso=None, frame=False, basedir='.'):
+    '''
+    writes a rendered frame to results/.../{iso}.png, whether it is stale is up to the caller (see rendering.FrameManifest)
+    :return: the directory it was written to
+    '''
+    fullpath, dirname, filename = get_fullpath(basedir, iso, results_subdir(title, frame), filename=None)
+    imb.save(fullpath, quality=95)
 
     return dirname
 
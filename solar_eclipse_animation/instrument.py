@@ -0,0 +1,106 @@
+import cProfile
+import io
+import json
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+PROFILERS = ['cprofile', 'tracemalloc']
+
+
+class RunReport:
+    '''
+    where a run's time went: wall and CPU seconds of each stage (a stage entered more than once adds up), counters
+    (frames rendered, bytes written, cache hits, ...), facts about the run and peak memory, written as JSON.
+
+        report = RunReport(profile='cprofile')
+        with report.stage('render'):
+            ...
+        report.count('frames_rendered')
+        report.save('run.report.json')
+
+    profile turns on one of the profilers for everything from construction to save: cprofile adds the functions
+    with the most cumulative time (and writes the full profile beside the report as .prof, for snakeviz or
+    pstats), tracemalloc the peak of Python's own allocations and the lines that allocated the most.
+    '''
+
+    def __init__(self, profile=None, **facts):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"unsupported profiler {profile}, expected one of {', '.join(PROFILERS)}")
+        self.facts = dict(facts)
+        self.stages = {}
+        self.counters = {}
+        self.started = datetime.now(timezone.utc)
+        self._began = time.perf_counter()
+        self.profile = profile
+        self._profiler = None
+        self._tracing = False
+        if profile == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif profile == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._tracing = True
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+            stage['seconds'] += time.perf_counter() - wall
+            stage['cpu_seconds'] += time.process_time() - cpu
+            stage['calls'] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, **facts):
+        self.facts.update(facts)
+
+    def as_dict(self, top=25):
+        '''
+        :param top: how many functions (cprofile) or lines (tracemalloc) to include
+        '''
+        report = {'started': self.started.isoformat(timespec='seconds'), 'seconds': time.perf_counter() - self._began,
+                  **self.facts, 'stages': self.stages, 'counters': self.counters, 'memory': peak_memory()}
+        if self._profiler is not None:
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            report['profile'] = stream.getvalue().splitlines()
+        elif self.profile == 'tracemalloc' and tracemalloc.is_tracing():
+            report['memory']['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            report['profile'] = [str(line) for line in tracemalloc.take_snapshot().statistics('lineno')[:top]]
+        return report
+
+    def save(self, filename):
+        '''
+        stops the profiler, writes the report as JSON (and the cProfile data to the same name with .prof)
+        '''
+        if self._profiler is not None:
+            self._profiler.disable()
+        report = self.as_dict()
+        if self._profiler is not None:
+            self._profiler.dump_stats(f"{filename.rsplit('.json', 1)[0]}.prof")
+            self._profiler = None
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        return report
+
+
+def peak_memory():
+    '''
+    peak resident memory of this process and of the largest of its finished children (ffmpeg, render workers),
+    bytes.  on Linux a child starts out counted at this process's size when it was forked.
+    '''
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is kilobytes but on macOS
+    return {'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'peak_children_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
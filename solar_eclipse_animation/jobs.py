@@ -0,0 +1,159 @@
+import configparser
+import csv
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from cache import CircumstancesCache, cached_circumstances
+from imaging import QUALITY, asset_pyramid
+from main import main
+from rendering import render_pool
+
+# what a city in a manifest can have besides name, lat and lon
+CITY_FIELDS = {'lat': float, 'lon': float, 'ele': float, 'date': str}
+ELE = 100  # meters, for a city that doesn't give its elevation
+
+
+def read_manifest(filename, date='20231014'):
+    '''
+    the cities of a batch from a CSV (a header row with name or city, lat, lon and optionally ele and date), an INI
+    file (a section per city with city, lat, lon and ele, like astroreport.ini) or JSON (a list of objects with the
+    same keys, or an object of name: {lat, lon, ...})
+    :param date: YYYYMMDD for the cities that don't give one
+    :return: list of dicts of name, lat, lon, date (YYYYMMDD) and ele when given, in manifest order
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        with open(filename, newline='') as f:
+            rows = [{k.strip().lower(): v.strip() for k, v in row.items() if k and v and v.strip()}
+                    for row in csv.DictReader(f)]
+    elif extension in ['.ini', '.cfg']:
+        config = configparser.ConfigParser()
+        if not config.read(filename):
+            raise FileNotFoundError(filename)
+        rows = [dict(config[section], name=config[section].get('city', section)) for section in config.sections()]
+    elif extension == '.json':
+        with open(filename) as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict):
+            manifest = [dict(city, name=city.get('name', name)) for name, city in manifest.items()]
+        rows = manifest
+    else:
+        raise ValueError(f"unsupported manifest {filename}, expected .csv, .ini or .json")
+
+    cities = []
+    for n, row in enumerate(rows, 1):
+        city = {'name': row.get('name') or row.get('city')}
+        try:
+            city.update({k: convert(row[k]) for k, convert in CITY_FIELDS.items() if k in row})
+        except ValueError as e:
+            raise ValueError(f"{filename} city {n}: {e}") from e
+        city.setdefault('date', date)
+        if not city['name'] or 'lat' not in city or 'lon' not in city:
+            raise ValueError(f"{filename} city {n} needs a name, lat and lon")
+        cities.append(city)
+    return cities
+
+
+def run_batch(cities, workers=1, encoders=1, font=None, ephfilename='de430t.bsp', basedir='.', imagedir='./images',
+              backend='skyfield', compositor='pil', cache=True, summary=None, **options):
+    '''
+    animations for a list of cities, as main would make them one after the other, but scheduled as stages
+    sharing one process and its caches (ephemeris, renderers, asset digests):
+
+      circumstances  every city's are computed up front across the render pool and land in the circumstances cache
+      render         a city at a time across the pool, its frames streamed into ffmpeg
+      encode         ffmpeg finishing a city's MP4 in the background while the next is rendered, at most encoders
+                     at once
+
+    a city that fails is reported and the rest carry on.
+    :param cities: from read_manifest
+    :param workers: render processes shared by every city, 1 renders in this process, None uses every core
+    :param encoders: MP4s allowed to be finishing while the next city renders
+    :param summary: optional path of a JSON report of each city's timings, output and error
+    :param options: anything else main takes (step, fps, quality, stream, save_frames, ...)
+    :return: list of a dict per city: name, status (ok or failed), mp4, error and seconds per stage
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    began = time.perf_counter()
+    results = [{'name': city['name'], 'status': 'ok', 'mp4': None, 'error': None,
+                'seconds': {'circumstances': 0.0, 'render': 0.0, 'encode': 0.0}} for city in cities]
+    pool = None
+    if workers > 1:
+        # warmed with the images and font size main renders this quality from
+        quality = options.get('quality', 'final')
+        pool = render_pool(workers, asset_pyramid(imagedir, quality), font, round(100 * QUALITY[quality]['scale']),
+                           compositor)
+    encoder = ThreadPoolExecutor(max_workers=max(1, encoders), thread_name_prefix='encode')
+    try:
+        prefetch = [None] * len(cities)
+        if pool is not None and cache:
+            prefetch = [pool.submit(_circumstances, city, ephfilename, backend) for city in cities]
+        encoding = []
+        for city, result, future in zip(cities, results, prefetch):
+            try:
+                if future is not None:
+                    result['seconds']['circumstances'] = future.result()
+                while len(encoding) >= max(1, encoders):
+                    _finish(*encoding.pop(0))
+                started = time.perf_counter()
+                year, month, day = int(city['date'][:4]), int(city['date'][4:6]), int(city['date'][6:8])
+                done = main(name=city['name'], lat=city['lat'], lon=city['lon'], ele=city.get('ele', ELE), year=year,
+                            month=month, day=day, font=font, ephfilename=ephfilename, basedir=basedir,
+                            imagedir=imagedir, backend=backend, compositor=compositor, cache=cache, workers=workers,
+                            executor=pool, encoder=_timed(encoder, result), **options)
+                result['seconds']['render'] = time.perf_counter() - started
+                encoding.append((done, result))
+            except Exception as e:
+                _failed(result, e)
+        for pending in encoding:
+            _finish(*pending)
+    finally:
+        encoder.shutdown()
+        if pool is not None:
+            pool.shutdown()
+
+    report = {'seconds': time.perf_counter() - began, 'workers': workers, 'encoders': encoders,
+              'failed': sum(result['status'] != 'ok' for result in results), 'cities': results}
+    if summary:
+        with open(summary, 'w') as f:
+            json.dump(report, f, indent=1)
+    return results
+
+
+def _circumstances(city, ephfilename, backend):
+    # in a render worker, the result goes to the cache for main to read, only the time comes back
+    started = time.perf_counter()
+    cached_circumstances(int(city['date'][:4]), int(city['date'][4:6]), int(city['date'][6:8]), city['lat'],
+                         city['lon'], ele=city.get('ele', ELE), ephfilename=ephfilename, cache=CircumstancesCache(),
+                         backend=backend)
+    return time.perf_counter() - started
+
+
+def _timed(encoder, result):
+    # the encoder main submits to, timing the city's encode in the thread that runs it
+    def encode(finish):
+        started = time.perf_counter()
+        try:
+            return finish()
+        finally:
+            result['seconds']['encode'] = time.perf_counter() - started
+    return SimpleNamespace(submit=lambda finish: encoder.submit(encode, finish))
+
+
+def _finish(done, result):
+    try:
+        result['mp4'] = done.result()
+    except Exception as e:
+        _failed(result, e)
+
+
+def _failed(result, error):
+    result['status'] = 'failed'
+    result['error'] = f"{type(error).__name__}: {error}"
+    print(f"{result['name']} failed")
+    traceback.print_exception(type(error), error, error.__traceback__)
@@ -1,17 +1,18 @@
 import os
-from zoneinfo import ZoneInfo
+import subprocess
+from pathlib import Path
 
-import dateutil
-from skyfield import api
-from timezonefinder import TimezoneFinder
-from tqdm import tqdm
+import numpy as np
 
-from imaging import compositing
-from skyfieldcalcs import circumstances, eclipse_fraction
+from cache import CircumstancesCache, cached_circumstances
+from encoding import FanOutWriter, FFmpegError, FFmpegWriter, output_args, parse_output, write_concat_list
+from frameplan import FPS, frame_plan
+from imaging import QUALITY, asset_pyramid, get_fullpath, get_renderer, results_subdir
+from instrument import RunReport
+from rendering import render_frames
+from runtime import timezone_at
 
-# reusable objects
-ts = api.load.timescale()
-tf = TimezoneFinder()
+HANDBRAKE = '/Applications/HandBrakeCLI'  # where the macOS download puts it
 
 
 def decdeg2dms(dd):
@@ -21,70 +22,177 @@ def decdeg2dms(dd):
     return int(mult * deg), int(mult * mnt), mult * sec
 
 
+def strip_picks(holds, count):
+    '''
+    the frames of a thumbnail strip, spread evenly over the plan rather than over what's written, where a held
+    contact is many copies of one frame
+    :param holds: each planned frame's hold
+    :return: numbers of the written frames (a frame then its hold) to take, in order
+    '''
+    starts = np.cumsum([0] + [1 + hold for hold in holds[:-1]])
+    if len(starts) <= count:
+        return starts.tolist()
+    return starts[np.round(np.linspace(0, len(starts) - 1, count)).astype(int)].tolist()
+
+
 def main(name='Raleigh, NC', lat=35.78255, lon=-78.63899, year=2023, month=10, day=14, ele=97, font=None, ephfilename='de430t.bsp',
-         handbrake=False):
-    timezone = tf.timezone_at(lng=lon, lat=lat)
+         handbrake=None, cache=True, workers=1, stream=True, save_frames=False, basedir='.', imagedir='./images',
+         backend='skyfield', step=None, fps=FPS, compositor='pil', quality='final', executor=None, encoder=None,
+         profile=None, outputs=('mp4',)):
+    '''
+    :param handbrake: path of HandBrakeCLI to re-encode the MP4 with (unsharp, 20 fps) beside its directory, True for
+                      HANDBRAKE, None to leave the MP4 as ffmpeg wrote it
+    :param step: seconds of eclipse between frames, None for the minute-by-minute rows of the circumstances.  any
+                 other step is filled in from a timeline (timeline.py) fitted to a few dozen positions
+    :param fps: frame rate of the MP4, the holds on the contacts are scaled to last as long as they do at 25
+    :param compositor: pil pastes the images (imaging.Renderer), disk draws anti-aliased sub-pixel disks into a
+                       NumPy frame (imaging.DiskRenderer)
+    :param quality: draft (quarter size) or preview (half size) render the same frames from scaled down copies of the
+                    images (imaging.asset_pyramid) under {basedir}/{quality}, final renders from the images themselves
+    :param executor: a running pool of render workers (rendering.render_pool) to use rather than starting one, so a
+                     batch of cities (jobs.py) shares one
+    :param encoder: an executor the end of the encode is handed to, ffmpeg finishing one city's MP4 while the next is
+                    rendered.  main then returns a Future of the MP4's path
+    :param profile: cprofile or tracemalloc to profile the run, see instrument.RunReport
+    :param outputs: formats to encode the frames to, each with its own size and frame rate (encoding.parse_output:
+                    mp4, webm, gif, strip, gif:640@12, ...), all from one pass of rendering
+    :return: path of the MP4 (of the first output when there's no MP4), a {name}.report.json beside it has the time
+             each stage took, counts of frames and bytes and peak memory
+    '''
+    if quality not in QUALITY:
+        raise ValueError(f"unsupported quality {quality}")
+    outputs = dict(parse_output(spec) for spec in outputs)
+    if not outputs:
+        raise ValueError('no outputs')
+    report = RunReport(profile=profile, name=name, lat=lat, lon=lon, ele=ele, date=f"{year}{month:02d}{day:02d}",
+                       options=dict(backend=backend, ephfilename=ephfilename, step=step, fps=fps, compositor=compositor,
+                                    quality=quality, workers=workers, stream=stream, cache=cache, outputs=outputs))
+    tier = QUALITY[quality]
+    fontsize = round(100 * tier['scale'])
+    if quality != 'final':
+        basedir = f"{basedir}/{quality}"
+    with report.stage('timezone'):
+        timezone = timezone_at(lat, lon)
 
-    c1, c2, mid, c3, c4, df = circumstances(ts.utc(year, month, day), lat, lon, ele=ele, ephfilename=ephfilename)
-    df_eclipsed = df[(df.eclipse_fraction > 0)]
-    aaa = df[(df.eclipse_fraction > 0)]
-    aaa = aaa[['utc_iso', 'separation', 'moon_r', 'sun_r', 'eclipse_fraction']]
-    aaa.to_csv('dump.csv')
+    # re-rendering a city reuses the circumstances from the last run rather than going back to the ephemeris.  a
+    # timeline steps from the sub-second contacts, the minute rows would start it up to a minute into the eclipse
+    c1, c2, mid, c3, c4, table = cached_circumstances(year, month, day, lat, lon, ele=ele, ephfilename=ephfilename,
+                                                      cache=CircumstancesCache() if cache else None,
+                                                      refine=step is not None, backend=backend, report=report)
+    frames_table = table[table.eclipse_fraction > 0]
+    if step is not None and mid is None:
+        # there's nothing to fit a timeline between
+        raise ValueError(f"no eclipse at {lat}, {lon} on {year}-{month:02d}-{day:02d}")
+    if step is not None:
+        # a frame every step from c1 to c4, the positions from a timeline fitted on a few dozen rather than an
+        # ephemeris evaluation per frame
+        from backends import BACKENDS, get_backend
+        from runtime import timescale
+        from skyfieldcalcs import load_ephemeris
+        from timeline import Timeline, frame_times
+        eph = None
+        if BACKENDS[backend].needs_spk:
+            # the same excerpt of the days around the eclipse as the circumstances, not the whole kernel
+            with report.stage('ephemeris'):
+                date = timescale().utc(year, month, day)
+                eph = load_ephemeris(ephfilename, start=date.tt - 2, end=date.tt + 2)
+        with report.stage('timeline'):
+            contacts = [c['jd'] for c in [c1, c2, mid, c3, c4] if c is not None]
+            jd = frame_times(contacts, step)
+            frames_table = Timeline.fit(get_backend(backend, eph=eph), lat, lon, ele, jd[0], jd[-1]).table(jd)
 
-    # for event, msg in zip([c1, c2, mid, c3, c4], ['start of partial eclipse', 'start of annular eclipse', 'maximum eclipse', 'end of annular eclipse', 'end of partial eclipse']):
-    pbar = tqdm(total=df_eclipsed.shape[0])
-    dirname = 'unknown'
-    print(f'generating {df_eclipsed.shape[0]} animation frames for {name} for the eclipse on {year}-{month}-{day}')
-    for n, event in df_eclipsed.iterrows():
-        msg = ' '
-        pbar.update(1)
-        # if n % 5 != 0:
-        #     continue
-        obs = event['eclipse_fraction']
-        sun_alt = event['sun_alt']
-        sun_az = event['sun_az']
-        moon_alt = event['moon_alt']
-        moon_az = event['moon_az']
+    # every frame's times, labels, offsets and holds in one pass over the columns
+    with report.stage('frame_plan'):
+        contacts = {k: None if c is None else c['jd'] for k, c in zip(['c1', 'c2', 'mid', 'c3', 'c4'],
+                                                                      [c1, c2, mid, c3, c4])}
+        frames = frame_plan(frames_table, contacts, timezone, title=name, basedir=basedir, labels=font is not None,
+                            hold_scale=fps / FPS, milliseconds=step is not None and step % 1 != 0)
+    report.count('frames', len(frames))
+    print(f'generating {len(frames)} animation frames for {name} for the eclipse on {year}-{month}-{day}')
+    filename_mp4 = f"{name.replace(' ', '_')}_{year}{month:02d}{day:02d}{'' if quality == 'final' else '_' + quality}.mp4"
+    filenames = {output: f"{filename_mp4[:-4]}{settings['extension']}" for output, settings in outputs.items()}
+    picks = strip_picks(frames['hold'], outputs['strip']['count']) if 'strip' in outputs else None
+    with report.stage('assets'):
+        imagedir = asset_pyramid(imagedir, quality)
+    if stream:
+        # frames go straight from the renderer into ffmpeg, PNGs are only written when asked for
+        dirname = f"{basedir}/results/{results_subdir(name, frame=True)}".replace(',', '').replace(' ', '_')
+        Path(dirname).mkdir(parents=True, exist_ok=True)
+        print(f"streaming frames to ffmpeg")
+        with report.stage('assets'):
+            size = get_renderer(imagedir, fontfile=font, fontsize=fontsize, compositor=compositor).size
+        writers = []
+        try:
+            for output, settings in outputs.items():
+                writers.append(FFmpegWriter(f"{dirname}/{filenames[output]}", size, fps=fps,
+                                            output_args=output_args(output, settings, tier['preset'], picks)))
+        except BaseException:
+            for started in writers:
+                started.abort()
+            raise
+        # a single output is written to directly, more each get their own encoder fed from the one render
+        writer = writers[0] if len(writers) == 1 else FanOutWriter(writers)
+        try:
+            with report.stage('render'):
+                render_frames(frames, workers=workers, imagedir=imagedir, fontfile=font, fontsize=fontsize,
+                              writer=writer, save=save_frames, compositor=compositor, executor=executor, report=report)
+        except BaseException:
+            writer.abort()
+            raise
+        # how long rendering waited on ffmpeg to take frames, part of render
+        report.stages['render']['ffmpeg_wait_seconds'] = writer.wait_seconds
 
-        time_utc_dt = dateutil.parser.isoparse(event['utc_iso'])
-        time_local_dt = time_utc_dt.astimezone(ZoneInfo(timezone))
-        local_tz_short = time_utc_dt.strftime('%Z')[0] + time_local_dt.strftime('%Z')[-1]
-        local_time = time_local_dt.strftime('%-I:%M %p %Z')
-        local_date = time_local_dt.strftime('%a %b %-d, %Y')
-        obs = eclipse_fraction(event['separation'], event['moon_r'], event['sun_r'])
+        def encode():
+            # closing waits for ffmpeg to encode the frames still in its pipe and lookahead
+            writer.close()
+            report.count('frames_encoded', writer.frames)
+            report.count('bytes_piped', writer.frames * writer.frame_bytes * len(writers))
+    else:
+        with report.stage('render'):
+            dirnames = render_frames(frames, workers=workers, imagedir=imagedir, fontfile=font, fontsize=fontsize,
+                                     compositor=compositor, executor=executor, report=report)
+        dirname = dirnames[-1] if dirnames else 'unknown'
+        # each PNG is listed once with how long it is shown for, holds are durations rather than copies
+        timeline = [(os.path.basename(get_fullpath(basedir, iso, results_subdir(name, frame=True))[0]), 1 + hold)
+                    for iso, hold in zip(frames['iso'], frames['hold'])]
+        write_concat_list(f"{dirname}/frames.txt", timeline, fps=fps)
+        # the strip's frames keep their times, a frame rate would have them duplicated to fill it, and so are
+        # counted a PNG at a time, holds and all
+        if picks is not None:
+            picks = strip_picks([0] * len(frames), outputs['strip']['count'])
+        cmds = [['ffmpeg', '-f', 'concat', '-safe', '0', '-i', 'frames.txt',
+                 *(() if output == 'strip' else ('-r', str(fps))),
+                 '-frames:v', str(sum(count for _, count in timeline)),
+                 *output_args(output, settings, tier['preset'], picks), '-y', filenames[output]]
+                for output, settings in outputs.items()]
 
-        if event['utc_iso'] == c1['utc_iso']:
-            msg = 'start of partial eclipse'
-        elif c2 is not None and event['utc_iso'] == c2['utc_iso']:
-            msg = 'start of annular eclipse'
-        elif event['utc_iso'] == mid['utc_iso']:
-            msg = 'maximum eclipse'
-        elif c3 is not None and event['utc_iso'] == c3['utc_iso']:
-            msg = 'end of annular eclipse'
-        elif event['utc_iso'] == c4['utc_iso']:
-            msg = 'end of partial eclipse'
-        else:
-            msg = ''
-        if font is None:
-            ll = lr = None
-        else:
-            ll = f"{local_time}"
-            lr = f"{msg} {obs * 100:.1f}%"
+        def encode():
+            print(f"calling ffmpeg to generate {', '.join(outputs)} animation ")
+            # each output from the same PNGs, side by side
+            processes = [subprocess.Popen(cmd, cwd=dirname) for cmd in cmds]
+            failed = [(cmd, process.wait()) for cmd, process in zip(cmds, processes)]
+            failed = [(cmd, returncode) for cmd, returncode in failed if returncode != 0]
+            if failed:
+                raise FFmpegError('\n'.join(f"ffmpeg exited with status {returncode} writing {cmd[-1]}\n{' '.join(cmd)}"
+                                            for cmd, returncode in failed))
 
-        dirname = compositing(label_ll=ll, label_lr=lr, title=name,
-                              iso=time_local_dt.strftime('%Y%m%dT%H%M%S'),
-                              sun_radius=event['sun_r'], moon_radius=event['moon_r'],
-                              moon_alt_delta_deg=sun_alt - moon_alt,
-                              moon_az_delta_deg=moon_az - sun_az, frame=True, filename=font)
-    print(f"calling ffmpeg to generate MP4 animation ")
-    os.chdir(dirname)
-    filename_mp4 = f"{name.replace(' ', '_')}_{year}{month:02d}{day:02d}.mp4"
-    cmd = f'''ffmpeg  -pattern_type glob -i "*.png" -c:v libx264 -pix_fmt yuv420p -y "{name.replace(' ', '_')}_ASE20231014.mp4"'''
-    os.system(cmd)
-    print(f"wrote to {filename_mp4}")
-    if handbrake:
-        print(f"refining animation with handbrakecli")
+    def finish():
+        with report.stage('encode'):
+            encode()
+        for output, filename in filenames.items():
+            print(f"wrote to {filename}")
+            if os.path.isfile(f"{dirname}/{filename}"):
+                report.count(f'{output}_bytes', os.path.getsize(f"{dirname}/{filename}"))
+        # what went into every frame, to inspect or to render again with FramePlan.load
+        with report.stage('save_plan'):
+            frames.save(f"{dirname}/{filename_mp4[:-4]}.plan.json")
+        if handbrake and 'mp4' in outputs:
+            print(f"refining animation with handbrakecli")
+            cmd = [HANDBRAKE if handbrake is True else handbrake, '-r', '20', '--unsharp', 'medium',
+                   '-i', filename_mp4, '-o', f"../{filename_mp4.replace(',', '')}"]
+            with report.stage('handbrake'):
+                subprocess.run(cmd, cwd=dirname, check=True)
+        report.save(f"{dirname}/{filename_mp4[:-4]}.report.json")
+        return f"{dirname}/{filenames.get('mp4', next(iter(filenames.values())))}"
 
-        cmd = f'''/Applications/HandBrakeCLI -r 20 --unsharp medium -i {filename_mp4} -o ../{filename_mp4.replace(',', '')}'''
-        print(cmd)
-        os.system(cmd)
+    return finish() if encoder is None else encoder.submit(finish)
@@ -0,0 +1,159 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from imaging import heatmap
+from multisite import GeocentricTrack, Observers, local_contacts
+from runtime import timescale
+from skyfieldcalcs import get_ints_for_dt_params, load_ephemeris
+
+FIELDS = ['eclipse_fraction', 'c1', 'c2', 'mid', 'c3', 'c4', 'sun_alt']
+CONUS = {'lat': (24.5, 49.5), 'lon': (-125.0, -66.5)}
+
+
+class ObscurationMap:
+    '''
+    maximum obscuration, contact times (TT julian dates, NaN where there is no such contact) and the Sun's altitude at
+    maximum for every point of a lat/lon grid, each field a (len(lats), len(lons)) array with the northernmost row first
+    '''
+
+    def __init__(self, lats, lons, fields):
+        self.lats = lats
+        self.lons = lons
+        self.fields = fields
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.fields:
+            raise AttributeError(name)
+        return self.fields[name]
+
+    @property
+    def shape(self):
+        return len(self.lats), len(self.lons)
+
+    def save_npz(self, filename):
+        np.savez_compressed(filename, lats=self.lats, lons=self.lons, **self.fields)
+
+    @classmethod
+    def load_npz(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['lats'], data['lons'], {name: data[name] for name in FIELDS})
+
+    def save_csv(self, filename):
+        '''
+        one line per grid point: lat, lon, eclipse_fraction, sun_alt and the contacts in UTC (blank when there are none)
+        '''
+        lat, lon = np.meshgrid(self.lats, self.lons, indexing='ij')
+        columns = {'lat': np.char.mod('%.4f', lat.ravel()), 'lon': np.char.mod('%.4f', lon.ravel()),
+                   'eclipse_fraction': np.char.mod('%.5f', self.eclipse_fraction.ravel()),
+                   'sun_alt': np.char.mod('%.2f', self.sun_alt.ravel())}
+        for k in ['c1', 'c2', 'mid', 'c3', 'c4']:
+            columns[f'{k}_utc'] = utc_strings(self.fields[k].ravel())
+        with open(filename, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            rows = np.stack(list(columns.values()), axis=1)
+            for start in range(0, len(rows), 100_000):
+                f.writelines(','.join(row) + '\n' for row in rows[start:start + 100_000])
+
+    def save_png(self, filename, fontfile=None, title=None):
+        heatmap(self.eclipse_fraction, filename, fontfile=fontfile, title=title)
+
+
+def obscuration_map(date, lat_range=CONUS['lat'], lon_range=CONUS['lon'], shape=(1000, 1000), ele=0,
+                    ephfilename='de430t.bsp', workers=1, chunk=2048, tolerance_seconds=1, stride=5):
+    '''
+    local circumstances over a regular lat/lon grid.  the geocentric Sun and Moon are computed once, the grid is then
+    worked through in chunks of points (see multisite.local_contacts), spread across processes when workers > 1.
+    memory stays at the output arrays plus one chunk per worker however large the grid.
+    :param date: skyfield Time, the day of the eclipse
+    :param lat_range: (south, north) in degrees
+    :param lon_range: (west, east) in degrees
+    :param shape: number of latitudes, number of longitudes
+    :param ele: elevation in meters of every point
+    :param workers: number of processes, None for one per core
+    :param chunk: grid points per chunk
+    :param tolerance_seconds: how closely contact times are refined
+    :param stride: bracketing step in minutes (multiples of the track's 1 minute grid), eclipses shorter than this
+                   (grazing the edge of the penumbra) can be missed
+    :return: ObscurationMap
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    day, hour, minute, month, second, year = get_ints_for_dt_params(date)
+    noon = timescale().utc(year, month, day, 12).tt
+    eph = load_ephemeris(ephfilename, start=noon - 2, end=noon + 2)
+    track = GeocentricTrack(eph, noon - 1, noon + 1).window()
+
+    lats = np.linspace(lat_range[1], lat_range[0], shape[0])
+    lons = np.linspace(lon_range[0], lon_range[1], shape[1])
+    size = shape[0] * shape[1]
+    fields = {name: np.full(size, np.nan) for name in FIELDS}
+    fields['eclipse_fraction'][:] = 0
+    if track is not None:
+        chunks = [(start, min(start + chunk, size)) for start in range(0, size, chunk)]
+        args = (track, lats, lons, ele, tolerance_seconds, stride)
+        with tqdm(total=size) as pbar:
+            if workers <= 1 or len(chunks) == 1:
+                _init_worker(*args)
+                results = map(_map_chunk, chunks)
+                for (start, stop), result in zip(chunks, results):
+                    _store(fields, start, stop, result)
+                    pbar.update(stop - start)
+            else:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args) as executor:
+                    for (start, stop), result in zip(chunks, executor.map(_map_chunk, chunks)):
+                        _store(fields, start, stop, result)
+                        pbar.update(stop - start)
+    return ObscurationMap(lats, lons, {name: values.reshape(shape) for name, values in fields.items()})
+
+
+def save_map(obscuration, dirname, name='map', fontfile=None, title=None):
+    '''
+    writes {name}.npz, {name}.csv and {name}.png to dirname
+    :return: the three paths
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    paths = [os.path.join(dirname, f'{name}.{ext}') for ext in ['npz', 'csv', 'png']]
+    obscuration.save_npz(paths[0])
+    obscuration.save_csv(paths[1])
+    obscuration.save_png(paths[2], fontfile=fontfile, title=title)
+    return paths
+
+
+def utc_strings(jd):
+    '''
+    TT julian dates as UTC ISO strings ('' for NaN) without going through a Time per element, the offset between
+    TT and UTC is taken once from the earliest time (an eclipse doesn't span a leap second)
+    '''
+    strings = np.full(len(jd), '', dtype=object)
+    present = np.isfinite(jd)
+    if present.any():
+        t = timescale().tt_jd(np.nanmin(jd))
+        offset = t.tt - (t.utc_datetime().timestamp() / 86400 + 2440587.5)
+        seconds = np.round((jd[present] - offset - 2440587.5) * 86400).astype('int64')
+        strings[present] = np.char.add(np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s'), 'Z')
+    return strings.astype(str)
+
+
+_worker = {}
+
+
+def _init_worker(track, lats, lons, ele, tolerance_seconds, stride):
+    _worker.update(track=track, lats=lats, lons=lons, ele=ele, tolerance_seconds=tolerance_seconds, stride=stride)
+
+
+def _map_chunk(bounds):
+    start, stop = bounds
+    index = np.arange(start, stop)
+    lons = _worker['lons']
+    observers = Observers(_worker['lats'][index // len(lons)], lons[index % len(lons)], _worker['ele'])
+    result = local_contacts(_worker['track'], observers, tolerance_seconds=_worker['tolerance_seconds'],
+                            stride=_worker['stride'])
+    return {name: result[name] for name in FIELDS}
+
+
+def _store(fields, start, stop, result):
+    for name in FIELDS:
+        fields[name][start:stop] = result[name]
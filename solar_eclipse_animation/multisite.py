@@ -0,0 +1,254 @@
+import numpy as np
+import pandas as pd
+from skyfield.api import wgs84
+from skyfield.framelib import itrs
+
+from runtime import timescale
+from skyfieldcalcs import MOON_RADIUS_KM, SUN_RADIUS_KM, eclipse_fraction_array, get_ints_for_dt_params, \
+    load_ephemeris
+
+CONTACTS = ['c1', 'c2', 'mid', 'c3', 'c4']
+# widest separation of the geocentric Sun and Moon that can still be an eclipse somewhere: both radii plus the
+# Moon's largest horizontal parallax, with some margin
+GEOCENTRIC_LIMIT_DEG = 1.7
+
+
+class GeocentricTrack:
+    '''
+    apparent positions of the Sun and Moon from the centre of the Earth on a regular time grid, rotated into the
+    Earth-fixed (ITRS) frame.  this is the only part of local circumstances that needs the ephemeris and it is the
+    same for every observer, an observer's view is then their own ITRS position subtracted from these vectors.
+    positions between grid points are cubic (4 point Lagrange) interpolations, at a 1 minute step that is well under
+    a metre for the Moon.
+    '''
+
+    def __init__(self, eph, jd_start, jd_end, step_minutes=1):
+        self.step = step_minutes / 1440
+        self.jd = np.arange(jd_start, jd_end + self.step, self.step)
+        t = timescale().tt_jd(self.jd)
+        earth = eph['earth'].at(t)
+        rotation = itrs.rotation_at(t)
+        self.moon = np.einsum('ijn,jn->ni', rotation, earth.observe(eph['moon']).apparent().xyz.km)
+        self.sun = np.einsum('ijn,jn->ni', rotation, earth.observe(eph['sun']).apparent().xyz.km)
+
+    def window(self, limit_deg=GEOCENTRIC_LIMIT_DEG):
+        '''
+        :return: the track cut down to the grid points where the Sun and Moon are close
+                 enough for an eclipse to be seen from somewhere, None when they never are
+        '''
+        cos = np.sum(self.moon * self.sun, axis=1) / np.linalg.norm(self.moon, axis=1) / np.linalg.norm(self.sun, axis=1)
+        close = np.flatnonzero(np.degrees(np.arccos(np.clip(cos, -1, 1))) < limit_deg)
+        if len(close) == 0:
+            return None
+        # two extra points each side keep the interpolation stencil inside the window
+        first, last = max(close[0] - 2, 0), min(close[-1] + 3, len(self.jd))
+        track = GeocentricTrack.__new__(GeocentricTrack)
+        track.step = self.step
+        track.jd, track.moon, track.sun = self.jd[first:last], self.moon[first:last], self.sun[first:last]
+        return track
+
+    def at(self, jd):
+        '''
+        :param jd: TT julian dates (array, any shape) inside the grid
+        :return: Moon and Sun ITRS vectors (km), shaped jd.shape + (3,)
+        '''
+        x = (np.asarray(jd, dtype=float) - self.jd[0]) / self.step
+        n = np.clip(np.floor(x).astype(int), 1, len(self.jd) - 3)
+        u = (x - n)[..., None]
+        weights = [-u * (u - 1) * (u - 2) / 6, (u + 1) * (u - 1) * (u - 2) / 2,
+                   -(u + 1) * u * (u - 2) / 2, (u + 1) * u * (u - 1) / 6]
+        moon = sum(w * self.moon[n + k - 1] for k, w in enumerate(weights))
+        sun = sum(w * self.sun[n + k - 1] for k, w in enumerate(weights))
+        return moon, sun
+
+
+class Observers:
+    '''
+    ITRS positions and local east/north/up directions of a set of sites (wgs84)
+    '''
+
+    def __init__(self, lats, lons, eles=100):
+        lats, lons, eles = np.broadcast_arrays(np.atleast_1d(np.asarray(lats, dtype=float)),
+                                               np.atleast_1d(np.asarray(lons, dtype=float)),
+                                               np.atleast_1d(np.asarray(eles, dtype=float)))
+        self.lat, self.lon, self.ele = lats, lons, eles
+        self.xyz = wgs84.latlon(lats, lons, elevation_m=eles).itrs_xyz.km.T
+        phi, lam = np.radians(lats), np.radians(lons)
+        self.east = np.stack([-np.sin(lam), np.cos(lam), np.zeros_like(lam)], axis=-1)
+        self.north = np.stack([-np.sin(phi) * np.cos(lam), -np.sin(phi) * np.sin(lam), np.cos(phi)], axis=-1)
+        self.up = np.stack([np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)], axis=-1)
+
+    def __len__(self):
+        return len(self.lat)
+
+
+def topocentric(track, observers, jd):
+    '''
+    separation and apparent radii of the Sun and Moon for every observer at their own times
+    :param jd: TT julian dates, shaped (sites,) or (sites, times)
+    :return: separation, moon radius, sun radius (degrees), Moon and Sun vectors (km) from the observers
+    '''
+    jd = np.asarray(jd, dtype=float)
+    moon, sun = track.at(jd)
+    return _view(moon, sun, observers.xyz.reshape((len(observers),) + (1,) * (jd.ndim - 1) + (3,)))
+
+
+def _view(moon, sun, origin):
+    moon, sun = moon - origin, sun - origin
+    moon_dist, sun_dist = np.linalg.norm(moon, axis=-1), np.linalg.norm(sun, axis=-1)
+    cos = np.sum(moon * sun, axis=-1) / (moon_dist * sun_dist)
+    # arccos loses precision near zero, the cross product keeps it for near-central eclipses
+    sin = np.linalg.norm(np.cross(moon, sun), axis=-1) / (moon_dist * sun_dist)
+    separation = np.degrees(np.arctan2(sin, cos))
+    moon_r = np.degrees(np.arcsin(MOON_RADIUS_KM / moon_dist))
+    sun_r = np.degrees(np.arcsin(SUN_RADIUS_KM / sun_dist))
+    return separation, moon_r, sun_r, moon, sun
+
+
+def altaz(observers, vector):
+    '''
+    :param vector: topocentric ITRS vectors, shaped (sites, 3)
+    :return: altitude and azimuth (degrees) for each site
+    '''
+    up = np.sum(vector * observers.up, axis=-1)
+    north = np.sum(vector * observers.north, axis=-1)
+    east = np.sum(vector * observers.east, axis=-1)
+    alt = np.degrees(np.arctan2(up, np.hypot(north, east)))
+    az = np.degrees(np.arctan2(east, north)) % 360
+    return alt, az
+
+
+def local_contacts(track, observers, tolerance_seconds=0.05, stride=1):
+    '''
+    contact points and maximum eclipse for every observer at once, the vectorized counterpart of find_contacts.
+    the track's grid brackets each contact, then every site's brackets are narrowed together.
+    :param track: GeocentricTrack (ideally its window())
+    :param observers: Observers
+    :param stride: bracket on every stride-th point of the track's grid, coarser is faster but can miss eclipses
+                   shorter than the bracketing step
+    :return: dict of arrays, one element per site: TT julian dates for c1, c2, mid, c3, c4 (NaN where there is no
+             such contact), eclipse_fraction at maximum, sun_alt and sun_az at maximum
+    '''
+    jd = track.jd[::stride]
+    tolerance = tolerance_seconds / 86400
+    # the bracketing grid is the track's own points, nothing to interpolate
+    separation, moon_r, sun_r, _, _ = _view(track.moon[None, ::stride], track.sun[None, ::stride],
+                                            observers.xyz[:, None])
+
+    # maximum eclipse, the minimum separation between the grid points either side of the smallest on the grid
+    n = np.argmin(separation, axis=1)
+    a, b = jd[np.maximum(n - 1, 0)], jd[np.minimum(n + 1, len(jd) - 1)]
+    mid = _golden_section(lambda t: topocentric(track, observers, t)[0], a, b, tolerance)
+    sep, m_r, s_r, moon, sun = topocentric(track, observers, mid)
+    eclipsed = sep < m_r + s_r
+    central = sep < np.abs(s_r - m_r)
+
+    # the last grid point before maximum and the first after it where the disks don't overlap
+    clear = separation >= (moon_r + sun_r)
+    index = np.arange(len(jd))
+    before = np.where(clear & (index <= n[:, None]), index, -1).max(axis=1)
+    after = np.where(clear & (index >= n[:, None]), index, len(jd)).min(axis=1)
+    before, after = np.maximum(before, 0), np.minimum(after, len(jd) - 1)
+
+    def partial(t):
+        sep, m_r, s_r, _, _ = topocentric(track, observers, t)
+        return sep - (m_r + s_r)
+
+    def annular(t):
+        sep, m_r, s_r, _, _ = topocentric(track, observers, t)
+        return sep - np.abs(s_r - m_r)
+
+    c1 = _bisect(partial, np.minimum(jd[before], mid), mid, tolerance)
+    c4 = _bisect(partial, mid, np.maximum(jd[after], mid), tolerance)
+    c2 = _bisect(annular, c1, mid, tolerance)
+    c3 = _bisect(annular, mid, c4, tolerance)
+
+    sun_alt, sun_az = altaz(observers, sun)
+    result = {'c1': c1, 'c2': c2, 'mid': mid, 'c3': c3, 'c4': c4,
+              'eclipse_fraction': eclipse_fraction_array(sep, m_r, s_r), 'sun_alt': sun_alt, 'sun_az': sun_az}
+    for k in ['c1', 'mid', 'c4']:
+        result[k] = np.where(eclipsed, result[k], np.nan)
+    for k in ['c2', 'c3']:
+        result[k] = np.where(eclipsed & central, result[k], np.nan)
+    result['eclipse_fraction'][~eclipsed] = 0
+    return result
+
+
+def _golden_section(f, a, b, tolerance):
+    # vectorized golden section search, every element brackets its own minimum
+    invphi = (np.sqrt(5) - 1) / 2
+    a, b = np.array(a, dtype=float), np.array(b, dtype=float)
+    c, d = b - (b - a) * invphi, a + (b - a) * invphi
+    fc, fd = f(c), f(d)
+    while np.max(np.abs(b - a)) > tolerance:
+        # where the minimum is left of d the bracket becomes [a, d] and a new c is probed, otherwise [c, b] and a new d
+        left = fc < fd
+        a, b = np.where(left, a, c), np.where(left, d, b)
+        c, d = np.where(left, b - (b - a) * invphi, d), np.where(left, c, a + (b - a) * invphi)
+        probe = f(np.where(left, c, d))
+        fc, fd = np.where(left, probe, fd), np.where(left, fc, probe)
+    return (a + b) / 2
+
+
+def _bisect(f, a, b, tolerance):
+    # vectorized bisection of a sign change between a and b, elements without one converge to an end
+    a, b = np.array(a, dtype=float), np.array(b, dtype=float)
+    fa = f(a)
+    while np.max(np.abs(b - a)) > tolerance:
+        c = (a + b) / 2
+        fc = f(c)
+        same = np.sign(fc) == np.sign(fa)
+        a, fa, b = np.where(same, c, a), np.where(same, fc, fa), np.where(same, b, c)
+    return (a + b) / 2
+
+
+def circumstances_batch(start, lats, lons, eles=100, eph=None, ephfilename=None, tolerance_seconds=0.05,
+                        chunk=1024):
+    '''
+    local circumstances of an eclipse for many sites from one pass over the ephemeris.  the geocentric Sun and Moon
+    are computed once (GeocentricTrack) for the same 2 day span circumstances searches and every site's
+    topocentric view, contacts and maximum are worked out from them together.
+    agrees with solve_contacts to a fraction of a second.
+    :param start: skyfield Time, the day of the eclipse
+    :param lats: latitudes in degrees (array-like, positive north, negative south)
+    :param lons: longitudes in degrees (array-like, positive east, negative west)
+    :param eles: elevations in meters (array-like or a single value for every site)
+    :param chunk: sites worked on together, bounds memory at roughly 50 MB per 1000 sites
+    :return: dataframe with one row per site: lat, lon, ele, TT julian dates and UTC ISO strings for c1, c2, mid, c3
+             and c4 (NaN/None where there is no such contact), eclipse_fraction at maximum (0 when there is no
+             eclipse), sun_alt and sun_az at maximum
+    '''
+    day, hour, minute, month, second, year = get_ints_for_dt_params(start)
+    if eph is None:
+        eph = load_ephemeris(ephfilename)
+    lats, lons, eles = np.broadcast_arrays(np.atleast_1d(np.asarray(lats, dtype=float)),
+                                           np.atleast_1d(np.asarray(lons, dtype=float)),
+                                           np.atleast_1d(np.asarray(eles, dtype=float)))
+    df = pd.DataFrame({'lat': lats, 'lon': lons, 'ele': eles})
+    noon = timescale().utc(year, month, day, 12).tt
+    track = GeocentricTrack(eph, noon - 1, noon + 1).window()
+    if track is None:
+        result = {k: np.full(len(df), np.nan) for k in CONTACTS + ['sun_alt', 'sun_az']}
+        result['eclipse_fraction'] = np.zeros(len(df))
+    else:
+        parts = [local_contacts(track, Observers(lats[i:i + chunk], lons[i:i + chunk], eles[i:i + chunk]),
+                                tolerance_seconds=tolerance_seconds) for i in range(0, len(df), chunk)]
+        result = {k: np.concatenate([part[k] for part in parts]) for k in parts[0]}
+    for k in CONTACTS:
+        df[k] = result[k]
+        df[f'{k}_utc'] = utc_iso(result[k])
+    for k in ['eclipse_fraction', 'sun_alt', 'sun_az']:
+        df[k] = result[k]
+    return df
+
+
+def utc_iso(jd):
+    '''
+    :param jd: TT julian dates, NaN where there is no time
+    :return: series of UTC ISO strings, None in place of NaN
+    '''
+    iso = np.full(len(jd), None, dtype=object)
+    present = np.isfinite(jd)
+    if present.any():
+        iso[present] = timescale().tt_jd(jd[present]).utc_iso()
+    return pd.Series(iso, dtype=object)
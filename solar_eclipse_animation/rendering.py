@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from imaging import ASSETS, compositing, get_fullpath, get_renderer, results_subdir, save_frame
+
+RENDER_VERSION = 1  # bump when the way frames are drawn changes, every frame is then re-rendered once
+# compositing arguments that change the pixels of a frame
+RENDER_INPUTS = ['sun_radius', 'moon_radius', 'moon_alt_delta_deg', 'moon_az_delta_deg', 'label_ll', 'label_lr', 'fontsize',
+                 'compositor']
+
+
+def render_frames(frames, workers=1, imagedir='./images', fontfile=None, fontsize=100, writer=None, save=True,
+                  compositor='pil', executor=None, report=None):
+    '''
+    renders every frame with compositing, one at a time or spread across a pool of worker processes.
+    each worker decodes the assets once (its own warm Renderer) and keeps them for all of its frames.
+    frame file names come from the frames themselves, so the output is the same either way.
+    saved frames are incremental: a manifest in each frames directory records a hash of what went into each PNG
+    (see frame_digest), only frames whose hash changed are rendered again and PNGs no longer in the animation are
+    removed.
+    :param frames: list of dicts of keyword arguments for compositing, in animation order, plus an optional
+                   hold: how many extra frame-times the frame stays on screen
+    :param workers: number of processes, 1 renders in this process, None uses every core
+    :param writer: optional FFmpegWriter, each frame is written to it in animation order
+    :param save: write each frame as a PNG, only optional when there is a writer
+    :param compositor: pil (imaging.Renderer) or disk (imaging.DiskRenderer)
+    :param executor: a running pool (render_pool) to render in rather than starting one for these frames, workers
+                     is then how many of its processes to keep busy
+    :param report: optional instrument.RunReport, counts the frames rendered, up to date and held (written again)
+                   and the bytes of PNGs written
+    :return: the directory each frame was written to (None when not saved), in the same order as frames
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    frames = [dict(frame, imagedir=imagedir, filename=fontfile, fontsize=fontsize, save=save, compositor=compositor)
+              for frame in frames]
+    stream = writer is not None
+    manifests = {}
+    if save:
+        assets = asset_digest(imagedir, fontfile)
+        for frame in frames:
+            fullpath, dirname, filename = get_fullpath(frame.get('basedir', '.'), frame['iso'],
+                                                       results_subdir(frame.get('title', 'unknown'), frame.get('frame', False)))
+            if dirname not in manifests:
+                manifests[dirname] = FrameManifest(dirname)
+            frame['digest'] = frame_digest(frame, assets)
+            frame['save'] = not manifests[dirname].is_current(filename, frame['digest'])
+            manifests[dirname].record(filename, frame['digest'])
+    skipped = 0 if stream else sum(1 for frame in frames if save and not frame['save'])
+    rendered = [frame for frame in frames if stream or frame['save']]
+    pbar = tqdm(total=len(frames))
+    pbar.update(skipped)
+    dirnames = []
+    if workers <= 1 or len(frames) - skipped <= 1:
+        for frame in frames:
+            dirname, pixels = _render_frame(frame, stream)
+            if stream:
+                _write(writer, pixels, frame)
+            dirnames.append(dirname)
+            if stream or frame['save']:
+                pbar.update(1)
+    elif not stream:
+        with _pool(executor, workers, imagedir, fontfile, fontsize, compositor) as executor:
+            # map hands results back in submission order, small chunks keep every worker busy to the end
+            todo = [frame for frame in frames if frame['save']]
+            chunksize = max(1, min(8, len(todo) // (workers * 4)))
+            for _ in executor.map(_render_frame, todo, chunksize=chunksize):
+                pbar.update(1)
+            dirnames = [_frame_dir(frame) for frame in frames]
+    else:
+        with _pool(executor, workers, imagedir, fontfile, fontsize, compositor) as executor:
+            # a full frame of pixels is large, so only a couple per worker are ever in flight, the oldest is
+            # waited on and written before another is submitted, which also keeps them in order
+            pending = deque()
+            for frame in frames:
+                if len(pending) >= 2 * workers:
+                    dirnames.append(_write_next(pending, writer))
+                    pbar.update(1)
+                pending.append((executor.submit(_render_frame, frame, True), frame))
+            while pending:
+                dirnames.append(_write_next(pending, writer))
+                pbar.update(1)
+    pbar.close()
+    for manifest in manifests.values():
+        manifest.prune()
+        manifest.save()
+    if report is not None:
+        report.count('frames_rendered', len(rendered))
+        report.count('frames_up_to_date', skipped)
+        if stream:
+            report.count('frames_held', sum(frame.get('hold', 0) for frame in frames))
+        if save:
+            report.count('png_bytes', sum(os.path.getsize(_frame_path(frame)) for frame in rendered if frame['save']))
+    return dirnames
+
+
+def render_pool(workers=None, imagedir='./images', fontfile=None, fontsize=100, compositor='pil'):
+    '''
+    a pool of worker processes that each decode the assets once, to pass to render_frames as executor and keep for
+    as many animations as use the same images, font and compositor
+    :param workers: number of processes, None for one per core
+    '''
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_warm_worker,
+                               initargs=(imagedir, fontfile, fontsize, compositor))
+
+
+class FrameManifest:
+    '''
+    manifest.json in a frames directory, the hash of the inputs of every PNG in it.  record() the frames of the
+    current run, prune() removes the PNGs (and entries) that are not part of it, save() writes it back.
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.path = os.path.join(dirname, 'manifest.json')
+        try:
+            with open(self.path) as f:
+                self.previous = json.load(f).get('frames', {})
+        except (FileNotFoundError, ValueError):
+            self.previous = {}
+        self.frames = {}
+
+    def is_current(self, filename, digest):
+        return self.previous.get(filename) == digest and os.path.isfile(os.path.join(self.dirname, filename))
+
+    def record(self, filename, digest):
+        self.frames[filename] = digest
+
+    def prune(self):
+        for entry in os.scandir(self.dirname):
+            if entry.name.endswith('.png') and entry.name not in self.frames:
+                os.unlink(entry.path)
+
+    def save(self):
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': RENDER_VERSION, 'frames': self.frames}, f, indent=1, sort_keys=True)
+        os.replace(tmpname, self.path)
+
+
+def frame_digest(frame, assets):
+    '''
+    hash of everything that decides the pixels of a frame: the Sun and Moon radii and offsets, the labels,
+    the font size and the digest of the image and font files (asset_digest)
+    '''
+    inputs = {key: _plain(frame.get(key)) for key in RENDER_INPUTS}
+    inputs.update(version=RENDER_VERSION, assets=assets)
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+_file_digests = {}
+
+
+def asset_digest(imagedir, fontfile=None):
+    '''
+    combined sha256 of the background, Sun and Moon images and the font, each file is only read again when its
+    size or modification time changes
+    '''
+    digest = hashlib.sha256()
+    for path in [os.path.join(imagedir, name) for name in ASSETS] + ([fontfile] if fontfile else []):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in _file_digests:
+            with open(path, 'rb') as f:
+                _file_digests[key] = hashlib.sha256(f.read()).hexdigest()
+        digest.update(_file_digests[key].encode())
+    return digest.hexdigest()
+
+
+def _plain(value):
+    # numpy scalars and python floats hash the same
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _frame_dir(frame):
+    return get_fullpath(frame.get('basedir', '.'), frame['iso'], results_subdir(frame.get('title', 'unknown'),
+                                                                                frame.get('frame', False)))[1]
+
+
+def _frame_path(frame):
+    return get_fullpath(frame.get('basedir', '.'), frame['iso'], results_subdir(frame.get('title', 'unknown'),
+                                                                                frame.get('frame', False)))[0]
+
+
+def _pool(executor, workers, imagedir, fontfile, fontsize, compositor):
+    # the caller's pool is left running for its next animation, one started here is shut down with the frames
+    if executor is not None:
+        return nullcontext(executor)
+    return render_pool(workers, imagedir, fontfile, fontsize, compositor)
+
+
+def _write_next(pending, writer):
+    future, frame = pending.popleft()
+    dirname, pixels = future.result()
+    _write(writer, pixels, frame)
+    return dirname
+
+
+def _write(writer, pixels, frame):
+    # a hold is the same pixels written again, nothing is rendered or stored twice
+    for _ in range(1 + frame.get('hold', 0)):
+        writer.write(pixels)
+
+
+def _warm_worker(imagedir, fontfile, fontsize, compositor='pil'):
+    get_renderer(imagedir, fontfile=fontfile, fontsize=fontsize, compositor=compositor)
+
+
+def _render_frame(frame, stream=False):
+    save = frame.get('save', True)
+    if not stream:
+        if not save:
+            return _frame_dir(frame), None  # already up to date
+        return compositing(**{k: v for k, v in frame.items() if k not in ['hold', 'save', 'digest']}), None
+    renderer = get_renderer(frame['imagedir'], fontfile=frame['filename'], fontsize=frame['fontsize'],
+                            compositor=frame.get('compositor', 'pil'))
+    args = dict(moon_alt_delta_deg=frame.get('moon_alt_delta_deg', 0), moon_az_delta_deg=frame.get('moon_az_delta_deg', 0),
+                label_ll=frame.get('label_ll'), label_lr=frame.get('label_lr'))
+    if not save:
+        # straight from the renderer to the writer, for DiskRenderer its own frame buffer
+        return (_frame_dir(frame) if 'digest' in frame else None,
+                renderer.render_pixels(frame['sun_radius'], frame['moon_radius'], **args))
+    imb = renderer.render(frame['sun_radius'], frame['moon_radius'], **args)
+    dirname = save_frame(imb, title=frame.get('title', 'unknown'), iso=frame.get('iso'),
+                         frame=frame.get('frame', False), basedir=frame.get('basedir', '.'))
+    return dirname, (imb if imb.mode == 'RGB' else imb.convert('RGB')).tobytes()
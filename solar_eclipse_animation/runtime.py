@@ -0,0 +1,29 @@
+'''
+the objects that are slow to build or need a heavy import, each made the first time it's asked for and shared by
+the whole process from then on, so importing a module (or the CLI's --help) costs nothing until one is used.  the
+ephemerides are shared the same way by skyfieldcalcs.load_ephemeris and the image renderers (one per thread) by
+imaging.get_renderer.
+'''
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def timescale():
+    '''
+    :return: skyfield Timescale, from the leap second and delta T tables built into skyfield
+    '''
+    from skyfield.api import load
+    return load.timescale()
+
+
+@lru_cache(maxsize=None)
+def timezone_finder():
+    from timezonefinder import TimezoneFinder
+    return TimezoneFinder()
+
+
+def timezone_at(lat, lon):
+    '''
+    :return: IANA timezone name at lat/lon, None out at sea
+    '''
+    return timezone_finder().timezone_at(lng=lon, lat=lat)
@@ -0,0 +1,110 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from besselian import GEOCENTRIC_LIMIT_DEG, Site, fit_elements
+from runtime import timescale
+from skyfieldcalcs import load_ephemeris
+
+CONTACTS = ['c1', 'c2', 'mid', 'c3', 'c4']
+
+
+def new_moons(jd_start, jd_end):
+    '''
+    true new moons by Meeus's periodic terms (Astronomical Algorithms, chapter 49), the terms dropped here are each
+    under a minute so these are within a couple of minutes of the ephemeris, plenty for a first cut
+    :param jd_start: TT julian date
+    :param jd_end: TT julian date
+    :return: TT julian dates of every new moon between them
+    '''
+    k = np.arange(np.floor((jd_start - 2451550.09766) / 29.530588861), np.ceil((jd_end - 2451550.09766) / 29.530588861) + 1)
+    t = k / 1236.85
+    jde = 2451550.09766 + 29.530588861 * k + 0.00015437 * t ** 2 - 0.000000150 * t ** 3 + 0.00000000073 * t ** 4
+    m = np.radians(2.5534 + 29.10535670 * k - 0.0000014 * t ** 2 - 0.00000011 * t ** 3)
+    mp = np.radians(201.5643 + 385.81693528 * k + 0.0107582 * t ** 2 + 0.00001238 * t ** 3 - 0.000000058 * t ** 4)
+    f = np.radians(160.7108 + 390.67050284 * k - 0.0016118 * t ** 2 - 0.00000227 * t ** 3 + 0.000000011 * t ** 4)
+    omega = np.radians(124.7746 - 1.56375588 * k + 0.0020672 * t ** 2 + 0.00000215 * t ** 3)
+    e = 1 - 0.002516 * t - 0.0000074 * t ** 2
+    jde += (-0.40720 * np.sin(mp) + 0.17241 * e * np.sin(m) + 0.01608 * np.sin(2 * mp) + 0.01039 * np.sin(2 * f)
+            + 0.00739 * e * np.sin(mp - m) - 0.00514 * e * np.sin(mp + m) + 0.00208 * e ** 2 * np.sin(2 * m)
+            - 0.00111 * np.sin(mp - 2 * f) - 0.00057 * np.sin(mp + 2 * f) + 0.00056 * e * np.sin(2 * mp + m)
+            - 0.00042 * np.sin(3 * mp) + 0.00042 * e * np.sin(m + 2 * f) + 0.00038 * e * np.sin(m - 2 * f)
+            - 0.00024 * e * np.sin(2 * mp - m) - 0.00017 * np.sin(omega))
+    return jde[(jde >= jd_start) & (jde <= jd_end)]
+
+
+def eclipse_candidates(eph, jd_start, jd_end, limit_deg=GEOCENTRIC_LIMIT_DEG + 0.1):
+    '''
+    new moons close enough to a node for the Moon to cover some of the Sun from somewhere on Earth, from one pass
+    over the ephemeris for all of them.  the geocentric separation at conjunction is within a fraction of a percent
+    of the least separation (the margin covers that and new_moons' error), the test drops about four in five new
+    moons before any local calculation.
+    :return: TT julian dates of the candidate new moons
+    '''
+    jd = new_moons(jd_start, jd_end)
+    t = timescale().tt_jd(jd)
+    earth = eph['earth'].at(t)
+    separation = earth.observe(eph['moon']).apparent().separation_from(earth.observe(eph['sun']).apparent()).degrees
+    return jd[separation < limit_deg]
+
+
+def search_eclipses(lat, lon, ele=100, start_year=1900, end_year=2100, ephfilename='de430t.bsp', workers=1,
+                    visible=True):
+    '''
+    every solar eclipse seen from a site over a span of years.  new moons are found and prefiltered with the
+    geocentric separation (eclipse_candidates), Besselian elements are then fitted around each candidate and give
+    the site's contacts in closed form, in a second or two per century.
+    :param lat: latitude in degrees (float, positive north, negative south)
+    :param lon: longitude in degrees (float, positive east, negative west)
+    :param ele: elevation in meters
+    :param start_year: first year searched
+    :param end_year: last year searched (inclusive), the ephemeris has to cover the whole span
+    :param workers: number of processes working through the candidates, None for one per core
+    :param visible: only eclipses with the Sun above the horizon at some point between c1 and c4
+    :return: dataframe with one row per eclipse: date (UTC of maximum), kind (partial, annular or total), TT julian
+             dates and UTC ISO strings of the contacts (NaN/None where there is no such contact), magnitude,
+             eclipse_fraction and sun_alt at maximum and whether the eclipse is above the horizon
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    eph = load_ephemeris(ephfilename)
+    candidates = eclipse_candidates(eph, timescale().utc(start_year, 1, 1).tt, timescale().utc(end_year + 1, 1, 1).tt)
+    args = [(jd, lat, lon, ele, ephfilename) for jd in candidates]
+    if workers <= 1 or len(args) <= 1:
+        rows = [_local_eclipse(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(_local_eclipse, *zip(*args), chunksize=max(1, len(args) // (workers * 4))))
+    df = pd.DataFrame([row for row in rows if row is not None],
+                      columns=['date', 'kind'] + CONTACTS + [f'{k}_utc' for k in CONTACTS] +
+                              ['magnitude', 'eclipse_fraction', 'sun_alt', 'above_horizon'])
+    if visible:
+        df = df[df.above_horizon].reset_index(drop=True)
+    return df
+
+
+def _local_eclipse(jd, lat, lon, ele, ephfilename):
+    # one candidate new moon: elements fitted over the hours either side of conjunction and the site's contacts
+    eph = load_ephemeris(ephfilename)
+    elements = fit_elements(eph, jd + np.arange(-30, 31) * 10 / 1440)
+    if elements is None:
+        return None
+    site = Site(lat, lon, ele)
+    contacts = elements.contacts(site)
+    if not np.isfinite(contacts['mid']):
+        return None
+    row = {k: float(contacts[k]) for k in CONTACTS}
+    for k in CONTACTS:
+        row[f'{k}_utc'] = timescale().tt_jd(row[k]).utc_iso() if np.isfinite(row[k]) else None
+    if np.isnan(row['c2']):
+        kind = 'partial'
+    else:
+        kind = 'total' if contacts['magnitude'] >= 1 else 'annular'
+    # the Sun's altitude changes monotonically across the eclipse unless it transits, when maximum is the highest
+    sun_alt = elements.observe(site, [row['c1'], row['mid'], row['c4']]).sun_alt
+    row.update(date=row['mid_utc'][:10], kind=kind, magnitude=float(contacts['magnitude']),
+               eclipse_fraction=float(contacts['eclipse_fraction']), sun_alt=float(contacts['sun_alt']),
+               above_horizon=bool(np.max(sun_alt) > 0))
+    return row
@@ -0,0 +1,422 @@
+'''
+a long running local service that keeps the ephemeris, timescale, timezone finder and decoded images loaded between
+requests, so a lookup costs milliseconds rather than a new process's start up
+
+    GET  /circumstances?lat=35.78&lon=-78.64[&ele=97][&date=20231014][&backend=skyfield]
+         the contacts in UTC and local time with the Sun's altitude, azimuth and obscuration, JSON
+    GET  /frame?lat=35.78&lon=-78.64&time=2023-10-14T17:20:15Z[&ele=97][&quality=preview][&compositor=disk]
+         the frame of the animation at a UTC time, PNG
+    POST /animations  {"lat": 35.78, "lon": -78.64, "name": "Raleigh, NC", "step": 5, "outputs": ["mp4", "gif"]}
+         queues an animation (main), 202 with the job, 503 when the queue is full.  the body has to be sent as
+         application/json (415 otherwise), which a web page can't do without the browser asking first
+    GET  /animations/<id>   a job: queued, running, done (with its mp4) or failed (with the error)
+    GET  /status            uptime, requests, cache hits, coalesced requests and the queue
+
+identical requests arriving while one is being worked on wait for its answer rather than repeating the work, and
+the answers are kept (a bounded number, least recently used dropped first).  an animation asked for again while
+it's queued or running is the same job.
+'''
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from backends import BACKENDS, CONTACTS, get_backend, site_circumstances
+from encoding import output_stem, parse_output
+from runtime import timescale, timezone_at, timezone_finder
+
+ELE = 100  # meters, for a request that doesn't give the elevation
+DATE = '20231014'
+CACHE_SIZE = 1024  # answers kept per kind (circumstances, frames)
+FRAME_CACHE_BYTES = 256 * 2 ** 20  # and the frames kept at most this many bytes of PNG, a 4K frame is several MB
+# what an animation request can set besides lat and lon, passed on to main
+ANIMATION_FIELDS = {'name': str, 'ele': float, 'date': str, 'step': float, 'fps': int, 'quality': str,
+                    'compositor': str, 'backend': str, 'outputs': list}
+
+
+class Coalescer:
+    '''
+    identical calls in flight at the same time share one result: the first computes it, the others wait for it
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.coalesced = 0
+
+    def call(self, key, f, *args, **kwargs):
+        with self._lock:
+            future = self._pending.get(key)
+            first = future is None
+            if first:
+                future = self._pending[key] = Future()
+            else:
+                self.coalesced += 1
+        if first:
+            try:
+                future.set_result(f(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._pending[key]
+        return future.result()
+
+
+class Service:
+    '''
+    everything the requests share: the warm backends and renderers, the answers already given and the animation
+    queue with its worker threads
+    :param queue_size: animations allowed to wait, more are turned away until one starts
+    :param jobs: animations rendered at once
+    :param workers: render processes per animation (main's workers)
+    :param cache_size: answers of each kind and finished animations kept
+    :param frame_cache_bytes: total size of the frames kept, the least recently used dropped first
+    '''
+
+    def __init__(self, ephfilename='de430t.bsp', imagedir='./images', font=None, basedir='.', backend='skyfield',
+                 compositor='pil', queue_size=8, jobs=1, workers=1, cache_size=CACHE_SIZE,
+                 frame_cache_bytes=FRAME_CACHE_BYTES):
+        if backend not in BACKENDS:
+            raise ValueError(f"unsupported backend {backend}")
+        self.ephfilename = ephfilename
+        self.imagedir = imagedir
+        self.font = font
+        self.basedir = basedir
+        self.backend = backend
+        self.compositor = compositor
+        self.workers = workers
+        self.cache_size = cache_size
+        self.frame_cache_bytes = frame_cache_bytes
+        self.started = time.time()
+        self.counters = {'requests': 0, 'cache_hits': 0, 'errors': 0, 'jobs_rejected': 0}
+        self._answers = {'circumstances': OrderedDict(), 'frame': OrderedDict()}
+        self._frame_bytes = 0
+        self._coalescer = Coalescer()
+        self._lock = threading.Lock()
+        self._renderers = {}
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._work, name=f'animation-{n}', daemon=True) for n in range(jobs)]
+        for thread in self._threads:
+            thread.start()
+
+    def warm(self, quality='preview'):
+        '''
+        loads what the first request would otherwise wait for: the timescale, the timezone finder, the ephemeris
+        and the images at one quality
+        '''
+        timescale()
+        timezone_finder()
+        get_backend(self.backend, ephfilename=self.ephfilename)
+        self.renderer(quality, self.compositor)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def cached(self, kind, key, f, *args, **kwargs):
+        '''
+        a kept answer, else f's, computed once however many identical requests are waiting on it
+        '''
+        answers = self._answers[kind]
+        with self._lock:
+            if key in answers:
+                answers.move_to_end(key)
+                self.counters['cache_hits'] += 1
+                return answers[key]
+        answer = self._coalescer.call((kind, key), f, *args, **kwargs)
+        with self._lock:
+            if key not in answers:  # the requests that waited on it put it back too
+                answers[key] = answer
+                if kind == 'frame':
+                    self._frame_bytes += len(answer)
+            while answers and (len(answers) > self.cache_size or
+                               (kind == 'frame' and self._frame_bytes > self.frame_cache_bytes)):
+                _, dropped = answers.popitem(last=False)
+                if kind == 'frame':
+                    self._frame_bytes -= len(dropped)
+        return answer
+
+    def circumstances(self, lat, lon, ele=ELE, date=DATE, backend=None):
+        backend = backend or self.backend
+        _check_site(lat, lon)
+        if backend not in BACKENDS:
+            raise ValueError(f"unsupported backend {backend}")
+        return self.cached('circumstances', (date, lat, lon, ele, backend), site_circumstances, date, lat, lon,
+                           ele=ele, backend=backend, ephfilename=self.ephfilename)
+
+    def renderer(self, quality='final', compositor=None):
+        '''
+        the service's own renderer for a quality and compositor, with a lock, apart from the ones animations use
+        '''
+        from imaging import COMPOSITORS, QUALITY, asset_pyramid
+        compositor = compositor or self.compositor
+        if quality not in QUALITY:
+            raise ValueError(f"unsupported quality {quality}")
+        if compositor not in COMPOSITORS:
+            raise ValueError(f"unsupported compositor {compositor}")
+        with self._lock:
+            if (quality, compositor) not in self._renderers:
+                renderer = COMPOSITORS[compositor](asset_pyramid(self.imagedir, quality), fontfile=self.font,
+                                                   fontsize=round(100 * QUALITY[quality]['scale']))
+                self._renderers[quality, compositor] = (renderer, threading.Lock())
+            return self._renderers[quality, compositor]
+
+    def frame(self, lat, lon, utc, ele=ELE, quality='final', compositor=None, backend=None):
+        '''
+        :param utc: timezone aware datetime
+        :return: PNG bytes of the frame at utc, labelled as the animation's would be
+        '''
+        backend = backend or self.backend
+        compositor = compositor or self.compositor
+        _check_site(lat, lon)
+        key = (lat, lon, ele, utc.isoformat(), quality, compositor, backend)
+        return self.cached('frame', key, self._frame, lat, lon, utc, ele, quality, compositor, backend)
+
+    def _frame(self, lat, lon, utc, ele, quality, compositor, backend):
+        from frameplan import frame_plan
+        renderer, lock = self.renderer(quality, compositor)
+        date = utc.strftime('%Y%m%d')
+        # the contacts of the day so a frame at one is labelled with it
+        contacts = {c['contact']: c['jd'] for c in self.circumstances(lat, lon, ele, date, backend)['contacts']}
+        jd = timescale().from_datetime(utc).tt
+        table = get_backend(backend, ephfilename=self.ephfilename).table(lat, lon, ele, [jd])
+        plan = frame_plan(table, {k: contacts.get(k) for k in CONTACTS}, timezone_at(lat, lon) or 'UTC',
+                          labels=self.font is not None)
+        frame = next(iter(plan))
+        with lock:
+            image = renderer.render(frame['sun_radius'], frame['moon_radius'], frame['moon_alt_delta_deg'],
+                                    frame['moon_az_delta_deg'], label_ll=frame['label_ll'], label_lr=frame['label_lr'])
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def submit(self, request):
+        '''
+        queues an animation, or finds the same one already queued or running
+        :param request: dict of lat, lon and ANIMATION_FIELDS
+        :return: the job (a dict), whether it was already there
+        '''
+        unknown = set(request) - set(ANIMATION_FIELDS) - {'lat', 'lon'}
+        if unknown:
+            raise ValueError(f"unsupported fields {', '.join(sorted(unknown))}")
+        options = {'lat': float(request['lat']), 'lon': float(request['lon'])}
+        _check_site(options['lat'], options['lon'])
+        outputs = request.get('outputs')
+        if outputs is not None:
+            # checked now, so a bad one is the request's error rather than the job's
+            if not outputs or not isinstance(outputs, list) or not all(isinstance(spec, str) for spec in outputs):
+                raise ValueError('outputs must be a list of formats, e.g. ["mp4", "gif:480@10"]')
+            for spec in outputs:
+                parse_output(spec)
+        options.update({k: convert(request[k]) for k, convert in ANIMATION_FIELDS.items()
+                        if request.get(k) is not None})
+        options.setdefault('name', f"{options['lat']:.2f}_{options['lon']:.2f}")
+        _check_name(options['name'])
+        options.setdefault('date', DATE)
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            for job in self._jobs.values():
+                if job['key'] == key and job['status'] in ['queued', 'running']:
+                    return job, True
+            job = {'id': uuid.uuid4().hex[:12], 'key': key, 'status': 'queued', 'options': options, 'mp4': None,
+                   'report': None, 'error': None, 'submitted': time.time(), 'seconds': None}
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.counters['jobs_rejected'] += 1
+                raise
+            self._jobs[job['id']] = job
+        return job, False
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        from main import main
+        while True:
+            job = self._queue.get()
+            options = dict(job['options'])
+            date = options.pop('date')
+            options.setdefault('ele', ELE)
+            options.setdefault('backend', self.backend)
+            options.setdefault('compositor', self.compositor)
+            started = time.perf_counter()
+            job['status'] = 'running'
+            try:
+                mp4 = main(year=int(date[:4]), month=int(date[4:6]), day=int(date[6:8]), font=self.font,
+                           ephfilename=self.ephfilename, basedir=self.basedir, imagedir=self.imagedir,
+                           workers=self.workers, **options)
+                job.update(status='done', mp4=mp4, report=f"{output_stem(mp4)}.report.json")
+            except Exception as e:
+                job.update(status='failed', error=f"{type(e).__name__}: {e}")
+                traceback.print_exc()
+            finally:
+                job['seconds'] = time.perf_counter() - started
+                with self._lock:
+                    self._jobs.move_to_end(job['id'])
+                    self._forget()
+                self._queue.task_done()
+
+    def _forget(self):
+        # the finished jobs are kept like the answers, at most cache_size of them, the longest finished dropped
+        # first, those queued or running always are
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ['done', 'failed']]
+        for job_id in finished[:max(0, len(finished) - self.cache_size)]:
+            del self._jobs[job_id]
+
+    def status(self):
+        with self._lock:
+            jobs = [job['status'] for job in self._jobs.values()]
+            return {'uptime_seconds': time.time() - self.started, **self.counters,
+                    'coalesced': self._coalescer.coalesced,
+                    'cached': {kind: len(answers) for kind, answers in self._answers.items()},
+                    'cached_frame_bytes': self._frame_bytes,
+                    'queue': {'waiting': self._queue.qsize(), 'size': self._queue.maxsize,
+                              **{s: jobs.count(s) for s in ['queued', 'running', 'done', 'failed']}}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'solar_eclipse_animation'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        service = self.server.service
+        service.count('requests')
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        query = dict(parse_qsl(url.query))
+        try:
+            if method == 'GET' and path == '/circumstances':
+                self._json(200, service.circumstances(_float(query, 'lat'), _float(query, 'lon'),
+                                                      ele=_float(query, 'ele', ELE), date=query.get('date', DATE),
+                                                      backend=query.get('backend')))
+            elif method == 'GET' and path == '/frame':
+                png = service.frame(_float(query, 'lat'), _float(query, 'lon'), _utc(query),
+                                    ele=_float(query, 'ele', ELE), quality=query.get('quality', 'final'),
+                                    compositor=query.get('compositor'), backend=query.get('backend'))
+                self._send(200, png, 'image/png')
+            elif method == 'POST' and path == '/animations':
+                if self.headers.get_content_type() != 'application/json':
+                    service.count('errors')
+                    self._json(415, {'error': 'an animation is requested with a JSON body (application/json)'})
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"request is not JSON: {e}") from e
+                try:
+                    job, existing = service.submit(request)
+                except queue.Full:
+                    self._json(503, {'error': 'the animation queue is full, try again later'}, {'Retry-After': '30'})
+                    return
+                except KeyError as e:
+                    raise ValueError(f"missing {e.args[0]}") from e
+                self._json(200 if existing else 202, _public(job), {'Location': f"/animations/{job['id']}"})
+            elif method == 'GET' and path.startswith('/animations/'):
+                job = service.job(path.rsplit('/', 1)[1])
+                if job is None:
+                    self._json(404, {'error': f"no animation {path.rsplit('/', 1)[1]}"})
+                else:
+                    self._json(200, _public(job))
+            elif method == 'GET' and path == '/status':
+                self._json(200, service.status())
+            else:
+                self._json(404, {'error': f"no {method} {url.path}"})
+        except ValueError as e:
+            service.count('errors')
+            self._json(400, {'error': str(e)})
+        except Exception as e:
+            service.count('errors')
+            traceback.print_exc()
+            self._json(500, {'error': f"{type(e).__name__}: {e}"})
+
+    def _json(self, code, body, headers=None):
+        self._send(code, json.dumps(body, indent=1, default=str).encode(), 'application/json', headers)
+
+    def _send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # a Unix socket's clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address, 0
+
+
+def make_server(service, host='127.0.0.1', port=8023, socket=None):
+    '''
+    :param socket: path of a Unix socket to listen on rather than host and port
+    :return: the server, serve_forever() to run it
+    '''
+    server = UnixHTTPServer(socket, Handler) if socket else ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    return server
+
+
+def _check_site(lat, lon):
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        raise ValueError(f"latitude must be -90 to 90 and longitude -180 to 180, not {lat}, {lon}")
+
+
+def _check_name(name):
+    # the name is the animation's directory and file names, it can't lead out of basedir
+    if not name.strip() or any(part in name for part in ['/', '\\', '..', '\0']):
+        raise ValueError(f"name can't be empty or have /, \\ or .. in it, not {name!r}")
+
+
+def _float(query, name, default=None):
+    if name not in query:
+        if default is None:
+            raise ValueError(f"missing {name}")
+        return default
+    try:
+        return float(query[name])
+    except ValueError:
+        raise ValueError(f"{name} must be a number, not {query[name]}") from None
+
+
+def _utc(query):
+    if 'time' not in query:
+        raise ValueError('missing time')
+    try:
+        utc = datetime.fromisoformat(query['time'].replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"time must be ISO 8601, not {query['time']}") from None
+    return utc.replace(tzinfo=dt_timezone.utc) if utc.tzinfo is None else utc.astimezone(dt_timezone.utc)
+
+
+def _public(job):
+    return {k: v for k, v in job.items() if k != 'key'}
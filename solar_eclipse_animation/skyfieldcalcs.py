@@ -1,15 +1,42 @@
-import pandas as pd
-from skyfield import api
-from skyfield.api import Loader
+import os
+import tempfile
+import threading
+
+import numpy as np
+from jplephem.excerpter import write_excerpt
+from skyfield.api import Loader, load_file
 import math
 from skyfield.api import wgs84
 
-ts = api.load.timescale()
-pd.set_option('display.max_rows', None)
+from runtime import timescale
 
 MOON_RADIUS_KM = 1737.4
 SUN_RADIUS_KM = 695700
 
+# centralize local caching of ephemeris files, SOLAR_ECLIPSE_DATA moves it (and the caches kept alongside it)
+EPHEMERIS_PATH = os.environ.get('SOLAR_ECLIPSE_DATA', '/var/data')
+DEFAULT_EPHEMERIS = 'de430t.bsp'
+# SPK targets needed to observe the Sun and Moon from Earth: the Sun, Earth-Moon barycenter, Earth, Moon,
+# plus the Jupiter and Saturn barycenters skyfield's apparent() uses for light deflection
+ECLIPSE_TARGETS = (10, 3, 399, 301, 5, 6)
+
+_ephemerides = {}
+_ephemerides_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # ts, the shared timescale, is only built when something uses it (runtime.timescale)
+    if name == 'ts':
+        return timescale()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _pandas():
+    # pandas is only imported for the rows and dataframes, the numpy columns and contact solvers don't need it
+    import pandas as pd
+    pd.set_option('display.max_rows', None)
+    return pd
+
 
 def eclipse_fraction(s, body1, body2):
     '''
@@ -41,6 +68,37 @@ def eclipse_fraction(s, body1, body2):
     return eclipse_fraction
 
 
+def eclipse_fraction_array(s, body1, body2):
+    '''
+    array version of eclipse_fraction, evaluates every element of the inputs at once rather than one row at a time
+    handles the same three cases: no overlap, partial (lune) and annular/total containment
+    :param s: separations in degrees (array-like)
+    :param body1: foreground body radii in degrees (Moon, array-like or scalar)
+    :param body2: background body radii in degrees (Sun, array-like or scalar)
+    :return: numpy array of the fraction of body2 covered by body1
+    '''
+    s, body1, body2 = np.broadcast_arrays(np.asarray(s, dtype=float),
+                                          np.asarray(body1, dtype=float),
+                                          np.asarray(body2, dtype=float))
+    fraction = np.zeros(s.shape)
+
+    overlapping = s < (body1 + body2)
+    a = (body2 + body1 + s) * (body1 + s - body2) * (s + body2 - body1) * (body2 + body1 - s)
+    lune = overlapping & (a > 0)
+    contained = overlapping & ~lune
+
+    # partial eclipse, the Moon's limb crosses the Sun's
+    s_l, b1, b2 = s[lune], body1[lune], body2[lune]
+    lunedelta = 0.25 * np.sqrt(a[lune])
+    lune_area = 2 * lunedelta + b2 * b2 * np.arccos((b1 * b1 - b2 * b2 - s_l * s_l) / (2 * b2 * s_l)) \
+        - b1 * b1 * np.arccos((b1 * b1 + s_l * s_l - b2 * b2) / (2 * b1 * s_l))
+    fraction[lune] = 1 - (lune_area / (np.pi * b2 * b2))
+
+    # one disk inside the other, total when the Moon is the larger, annular otherwise
+    fraction[contained] = np.minimum((body1[contained] / body2[contained]) ** 2, 1)
+    return fraction
+
+
 def apparent_radius(df):
     for label in ['moon', 'sun']:
         if label == 'moon':
@@ -51,7 +109,6 @@ def apparent_radius(df):
             raise ValueError(f"unsupported body {label}")
         from numpy import arcsin
         df[f'{label}_r'] = 180.0 / math.pi * arcsin(equitorial_radius / df[f'{label}_dist'])
-    df['ratio'] = df.moon_r / df.sun_r
 
 
 def alt_az_dist(df, body, label):
@@ -61,7 +118,8 @@ def alt_az_dist(df, body, label):
     df[f'{label}_dist'] = distance.km
 
 
-def circumstances(start, lat, lon, ele=100, end=None, tzstring=None, eph=None, ephfilename=None):
+def circumstances(start, lat, lon, ele=100, end=None, tzstring=None, eph=None, ephfilename=None, refine=False,
+                  columnar=False, debug=False, backend='skyfield'):
     '''
     Calculates local circumstances of an eclipse returning datetimes (UTC) for partial
     eclipse contact points (c1 and c4), the moment of maxium eclipse, along with contact
@@ -75,6 +133,14 @@ def circumstances(start, lat, lon, ele=100, end=None, tzstring=None, eph=None, e
     :param ele: elevation in meters (int)
     :param end: date and time to end search (datetime, default None)
     :param tzstring: converts UTC to local for all datetimes (optional, example 'US/Eastern')
+    :param refine: when True the contact points come from solve_contacts (sub-second) rather than the
+                   nearest minute of the grid, the dataframe is unchanged
+    :param columnar: return the CircumstancesTable itself rather than a dataframe built from it
+    :param debug: include the Time objects (tt) and DMS string columns in the dataframe
+    :param backend: 'skyfield' observes the Sun and Moon from the site at every time, 'besselian' evaluates
+                    Besselian elements fitted once per eclipse (see besselian.py), much faster, the same to a small
+                    fraction of a second, and the rows only cover the hours an eclipse can be seen from somewhere.
+                    'astronomy' (astronomy-engine) and 'ephem' (PyEphem) need no SPK file, see backends.py
     :return: for each of the 5 circumstances, a pandas series is returned:
         a da
 
@@ -87,61 +153,197 @@ def circumstances(start, lat, lon, ele=100, end=None, tzstring=None, eph=None, e
     '''
 
     day, hour, minute, month, second, year = get_ints_for_dt_params(start)
-    if eph is None:
-        eph = load_ephemeris(ephfilename)
     if end is None:
         # all we have is a day, so let look across all minutes across a
         # 2 day span centered on noon UTC on the day passed
-        time = ts.utc(year, month, day, 12, range(-1440, 1440))
+        time = timescale().utc(year, month, day, 12, range(-1440, 1440))
     else:
         # second level resolution across entire eclipse
         timespan_sec = (end - start) * 86400
         startsec = int(second) - 300  # 1 minutes before C1
         endsec = int(second + 300 + timespan_sec)  # 1 minute after C4
-        time = ts.utc(year, month, day, hour, minute, range(startsec, endsec))
-
-    # build data frame from those times
-    df = pd.DataFrame({
-        # 'ordinal': time.toordinal(),  # needed really only for testing against other calculations
-        'utc_iso': time.utc_iso(),
-        'tt': list(time),
-        'jd': list(time.tt),
-    })
+        time = timescale().utc(year, month, day, hour, minute, range(startsec, endsec))
+
+    if backend != 'skyfield':
+        from backends import BACKENDS, get_backend
+        if backend not in BACKENDS:
+            raise ValueError(f"unsupported backend {backend}")
+        # only the backends built on skyfield open the ephemeris
+        if BACKENDS[backend].needs_spk and eph is None:
+            eph = load_ephemeris(ephfilename)
+        return _backend_circumstances(get_backend(backend, eph=eph), start, lat, lon, ele, time, refine, columnar, debug)
+    if eph is None:
+        eph = load_ephemeris(ephfilename)
 
     place = eph['earth'] + wgs84.latlon(lat, lon, elevation_m=ele)
+    table = observe(eph, place, time)
+
+    # now we can find when the partial (and if applicable total or annular) eclipses begin and end as well as the midpoint
+    c1, c2, mid_eclipse, c3, c4 = contact_points(table)
+
+    if refine and c1 is not None:
+        # replace the nearest minute with sub-second contact times
+        c1, c2, mid_eclipse, c3, c4 = solve_contacts(start, lat, lon, ele=ele, eph=eph, place=place)
+    if columnar:
+        return c1, c2, mid_eclipse, c3, c4, table
+    return c1, c2, mid_eclipse, c3, c4, table.to_frame(debug=debug)
+
+
+def _backend_circumstances(backend, start, lat, lon, ele, time, refine, columnar, debug):
+    # circumstances from one of backends.BACKENDS, the same steps as the skyfield path
+    table = backend.table(lat, lon, ele, time.tt)
+    c1, c2, mid_eclipse, c3, c4 = _table_contact_points(table)
+    if refine and c1 is not None:
+        contacts = backend.contacts(start, lat, lon, ele)
+        labels = [k for k in ['c1', 'c2', 'mid', 'c3', 'c4'] if contacts[k] is not None]
+        rows = backend.table(lat, lon, ele, np.array([contacts[k] for k in labels]))
+        rows = {k: rows.row(n) for n, k in enumerate(labels)}
+        c1, c2, mid_eclipse, c3, c4 = (rows.get(k) for k in ['c1', 'c2', 'mid', 'c3', 'c4'])
+    if columnar:
+        return c1, c2, mid_eclipse, c3, c4, table
+    return c1, c2, mid_eclipse, c3, c4, table.to_frame(debug=debug)
+
+
+def observe(eph, place, time):
+    '''
+    positions of the Sun and Moon as seen from a place at each of the times passed
+    :param eph: ephemeris (from load_ephemeris)
+    :param place: observer, eph['earth'] plus a wgs84 position
+    :param time: skyfield Time array
+    :return: CircumstancesTable, one row per time
+    '''
+    table = CircumstancesTable(time.tt)
 
     # get position of Moon and Sun at each time
     moon = place.at(time).observe(eph['moon']).apparent()
     sun = place.at(time).observe(eph['sun']).apparent()
 
     # add a column for angular separation of the Moon and Sun
-    df['separation'] = moon.separation_from(sun).degrees
+    table['separation'] = moon.separation_from(sun).degrees
 
     # lets get the lunar and solar distance... that might be useful
-    alt_az_dist(df, moon, 'moon')
-    alt_az_dist(df, sun, 'sun')
+    alt_az_dist(table, moon, 'moon')
+    alt_az_dist(table, sun, 'sun')
 
     # and the apparant radius, which provides the ratio, we'll need that
-    apparent_radius(df)
-
-    for a in ['sun', 'moon']:
-        df[f'{a}_d_dms'] = df.apply(lambda x: decdeg2dms(x[f'{a}_r']*2), axis=1)
-        for b in ['alt', 'az']:
-            df[f'{a}_{b}_dms'] = df.apply(lambda x: decdeg2dms(x[f'{a}_{b}']), axis=1)
-    df['combined_rs']=df.apply(lambda x: x.sun_r + x.moon_r, axis=1)
-    df['sepdelta'] = df.apply(lambda x: (x.separation - x.combined_rs)*1000, axis=1)
+    apparent_radius(table)
 
     # calculate how much of the Sun's disk is eclipsed by the Moon
-    df['eclipse_fraction'] = df.apply(lambda x: eclipse_fraction(x['separation'], x['moon_r'], x['sun_r']), axis=1)
+    table['eclipse_fraction'] = eclipse_fraction_array(table.separation, table.moon_r, table.sun_r)
+    return table
 
-    # now we can find when the partial (and if applicable total or annular) eclipses begin and end as well as the midpoint
-    c1, c2, mid_eclipse, c3, c4 = contact_points(df)
 
-    if end is None and c1 is not None and False:
-        # repeat at second resolution from C1 to C4
-        c1, c2, mid_eclipse, c3, c4, df = circumstances(c1.tt, lat, lon, end=c4.tt, eph=eph,
-                                                        ele=ele)  # refine at higher resolution
-    return c1, c2, mid_eclipse, c3, c4, df
+class CircumstancesTable:
+    '''
+    columnar local circumstances, one numpy array per column rather than a dataframe of python objects.
+    alt and az are stored as float32, everything the contact points depend on as float64.
+    utc_iso, tt and the DMS string columns are only built when asked for, then cached.
+
+        table['moon_alt']       numpy array
+        table.moon_alt          same
+        table['moon_alt_dms']   list of strings, formatted on first use
+        table[table.eclipse_fraction > 0]  a new table with just those rows
+    '''
+    compact = ['moon_alt', 'moon_az', 'sun_alt', 'sun_az']
+    derived = {
+        'ratio': lambda t: t.moon_r / t.sun_r,
+        'combined_rs': lambda t: t.sun_r + t.moon_r,
+        'sepdelta': lambda t: (t.separation - (t.sun_r + t.moon_r)) * 1000,
+        'rdiff': lambda t: t.sun_r - t.moon_r,
+        'sun_d': lambda t: 2 * t.sun_r,
+        'moon_d': lambda t: 2 * t.moon_r,
+    }
+
+    def __init__(self, jd, columns=None):
+        self.__dict__['_columns'] = {'jd': np.asarray(jd, dtype=np.float64)}
+        self.__dict__['_lazy'] = {}
+        for name, values in (columns or {}).items():
+            self[name] = values
+
+    def __len__(self):
+        return len(self._columns['jd'])
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __setitem__(self, name, values):
+        dtype = np.float32 if name in self.compact else np.float64
+        self._columns[name] = np.asarray(values, dtype=dtype)
+        self._lazy.clear()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self._columns:
+                return self._columns[key]
+            if key in self.derived:
+                return self.derived[key](self)
+            if key not in self._lazy:
+                self._lazy[key] = self._build(key)
+            return self._lazy[key]
+        return CircumstancesTable(self._columns['jd'][key],
+                                  {name: values[key] for name, values in self._columns.items() if name != 'jd'})
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, values):
+        self[name] = values
+
+    def _build(self, key):
+        if key == 'tt':
+            return timescale().tt_jd(self._columns['jd'])
+        if key == 'utc_iso':
+            return self['tt'].utc_iso()
+        if key.endswith('_d_dms'):
+            return [decdeg2dms(v) for v in 2 * self[f"{key[:-6]}_r"]]
+        if key.endswith('_dms'):
+            return [decdeg2dms(float(v)) for v in self[key[:-4]]]
+        raise KeyError(key)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self._columns.values())
+
+    def row(self, n):
+        '''
+        a single row as a pandas series, the same shape as a row of the circumstances dataframe
+        '''
+        one = self[n:n + 1]
+        values = {'utc_iso': one['utc_iso'][0], 'tt': one['tt'][0]}
+        values.update({name: column[0].item() for name, column in one._columns.items()})
+        values.update({name: float(f(one)[0]) for name, f in self.derived.items() if self._has_inputs()})
+        return _pandas().Series(values, name=n)
+
+    def to_frame(self, debug=False):
+        '''
+        a pandas dataframe of the same columns, tt and the DMS strings are only included when debug is True
+        '''
+        df = _pandas().DataFrame({'utc_iso': self['utc_iso']})
+        if debug:
+            df['tt'] = list(self['tt'])
+        for name, values in self._columns.items():
+            df[name] = values
+        if self._has_inputs():
+            for name, f in self.derived.items():
+                df[name] = f(self)
+        if debug:
+            for a in ['sun', 'moon']:
+                df[f'{a}_d_dms'] = self[f'{a}_d_dms']
+                for b in ['alt', 'az']:
+                    df[f'{a}_{b}_dms'] = self[f'{a}_{b}_dms']
+        return df
+
+    def _has_inputs(self):
+        return all(name in self._columns for name in ['separation', 'sun_r', 'moon_r'])
 
 
 def decdeg2dms(dd):
@@ -169,9 +371,11 @@ def contact_points(df):
     mid eclipse: mid point between c2 and c3, generally the best point to view the corona.
     c3: end of total eclipse
     c4: end of partial eclipse
-    :param df: the dataframe containing timestamps separation and fraction of the Sun eclipsed by the Moon
+    :param df: the dataframe (or CircumstancesTable) containing timestamps separation and fraction of the Sun eclipsed by the Moon
     :return: rows for c1, c2, max_eclipse, c3, c4, and a dataframe sliced with just rows where the Sun is eclipsed.
     '''
+    if isinstance(df, CircumstancesTable):
+        return _table_contact_points(df)
     df_eclipsed = df[(df.eclipse_fraction > 0)]
     max_eclipse_fraction = df.eclipse_fraction.max()
     df_eclipsed_max = df[(df.eclipse_fraction == max_eclipse_fraction)]
@@ -190,7 +394,229 @@ def contact_points(df):
     return c1, c2, mid_eclipse, c3, c4
 
 
-def load_ephemeris(de='de430t.bsp'):
-    load = Loader("/var/data")  # centralize local caching of ephemeris files
-    eph = load(de)
-    return eph
\ No newline at end of file
+def _table_contact_points(table):
+    # same selection as contact_points, on the numpy columns
+    eclipsed = np.flatnonzero(table.eclipse_fraction > 0)
+    anutot = np.flatnonzero((table.sun_r - table.moon_r) > table.separation)
+    c1, c2, mid_eclipse, c3, c4 = None, None, None, None, None
+    if len(eclipsed) > 0:
+        c1 = table.row(eclipsed[np.argmin(table.jd[eclipsed])])
+        c4 = table.row(eclipsed[np.argmax(table.jd[eclipsed])])
+        if len(anutot) > 0:
+            c2 = table.row(anutot[np.argmin(table.jd[anutot])])
+            c3 = table.row(anutot[np.argmax(table.jd[anutot])])
+        mid_eclipse = table.row(int(np.argmin(table.separation)))
+    return c1, c2, mid_eclipse, c3, c4
+
+
+def solve_contacts(start, lat, lon, ele=100, eph=None, ephfilename=None, place=None,
+                   step_minutes=20, tolerance_seconds=0.05):
+    '''
+    sub-second contact points from a handful of ephemeris evaluations rather than a dense grid.
+    the minimum separation is bracketed on a coarse grid across the same 2 day span circumstances
+    searches and refined, each contact is then bracketed between the coarse grid and that minimum and
+    found by root-finding.
+    :param start: skyfield Time, the day of the eclipse
+    :param lat: latitude in degrees (float, positive north, negative south)
+    :param lon: longitude in degrees (float, positive east, negative west)
+    :param ele: elevation in meters (int)
+    :param place: observer, computed from lat, lon and ele when not passed
+    :param step_minutes: coarse grid spacing, must be shorter than the partial eclipse
+    :param tolerance_seconds: how closely each time is refined
+    :return: rows for c1, c2, max_eclipse, c3, c4 (same columns as circumstances), None where there is no such contact
+    '''
+    day, hour, minute, month, second, year = get_ints_for_dt_params(start)
+    if eph is None:
+        eph = load_ephemeris(ephfilename)
+    if place is None:
+        place = eph['earth'] + wgs84.latlon(lat, lon, elevation_m=ele)
+    moon, sun = eph['moon'], eph['sun']
+
+    def evaluate(jd):
+        t = timescale().tt_jd(jd)
+        observer = place.at(t)
+        m = observer.observe(moon).apparent()
+        s = observer.observe(sun).apparent()
+        moon_r = np.degrees(np.arcsin(MOON_RADIUS_KM / m.distance().km))
+        sun_r = np.degrees(np.arcsin(SUN_RADIUS_KM / s.distance().km))
+        return m.separation_from(s).degrees, moon_r, sun_r
+
+    noon = timescale().utc(year, month, day, 12).tt
+    contacts = find_contacts(evaluate, noon - 1, noon + 1, step_minutes / 1440, tolerance_seconds / 86400)
+    if contacts['mid'] is None:
+        return None, None, None, None, None
+    labels = [k for k in ['c1', 'c2', 'mid', 'c3', 'c4'] if contacts[k] is not None]
+    table = observe(eph, place, timescale().tt_jd(np.array([contacts[k] for k in labels])))
+    rows = {k: table.row(n) for n, k in enumerate(labels)}
+    return tuple(rows.get(k) for k in ['c1', 'c2', 'mid', 'c3', 'c4'])
+
+
+def find_contacts(evaluate, jd_start, jd_end, step, tolerance):
+    '''
+    brackets and refines the contact points of an eclipse for any source of Sun/Moon positions
+    :param evaluate: function taking an array of julian dates returning arrays of separation, moon radius and sun radius (degrees)
+    :param jd_start: start of the search
+    :param jd_end: end of the search
+    :param step: coarse grid spacing (days)
+    :param tolerance: convergence (days)
+    :return: dict of julian dates for c1, c2, mid, c3, c4 (None when not applicable)
+    '''
+    contacts = dict.fromkeys(['c1', 'c2', 'mid', 'c3', 'c4'])
+    jd = np.arange(jd_start, jd_end + step, step)
+    separation, moon_r, sun_r = evaluate(jd)
+    n = int(np.argmin(separation))
+
+    def separation_at(t):
+        return evaluate(np.array([t]))[0][0]
+
+    # maximum eclipse, minimum separation between the neighbouring grid points
+    mid = _golden_section(separation_at, jd[max(n - 1, 0)], jd[min(n + 1, len(jd) - 1)], tolerance)
+    sep, m_r, s_r = (x[0] for x in evaluate(np.array([mid])))
+    if sep >= m_r + s_r:
+        return contacts  # no eclipse from here
+    contacts['mid'] = mid
+
+    def partial(t):
+        sep, m_r, s_r = (x[0] for x in evaluate(np.array([t])))
+        return sep - (m_r + s_r)
+
+    def central(t):
+        sep, m_r, s_r = (x[0] for x in evaluate(np.array([t])))
+        return sep - abs(s_r - m_r)
+
+    # walk out along the coarse grid to bracket the beginning and end of the partial eclipse
+    partial_grid = separation - (moon_r + sun_r)
+    before = n
+    while before > 0 and partial_grid[before] < 0:
+        before -= 1
+    after = n
+    while after < len(jd) - 1 and partial_grid[after] < 0:
+        after += 1
+    contacts['c1'] = _false_position(partial, jd[before], mid, tolerance)
+    contacts['c4'] = _false_position(partial, mid, jd[after], tolerance)
+
+    # annular or total only if the disks are concentric enough at maximum
+    if sep < abs(s_r - m_r):
+        contacts['c2'] = _false_position(central, contacts['c1'], mid, tolerance)
+        contacts['c3'] = _false_position(central, mid, contacts['c4'], tolerance)
+    return contacts
+
+
+def _golden_section(f, a, b, tolerance):
+    invphi = (math.sqrt(5) - 1) / 2
+    c = b - (b - a) * invphi
+    d = a + (b - a) * invphi
+    fc, fd = f(c), f(d)
+    while abs(b - a) > tolerance:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - (b - a) * invphi
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + (b - a) * invphi
+            fd = f(d)
+    return (a + b) / 2
+
+
+def _false_position(f, a, b, tolerance):
+    # Illinois variant of regula falsi, f(a) and f(b) must differ in sign
+    fa, fb = f(a), f(b)
+    side = 0
+    c = a
+    for _ in range(100):
+        previous, c = c, (a * fb - b * fa) / (fb - fa)
+        if abs(c - previous) < tolerance:
+            break
+        fc = f(c)
+        if fc * fb > 0:
+            b, fb = c, fc
+            if side == -1:
+                fa /= 2
+            side = -1
+        elif fa * fc > 0:
+            a, fa = c, fc
+            if side == 1:
+                fb /= 2
+            side = 1
+        else:
+            break
+    return c
+
+
+def load_ephemeris(de=DEFAULT_EPHEMERIS, path=EPHEMERIS_PATH, start=None, end=None):
+    '''
+    process-wide cache of ephemeris handles keyed by path and file name, each kernel is opened once
+    and its segments are memory-mapped by jplephem so pages are shared and only read as they are used.
+    :param de: SPK file name, downloaded into path by skyfield the first time
+    :param path: directory holding the ephemeris files
+    :param start: optional julian date (TT) or skyfield Time, with end loads an excerpt holding only the Sun, Earth
+                  and Moon segments (see excerpt_ephemeris) so the handle stays small
+    :param end: optional julian date (TT) or skyfield Time
+    :return: skyfield SpiceKernel
+    '''
+    if de is None:
+        de = DEFAULT_EPHEMERIS
+    if start is not None and end is not None:
+        de = excerpt_ephemeris(de, start, end, path=path)
+    key = (os.path.abspath(path), de)
+    with _ephemerides_lock:
+        eph = _ephemerides.get(key)
+        if eph is None:
+            if os.path.isabs(de):
+                eph = load_file(de)
+            else:
+                load = Loader(path)
+                eph = load(de)
+            _ephemerides[key] = eph
+    return eph
+
+
+def preload_ephemeris(de=DEFAULT_EPHEMERIS, path=EPHEMERIS_PATH, start=None, end=None):
+    '''
+    loads an ephemeris into the cache and maps each segment now rather than on the first observation,
+    call before forking worker processes so they share the handle
+    '''
+    eph = load_ephemeris(de, path=path, start=start, end=end)
+    for segment in eph.segments:
+        spk_segment = segment.spk_segment
+        spk_segment.compute((spk_segment.start_jd + spk_segment.end_jd) / 2)
+    return eph
+
+
+def clear_ephemeris_cache():
+    with _ephemerides_lock:
+        for eph in _ephemerides.values():
+            eph.close()
+        _ephemerides.clear()
+
+
+def excerpt_ephemeris(de, start, end, path=EPHEMERIS_PATH, targets=ECLIPSE_TARGETS):
+    '''
+    writes (once) an SPK excerpt of de covering start to end with just the segments for targets
+    :param de: SPK file name in path, or an absolute path
+    :param start: julian date (TT) or skyfield Time, widened to whole days
+    :param end: julian date (TT) or skyfield Time, widened to whole days
+    :param path: directory holding the ephemeris files, excerpts go in path/excerpts
+    :param targets: NAIF ids of the segments to keep
+    :return: absolute path of the excerpt
+    '''
+    start_jd = math.floor(getattr(start, 'tt', start) - 0.5) + 0.5
+    end_jd = math.ceil(getattr(end, 'tt', end) - 0.5) + 0.5
+    dirname = os.path.join(path, 'excerpts')
+    filename = os.path.join(dirname, f"{os.path.splitext(os.path.basename(de))[0]}_{start_jd:.1f}_{end_jd:.1f}.bsp")
+    if os.path.isfile(filename):
+        return filename
+    os.makedirs(dirname, exist_ok=True)
+    full = load_ephemeris(de, path=path)
+    summaries = [(name, values) for name, values in full.spk.daf.summaries() if int(values[2]) in targets]
+    # written to a temporary file and renamed so concurrent jobs never see a partial excerpt
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.bsp')
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            write_excerpt(full.spk, f, start_jd, end_jd, summaries)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    return filename
@@ -0,0 +1,136 @@
+import math
+import re
+
+import numpy as np
+
+from backends import POSITIONS, positions_table
+
+# what the fit is held to, a small fraction of a pixel even with the Sun a thousand pixels across
+TOLERANCE_DEG = 1e-4
+ANGLES = ['moon_alt', 'moon_az', 'sun_alt', 'sun_az', 'moon_r', 'sun_r', 'separation']
+
+
+class Timeline:
+    '''
+    the Sun and Moon from a site as piecewise Chebyshev series, fitted on a sparse set of nodes from any backend
+    (backends.py) and then evaluated at as many frame times as wanted for next to nothing.
+
+        timeline = Timeline.fit(get_backend('skyfield'), lat, lon, ele, c1_jd, c4_jd)
+        table = timeline.table(frame_times(contacts, 5))  # CircumstancesTable, a row every 5 seconds
+
+    .error is the largest difference (degrees) from the backend itself at check points between the nodes, where an
+    interpolating series is furthest off, for each of the alt/az, apparent radius and separation columns.
+    '''
+
+    def __init__(self, start, segment, coefficients, error=None):
+        self.start = start  # TT julian date the first segment begins
+        self.segment = segment  # days per segment
+        self.coefficients = coefficients  # column: array (segments, degree + 1)
+        self.error = error or {}
+
+    @classmethod
+    def fit(cls, backend, lat, lon, ele, jd_start, jd_end, segment_minutes=30, degree=12, tolerance_deg=TOLERANCE_DEG,
+            splits=4):
+        '''
+        :param backend: a backends.Backend, evaluated at (degree + 1) nodes per segment and two check points
+        :param jd_start: TT julian date
+        :param jd_end: TT julian date
+        :param segment_minutes: span of each piece, halved (up to splits times) until the check points are all within
+                                tolerance_deg
+        :return: Timeline, ValueError if it can't be fitted to tolerance
+        '''
+        segment = segment_minutes / 1440
+        for _ in range(splits + 1):
+            count = max(1, math.ceil((jd_end - jd_start) / segment - 1e-9))
+            x = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))  # Chebyshev nodes, descending
+            mids = jd_start + (np.arange(count) + 0.5) * segment
+            nodes = (mids[:, None] + x * segment / 2).ravel()
+            p = backend.positions(lat, lon, ele, nodes)
+            coefficients = {}
+            for name in POSITIONS:
+                values = np.asarray(p[name], dtype=float).reshape(count, degree + 1)
+                if name.endswith('_az'):
+                    values = np.degrees(np.unwrap(np.radians(values), axis=1))
+                coefficients[name] = _chebyshev_coefficients(values)
+            timeline = cls(jd_start, segment, coefficients)
+
+            # the segment ends and midpoints, as far from the nodes as anything gets
+            check = np.append(jd_start + np.arange(2 * count) * segment / 2, jd_start + count * segment)
+            expected = backend.table(lat, lon, ele, check)
+            found = timeline.table(expected.jd)
+            timeline.error = {name: _max_deviation(found[name], expected[name], wrap=name.endswith('_az'))
+                              for name in ANGLES}
+            if max(timeline.error.values()) <= tolerance_deg:
+                return timeline
+            segment /= 2
+        raise ValueError(f"the timeline is {max(timeline.error.values()):.2g} degrees from {backend.name} with "
+                         f"{segment * 2 * 1440:.2g} minute segments, more than {tolerance_deg:g}")
+
+    @property
+    def end(self):
+        return self.start + self.segment * len(next(iter(self.coefficients.values())))
+
+    def positions(self, jd):
+        '''
+        :param jd: TT julian dates between start and end
+        :return: dict of arrays the same as backends.Backend.positions
+        '''
+        jd = np.asarray(jd, dtype=float)
+        count = len(next(iter(self.coefficients.values())))
+        n = np.clip(((jd - self.start) // self.segment).astype(int), 0, count - 1)
+        x = np.clip((jd - self.start - (n + 0.5) * self.segment) / (self.segment / 2), -1, 1)
+        p = {}
+        for name, coefficients in self.coefficients.items():
+            terms = np.cos(np.outer(np.arccos(x), np.arange(coefficients.shape[1])))
+            p[name] = np.einsum('ij,ij->i', coefficients[n], terms)
+            if name.endswith('_az'):
+                p[name] %= 360
+        return p
+
+    def table(self, jd):
+        '''
+        :return: CircumstancesTable with the same columns as skyfieldcalcs.observe
+        '''
+        jd = np.asarray(jd, dtype=float)
+        return positions_table(jd, self.positions(jd))
+
+
+def frame_times(contacts, step_seconds):
+    '''
+    a frame every step_seconds from the first contact to the last, with the contacts themselves as frames
+    :param contacts: TT julian dates of c1, (c2,) mid, (c3,) c4
+    :return: sorted TT julian dates, grid times within half a step of a contact are dropped for it
+    '''
+    contacts = np.sort(np.asarray(contacts, dtype=float))
+    step = step_seconds / 86400
+    grid = contacts[0] + np.arange(int(np.floor((contacts[-1] - contacts[0]) / step)) + 1) * step
+    grid = grid[np.min(np.abs(grid[:, None] - contacts[None, :]), axis=1) >= step / 2]
+    return np.sort(np.concatenate([grid, contacts]))
+
+
+def parse_interval(text):
+    '''
+    :param text: 5s, 0.5s, 250ms, 1m or just a number of seconds
+    :return: seconds (float)
+    '''
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|min)?\s*', str(text))
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(f"unsupported interval {text}, expected something like 5s, 250ms or 1m")
+    return float(match.group(1)) * {'ms': 0.001, 's': 1, 'm': 60, 'min': 60}.get(match.group(2), 1)
+
+
+def _chebyshev_coefficients(values):
+    # values at the Chebyshev nodes of each row, the discrete cosine transform gives the interpolating series
+    n = values.shape[1]
+    k = np.arange(n)
+    coefficients = values @ np.cos(np.pi * np.outer(k + 0.5, k) / n) * 2 / n
+    coefficients[:, 0] /= 2
+    return coefficients
+
+
+def _max_deviation(found, expected, wrap=False):
+    difference = np.asarray(found, dtype=float) - np.asarray(expected, dtype=float)
+    if wrap:
+        difference = (difference + 180) % 360 - 180
+    difference = difference[np.isfinite(difference)]
+    return float(np.max(np.abs(difference))) if len(difference) else 0.0
@@ -29,6 +29,392 @@ class MyTestCase(unittest.TestCase):
         print(
             f"sun {decdeg2dms(c1['sun_alt'])} {decdeg2dms(c1['sun_az'])} moon {decdeg2dms(c1['moon_alt'])} {decdeg2dms(c1['moon_az'])}")
 
+    def test_solve_contacts(self):
+        # Sevier, UT is inside the annular path so all 4 contacts exist
+        from solar_eclipse_animation.skyfieldcalcs import solve_contacts
+        lat, lon = 38.57264, -112.24428
+        coarse = circumstances(ts.utc(2023, 10, 14), lat, lon, ephfilename='de430t.bsp')
+        refined = solve_contacts(ts.utc(2023, 10, 14), lat, lon, ephfilename='de430t.bsp')
+        for grid, exact in zip(coarse[:5], refined):
+            self.assertIsNotNone(exact)
+            self.assertLess(abs(grid['jd'] - exact['jd']) * 86400, 60)
+        self.assertGreater(refined[1]['jd'], coarse[1]['jd'] - 1 / 1440)
+        self.assertAlmostEqual(refined[0]['eclipse_fraction'], 0, places=6)
+
+    def test_circumstances_batch(self):
+        # Sevier UT (annular), Raleigh NC (partial) and Oslo (Sun below the horizon, no eclipse) in one pass
+        from solar_eclipse_animation.multisite import circumstances_batch
+        from solar_eclipse_animation.skyfieldcalcs import solve_contacts
+        sites = [(38.57264, -112.24428, 1800), (35.7796, -78.6382, 99), (59.91, 10.75, 20)]
+        df = circumstances_batch(ts.utc(2023, 10, 14), *zip(*sites), ephfilename='de430t.bsp')
+        self.assertEqual(len(df), 3)
+        for n, (lat, lon, ele) in enumerate(sites):
+            refined = solve_contacts(ts.utc(2023, 10, 14), lat, lon, ele=ele, ephfilename='de430t.bsp')
+            for k, row in zip(['c1', 'c2', 'mid', 'c3', 'c4'], refined):
+                if row is None:
+                    self.assertTrue(np.isnan(df[k][n]))
+                    self.assertIsNone(df[f'{k}_utc'][n])
+                else:
+                    self.assertLess(abs(df[k][n] - row['jd']) * 86400, 0.5)
+            if refined[2] is not None:
+                self.assertAlmostEqual(df.eclipse_fraction[n], refined[2]['eclipse_fraction'], places=4)
+                self.assertAlmostEqual(df.sun_alt[n], refined[2]['sun_alt'], places=2)
+        self.assertEqual(df.eclipse_fraction[2], 0)
+
+    def test_besselian(self):
+        # contacts from the elements against the Skyfield path, Sevier UT (annular) and Raleigh NC (partial)
+        from solar_eclipse_animation.besselian import besselian_elements, local_circumstances
+        from solar_eclipse_animation.skyfieldcalcs import solve_contacts
+        date = ts.utc(2023, 10, 14)
+        self.assertLess(besselian_elements(date, ephfilename='de430t.bsp').residual, 1e-6)
+        self.assertIsNone(besselian_elements(ts.utc(2023, 10, 20), ephfilename='de430t.bsp'))
+        sites = [(38.57264, -112.24428, 1800), (35.7796, -78.6382, 99)]
+        result = local_circumstances(date, *zip(*sites), ephfilename='de430t.bsp')
+        for n, (lat, lon, ele) in enumerate(sites):
+            refined = solve_contacts(date, lat, lon, ele=ele, ephfilename='de430t.bsp')
+            for k, row in zip(['c1', 'c2', 'mid', 'c3', 'c4'], refined):
+                if row is None:
+                    self.assertTrue(np.isnan(result[k][n]))
+                else:
+                    self.assertLess(abs(result[k][n] - row['jd']) * 86400, 1)
+            self.assertAlmostEqual(result['eclipse_fraction'][n], refined[2]['eclipse_fraction'], places=4)
+        self.assertGreater(result['magnitude'][0], result['magnitude'][1])
+        skyfield = circumstances(date, 35.7796, -78.6382, ephfilename='de430t.bsp', refine=True)
+        besselian = circumstances(date, 35.7796, -78.6382, ephfilename='de430t.bsp', refine=True, backend='besselian')
+        for a, b in zip(skyfield[:5], besselian[:5]):
+            self.assertEqual(a is None, b is None)
+            if a is not None:
+                self.assertLess(abs(a['jd'] - b['jd']) * 86400, 1)
+                self.assertAlmostEqual(a['sun_alt'], b['sun_alt'], places=2)
+
+    def test_backends(self):
+        # positions and contacts from each backend against Skyfield's, Raleigh NC on 2023-10-14
+        from solar_eclipse_animation.backends import BACKENDS, Backend, benchmark, get_backend, select_backend
+        with self.assertRaises(TypeError):
+            type('NoPositions', (Backend,), {'name': 'none'})()  # a backend has to implement positions()
+        date = ts.utc(2023, 10, 14)
+        site = (35.7796, -78.6382, 99)
+        backends = {}
+        for name in BACKENDS:
+            try:
+                backends[name] = get_backend(name, ephfilename='de430t.bsp')
+            except ImportError:
+                pass
+        reference = backends['skyfield'].contacts(date, *site)
+        jd = np.linspace(reference['c1'], reference['c4'], 5)
+        expected = backends['skyfield'].positions(*site, jd)
+        for name, backend in backends.items():
+            p = backend.positions(*site, jd)
+            # astronomy-engine's own delta T turns the whole sky by a minute or two of arc, Sun and Moon alike
+            for k in ['moon_alt', 'moon_az', 'sun_alt', 'sun_az']:
+                np.testing.assert_allclose(p[k], expected[k], atol=0.05, err_msg=f"{name} {k}")
+            for k in ['moon_dist', 'sun_dist']:
+                np.testing.assert_allclose(p[k], expected[k], rtol=0.001, err_msg=f"{name} {k}")
+        # PyEphem's truncated lunar theory puts its contacts ten seconds or so out
+        results = benchmark(backends, [site], date, positions_per_site=5)
+        for name, r in results.items():
+            self.assertEqual(r['mismatched'], 0, name)
+            self.assertLess(r['max_deviation'], 20, name)
+        self.assertEqual(select_backend(results, 1), 'besselian')
+        self.assertIsNone(select_backend({'a': dict(results['skyfield'], max_deviation=2)}, 1))
+
+    def test_timeline(self):
+        # frames every 2.5 seconds across the annular at Sevier UT from a fitted timeline, against Skyfield itself
+        from solar_eclipse_animation.backends import get_backend
+        from solar_eclipse_animation.timeline import TOLERANCE_DEG, Timeline, frame_times, parse_interval
+        self.assertEqual([parse_interval(s) for s in ['5s', '250ms', '1m', '2']], [5, 0.25, 60, 2])
+        with self.assertRaises(ValueError):
+            parse_interval('fast')
+        site = (38.57264, -112.24428, 1800)
+        backend = get_backend('skyfield', ephfilename='de430t.bsp')
+        contacts = [jd for jd in backend.contacts(ts.utc(2023, 10, 14), *site).values() if jd is not None]
+        jd = frame_times(contacts, 2.5)
+        self.assertEqual((jd[0], jd[-1]), (contacts[0], contacts[-1]))
+        self.assertTrue(set(contacts) <= set(jd))
+        self.assertGreater(np.min(np.diff(jd)) * 86400, 1.25 - 1e-3)
+        timeline = Timeline.fit(backend, *site, jd[0], jd[-1])
+        self.assertLess(max(timeline.error.values()), TOLERANCE_DEG)
+        found, expected = timeline.table(jd[::97]), backend.table(*site, jd[::97])
+        for k in ['moon_alt', 'moon_az', 'sun_alt', 'sun_az', 'separation', 'moon_r', 'sun_r']:
+            np.testing.assert_allclose(found[k], expected[k], atol=TOLERANCE_DEG, err_msg=k)
+        np.testing.assert_allclose(found.eclipse_fraction, expected.eclipse_fraction, atol=1e-3)
+
+    def test_timeline_no_eclipse(self):
+        # a frame every step needs contacts to step between
+        import os
+        import tempfile
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaisesRegex(ValueError, 'no eclipse at -40, 100 on 2023-10-14'):
+                main(name='nowhere', lat=-40, lon=100, ele=0, ephfilename=spk, cache=False, basedir=tmpdir, step=5)
+
+    def test_timeline_contacts(self):
+        # the timeline starts at the sub-second C1 (15:56:06 UTC at Raleigh) rather than the minute after it
+        import os
+        import tempfile
+        from solar_eclipse_animation.frameplan import FramePlan
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            strip = main(ephfilename=spk, cache=False, basedir=tmpdir, imagedir=make_images(f'{tmpdir}/images', (320, 180)),
+                         step=30, compositor='disk', outputs=('strip:32',))
+            plan = FramePlan.load(strip.replace('_strip.png', '.plan.json'))
+        self.assertEqual(plan['utc_iso'][0][:19], '2023-10-14T15:56:06')
+        self.assertEqual([e for e in plan['event'] if e], ['c1', 'mid', 'c4'])
+
+    def test_handbrake(self):
+        # the MP4 is passed to HandBrakeCLI as it's named, quotes and all, and HandBrakeCLI failing fails the run
+        import os
+        import subprocess
+        import tempfile
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            handbrake = f'{tmpdir}/HandBrakeCLI'
+            with open(handbrake, 'w') as f:
+                f.write(f'#!/bin/sh\nprintf "%s\\n" "$@" > {tmpdir}/arguments.txt\n')
+            os.chmod(handbrake, 0o755)
+            options = dict(name="Coeur d'Alene, ID", lat=47.6777, lon=-116.7805, ele=660, ephfilename=spk, cache=False,
+                           basedir=tmpdir, imagedir=make_images(f'{tmpdir}/images', (320, 180)), compositor='disk')
+            main(handbrake=handbrake, **options)
+            with open(f'{tmpdir}/arguments.txt') as f:
+                arguments = f.read().splitlines()
+            self.assertEqual(arguments[arguments.index('-i') + 1], "Coeur_d'Alene,_ID_20231014.mp4")
+            with self.assertRaises(subprocess.CalledProcessError):
+                main(handbrake='false', **options)
+
+    def test_frame_plan(self):
+        # half second frames across the annular at Sevier UT, labelled in Mountain time
+        import tempfile
+        from solar_eclipse_animation.backends import get_backend
+        from solar_eclipse_animation.frameplan import FramePlan, frame_plan
+        from solar_eclipse_animation.timeline import Timeline, frame_times
+        site = (38.57264, -112.24428, 1800)
+        backend = get_backend('skyfield', ephfilename='de430t.bsp')
+        contacts = backend.contacts(ts.utc(2023, 10, 14), *site)
+        jd = frame_times([jd for jd in contacts.values() if jd is not None], 0.5)
+        table = Timeline.fit(backend, *site, jd[0], jd[-1]).table(jd)
+        plan = frame_plan(table, contacts, 'America/Denver', title='Sevier, UT', hold_scale=2, milliseconds=True)
+        self.assertEqual(len(plan), len(jd))
+        self.assertEqual([e for e in plan['event'] if e], ['c1', 'c2', 'mid', 'c3', 'c4'])
+        self.assertEqual(sum(plan['hold']), 2 * (100 * 4 + 150))
+        self.assertEqual(plan['label_ll'][0], '9:08 AM MDT')
+        self.assertTrue(plan['label_lr'][0].startswith('start of partial eclipse'))
+        self.assertEqual(plan['utc_iso'][0][:16], '2023-10-14T15:08')
+        self.assertRegex(plan['iso'][1], r'^20231014T\d{9}$')
+        self.assertEqual(len(set(plan['iso'])), len(plan))
+        frame = next(iter(plan))
+        self.assertEqual((frame['title'], frame['frame'], frame['hold']), ('Sevier, UT', True, 200))
+        self.assertAlmostEqual(frame['moon_alt_delta_deg'], table.sun_alt[0] - table.moon_alt[0])
+        with tempfile.NamedTemporaryFile(suffix='.plan.json') as f:
+            plan.save(f.name)
+            loaded = FramePlan.load(f.name)
+        self.assertEqual(list(loaded), list(plan))
+        self.assertEqual(loaded.to_frame().shape, (len(jd), 13))
+
+    def test_search_eclipses(self):
+        from skyfield import almanac
+        from solar_eclipse_animation.search import new_moons, search_eclipses
+        from solar_eclipse_animation.skyfieldcalcs import load_ephemeris
+        eph = load_ephemeris('de430t.bsp')
+        times, phases = almanac.find_discrete(ts.utc(2023, 1, 1), ts.utc(2024, 1, 1), almanac.moon_phases(eph))
+        moons = new_moons(ts.utc(2023, 1, 1).tt, ts.utc(2024, 1, 1).tt)
+        np.testing.assert_allclose(moons, times.tt[phases == 0], atol=3 / 1440)
+        # Sevier UT saw the 2023 annular and a partial of the 2024 total, the 2021 and 2026 eclipses were not visible
+        df = search_eclipses(38.57264, -112.24428, ele=1800, start_year=2020, end_year=2026, ephfilename='de430t.bsp')
+        self.assertEqual(list(df.date), ['2023-10-14', '2024-04-08'])
+        self.assertEqual(list(df.kind), ['annular', 'partial'])
+        everything = search_eclipses(38.57264, -112.24428, ele=1800, start_year=2020, end_year=2026,
+                                     ephfilename='de430t.bsp', visible=False)
+        self.assertGreater(len(everything), len(df))
+
+    def test_obscuration_map(self):
+        import os
+        import tempfile
+        from solar_eclipse_animation.mapping import ObscurationMap, obscuration_map, save_map
+        from solar_eclipse_animation.multisite import circumstances_batch
+        m = obscuration_map(ts.utc(2023, 10, 14), lat_range=(30, 40), lon_range=(-115, -75), shape=(6, 9),
+                            ephfilename='de430t.bsp', workers=2, chunk=16)
+        self.assertEqual(m.eclipse_fraction.shape, (6, 9))
+        self.assertEqual(m.lats[0], 40)
+        df = circumstances_batch(ts.utc(2023, 10, 14), [m.lats[2]], [m.lons[3]], 0, ephfilename='de430t.bsp')
+        self.assertAlmostEqual(m.eclipse_fraction[2, 3], df.eclipse_fraction[0], places=4)
+        self.assertLess(abs(m.c1[2, 3] - df.c1[0]) * 86400, 2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            npz, csv, png = save_map(m, tmpdir, title='test')
+            with open(csv) as f:
+                self.assertEqual(len(f.readlines()), 1 + 6 * 9)
+            self.assertTrue(os.path.getsize(png) > 0)
+            np.testing.assert_array_equal(ObscurationMap.load_npz(npz).c4, m.c4)
+
+    def test_circumstances_table(self):
+        c1, c2, mid, c3, c4, table = circumstances(ts.utc(2023, 10, 14), 35.7796, -78.6382, ephfilename='de430t.bsp',
+                                                   columnar=True)
+        df = table.to_frame()
+        self.assertEqual(len(df), len(table))
+        self.assertNotIn('sun_alt_dms', df.columns)
+        self.assertLess(table.nbytes, 300_000)
+        eclipsed = table[table.eclipse_fraction > 0]
+        self.assertEqual(eclipsed.utc_iso[0], c1['utc_iso'])
+        self.assertTrue(eclipsed['sun_alt_dms'][0].startswith('43 '))
+        np.testing.assert_allclose(df.eclipse_fraction[df.eclipse_fraction > 0], eclipsed.eclipse_fraction)
+
+    def test_ephemeris_cache(self):
+        from solar_eclipse_animation.skyfieldcalcs import load_ephemeris
+        self.assertIs(load_ephemeris('de430t.bsp'), load_ephemeris('de430t.bsp'))
+        date = ts.utc(2023, 10, 14)
+        excerpt = load_ephemeris('de430t.bsp', start=date.tt - 2, end=date.tt + 2)
+        self.assertEqual(sorted(s.target for s in excerpt.segments), [3, 5, 6, 10, 301, 399])
+        full = circumstances(date, 35.7796, -78.6382, ephfilename='de430t.bsp', columnar=True)[5]
+        windowed = circumstances(date, 35.7796, -78.6382, eph=excerpt, columnar=True)[5]
+        np.testing.assert_allclose(full.separation, windowed.separation)
+
+    def test_bundled_ephemeris(self):
+        # the benchmarks' DE421 excerpt, excerpted again by absolute path into another directory
+        import os
+        import tempfile
+        from solar_eclipse_animation.skyfieldcalcs import excerpt_ephemeris, load_ephemeris
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        date = ts.utc(2023, 10, 14)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            excerpt = excerpt_ephemeris(spk, date.tt - 1, date.tt + 1, path=tmpdir)
+            self.assertEqual(os.path.dirname(excerpt), f'{tmpdir}/excerpts')
+            bundled = circumstances(date, 35.7796, -78.6382, eph=load_ephemeris(excerpt), columnar=True)
+        full = circumstances(date, 35.7796, -78.6382, ephfilename='de430t.bsp', columnar=True)
+        self.assertEqual([None if c is None else c['utc_iso'] for c in bundled[:5]],
+                         [None if c is None else c['utc_iso'] for c in full[:5]])
+
+    def test_circumstances_command(self):
+        # the contacts alone, from the bundled excerpt, without loading the renderers, pandas or the service
+        import json
+        import os
+        import subprocess
+        import sys
+        import tempfile
+        from solar_eclipse_animation.backends import contact_table, get_backend
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        contacts = contact_table(get_backend('skyfield', ephfilename=spk), ts.utc(2023, 10, 14), 35.7796, -78.6382, 97)
+        self.assertEqual([c['contact'] for c in contacts], ['c1', 'mid', 'c4'])
+        self.assertEqual(contacts[1]['utc_iso'], '2023-10-14T17:20:15Z')
+        self.assertAlmostEqual(contacts[1]['eclipse_fraction'], 0.372, places=2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # the command exits with sys.exit, what it loaded is printed as the interpreter exits
+            done = subprocess.run([sys.executable, '-c', "import atexit, runpy, sys; sys.argv = sys.argv[1:]; "
+                                   "atexit.register(lambda: print(sorted(m for m in ['PIL', 'pandas', 'imaging', 'service'] "
+                                   "if m in sys.modules))); runpy.run_path(sys.argv[0], run_name='__main__')",
+                                   'solar_eclipse_animation', 'circumstances', '35.7796', '-78.6382', '--ele', '97',
+                                   '--eph', spk, '--json'], capture_output=True, text=True, check=True,
+                                  env=dict(os.environ, SOLAR_ECLIPSE_DATA=tmpdir, PYTHONPATH='solar_eclipse_animation'))
+        output, loaded = done.stdout.strip().rsplit('\n', 1)
+        self.assertEqual(loaded, '[]')
+        result = json.loads(output)
+        self.assertEqual(result['timezone'], 'America/New_York')
+        self.assertEqual(result['contacts'][1]['local_iso'], '2023-10-14T13:20:15-04:00')
+
+    def test_service(self):
+        # in process on a free port, from the bundled excerpt, with no animation workers so the queue stays full
+        import json
+        import os
+        import threading
+        import time
+        import urllib.error
+        import urllib.request
+        from solar_eclipse_animation.service import Coalescer, Service, make_server
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        calls = []
+        coalescer = Coalescer()
+        threads = [threading.Thread(target=coalescer.call, args=('key', lambda: calls.append(time.sleep(0.2))))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), coalescer.coalesced), (1, 3))
+        # the frames kept are bounded by their size as well as their number
+        service = Service(ephfilename=spk, jobs=0, frame_cache_bytes=10)
+        for n in range(4):
+            service.cached('frame', n, lambda: b'.png')
+        self.assertEqual((list(service._answers['frame']), service.status()['cached_frame_bytes']), ([2, 3], 8))
+
+        server = make_server(Service(ephfilename=spk, queue_size=1, jobs=0), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        def request(path, body=None, content_type='application/json'):
+            data = None if body is None else json.dumps(body).encode()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url + path, data=data,
+                                                                   headers={'Content-Type': content_type})) as r:
+                    return r.status, json.load(r)
+            except urllib.error.HTTPError as e:
+                return e.code, json.load(e)
+        try:
+            code, result = request('/circumstances?lat=35.7796&lon=-78.6382&ele=97')
+            self.assertEqual(code, 200)
+            self.assertEqual(result['contacts'][1]['utc_iso'], '2023-10-14T17:20:15Z')
+            self.assertEqual(result['contacts'][1]['local_iso'], '2023-10-14T13:20:15-04:00')
+            self.assertEqual(request('/circumstances?lat=35.7796&lon=-78.6382&ele=97')[1], result)
+            self.assertEqual(request('/circumstances?lat=95&lon=0')[0], 400)
+            self.assertEqual(request('/nothing')[0], 404)
+            code, job = request('/animations', {'lat': 35.78, 'lon': -78.64, 'quality': 'draft'})
+            self.assertEqual((code, job['status']), (202, 'queued'))
+            self.assertEqual(request('/animations', {'lat': 35.78, 'lon': -78.64, 'quality': 'draft'}), (200, job))
+            for outputs in ['gif', ['gif:big'], ['avi'], []]:
+                self.assertEqual(request('/animations', {'lat': 36.1, 'lon': -86.8, 'outputs': outputs})[0], 400)
+            # nothing is written outside basedir, and a form posted from a web page isn't taken
+            for name in ['../../../tmp/x', 'a/b', 'a\\b', '..', ' ']:
+                self.assertEqual(request('/animations', {'lat': 36.1, 'lon': -86.8, 'name': name})[0], 400)
+            self.assertEqual(request('/animations', {'lat': 36.1, 'lon': -86.8}, content_type='text/plain')[0], 415)
+            self.assertEqual(request('/animations', {'lat': 36.1, 'lon': -86.8})[0], 503)
+            self.assertEqual(request(f"/animations/{job['id']}"), (200, job))
+            status = request('/status')[1]
+            self.assertEqual((status['cache_hits'], status['jobs_rejected'], status['queue']['queued']), (1, 1, 1))
+            self.assertEqual(status['errors'], 11)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_service_animation(self):
+        # a queued animation rendered by the service, the report found whichever output comes first
+        import os
+        import tempfile
+        import time
+        from solar_eclipse_animation.service import Service
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            service = Service(ephfilename=spk, imagedir=make_images(f'{tmpdir}/images', (320, 180)), basedir=tmpdir)
+            job, _ = service.submit({'lat': 35.78, 'lon': -78.64, 'ele': 97, 'quality': 'draft',
+                                     'outputs': ['webm', 'strip']})
+            for _ in range(600):
+                if job['status'] in ['done', 'failed']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual((job['status'], job['error']), ('done', None))
+            self.assertTrue(job['mp4'].endswith('_draft.webm'))
+            self.assertEqual(job['report'], f"{job['mp4'][:-5]}.report.json")
+            self.assertTrue(os.path.isfile(job['report']))
+            # only the last cache_size finished jobs are remembered
+            service = Service(ephfilename=spk, imagedir=f'{tmpdir}/images', basedir=tmpdir, cache_size=2)
+            jobs = [service.submit({'lat': 35.78, 'lon': -78.64, 'name': f'{n}', 'quality': 'none'})[0]
+                    for n in range(4)]
+            service._queue.join()
+            self.assertEqual([job['status'] for job in jobs], ['failed'] * 4)
+            self.assertEqual([service.job(job['id']) for job in jobs], [None, None, jobs[2], jobs[3]])
+
+    def test_circumstances_cache(self):
+        import tempfile
+        from solar_eclipse_animation.cache import CircumstancesCache, cached_circumstances
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = CircumstancesCache(dirname)
+            computed = cached_circumstances(2023, 10, 14, 35.7796, -78.6382, ephfilename='de430t.bsp', cache=cache)
+            key = cache.key(2023, 10, 14, 35.7796, -78.6382, 100, 'de430t.bsp', refine=False, backend='skyfield')
+            cached = cache.get(key)
+            self.assertIsNotNone(cached)
+            self.assertIsNone(cached[1])
+            self.assertEqual(cached[0]['utc_iso'], computed[0]['utc_iso'])
+            np.testing.assert_array_equal(cached[5].eclipse_fraction, computed[5].eclipse_fraction)
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+
     def test_comp(self):
         moon_alt_delta_deg = 0.6061575008073419
         moon_az_delta_deg = -0.2797259658417204
@@ -38,6 +424,316 @@ class MyTestCase(unittest.TestCase):
                     moon_az_delta_deg=moon_az_delta_deg,
                     imagedir='/Users/trice/PyCharmProjects/sandbox/solar_eclipse_animation/images')
 
+    def test_renderer(self):
+        import tempfile
+        from solar_eclipse_animation.imaging import Renderer
+        with tempfile.TemporaryDirectory() as imagedir:
+            make_images(imagedir, (1920, 1080))
+            renderer = Renderer(imagedir, sprite_cache_size=2)
+            for moon_r in [.24, .25, .26, .24]:
+                frame = renderer.render(.26, moon_r, moon_alt_delta_deg=.1, moon_az_delta_deg=-.1)
+            self.assertEqual(frame.size, (1920, 1080))
+            self.assertEqual(len(renderer._sprites), 2)
+            self.assertEqual(list(renderer._sprites)[-1], (923, 923))
+
+    def test_disk_renderer(self):
+        # a white Sun and a black Moon on a black sky, so how much of the Sun is left is how bright the frame is
+        import tempfile
+        from PIL import Image
+        from solar_eclipse_animation.imaging import DiskRenderer
+        with tempfile.TemporaryDirectory() as imagedir:
+            Image.new('RGB', (960, 540), 'black').save(f'{imagedir}/bluesky_4k.png')
+            Image.new('RGBA', (400, 400), 'white').save(f'{imagedir}/sun.png')
+            Image.new('RGBA', (400, 400), 'black').save(f'{imagedir}/newmoon.png')
+            renderer = DiskRenderer(imagedir)
+            sun = renderer.background.sum()
+            self.assertAlmostEqual(sun / 255 / 3, np.pi * 200 ** 2, delta=5)
+            for separation in [0, .1, .3, .5]:
+                frame = renderer.render_pixels(.2671, .2533, moon_alt_delta_deg=separation)
+                self.assertIs(frame, renderer.frame)
+                self.assertAlmostEqual(1 - frame.sum() / sun, eclipse_fraction(separation, .2533, .2671), delta=2e-3)
+            # a tenth of a pixel at a time, the Sun uncovers smoothly rather than in whole pixel steps
+            step = .2671 * 2 / 400 / 10
+            visible = [renderer.render_pixels(.2671, .2533, moon_alt_delta_deg=.1 + n * step).sum() for n in range(10)]
+            self.assertTrue(all(np.diff(visible) > 0))
+            # only what the last frame touched is put back
+            renderer.render_pixels(.2671, .2533, moon_alt_delta_deg=.1, label_ll='12:00 PM', label_lr='50%')
+            self.assertFalse(np.array_equal(renderer.frame, renderer.background))
+            self.assertTrue(np.array_equal(renderer.render_pixels(.2671, .2533, moon_alt_delta_deg=2), renderer.background))
+            self.assertEqual(renderer.render(.2671, .2533).size, (960, 540))
+        # a Sun wider than the frame (a small sky with the full size Sun) is cut off at its edges, and so is the Moon
+        with tempfile.TemporaryDirectory() as imagedir:
+            Image.new('RGB', (300, 200), 'black').save(f'{imagedir}/bluesky_4k.png')
+            Image.new('RGBA', (400, 400), 'white').save(f'{imagedir}/sun.png')
+            Image.new('RGBA', (400, 400), 'black').save(f'{imagedir}/newmoon.png')
+            renderer = DiskRenderer(imagedir)
+            for separation in [0, .05]:
+                frame = renderer.render_pixels(.2671, .2533, moon_alt_delta_deg=separation)
+                self.assertEqual(frame.shape, (200, 300, 3))
+                self.assertEqual(frame[100, 150].tolist(), [0, 0, 0])
+
+    def test_asset_pyramid(self):
+        import os
+        import tempfile
+        from PIL import Image
+        from solar_eclipse_animation.imaging import Renderer, asset_pyramid
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imagedir = make_images(f'{tmpdir}/images', (1920, 1080))
+            self.assertEqual(asset_pyramid(imagedir, 'final', dirname=f'{tmpdir}/pyramid'), imagedir)
+            draft = asset_pyramid(imagedir, 'draft', dirname=f'{tmpdir}/pyramid')
+            self.assertEqual(Image.open(f'{draft}/bluesky_4k.png').size, (480, 270))
+            self.assertEqual(Image.open(f'{draft}/sun.png').size, (250, 250))
+            # built once, until an original changes
+            built = os.stat(f'{draft}/sun.png').st_mtime_ns
+            self.assertEqual(asset_pyramid(imagedir, 'draft', dirname=f'{tmpdir}/pyramid'), draft)
+            self.assertEqual(os.stat(f'{draft}/sun.png').st_mtime_ns, built)
+            Image.new('RGB', (1920, 1080), '#000000').save(f'{imagedir}/bluesky_4k.png')
+            self.assertNotEqual(asset_pyramid(imagedir, 'draft', dirname=f'{tmpdir}/pyramid'), draft)
+            with self.assertRaises(ValueError):
+                asset_pyramid(imagedir, 'best')
+            # the Moon lands on the same part of the Sun at any tier
+            preview = asset_pyramid(imagedir, 'preview', dirname=f'{tmpdir}/pyramid')
+            full = np.asarray(Renderer(imagedir).render(.2671, .2533, .1, .1).resize((960, 540)), dtype=float)
+            half = np.asarray(Renderer(preview, fontsize=50).render(.2671, .2533, .1, .1), dtype=float)
+            self.assertLess(np.mean(np.abs(full - half)), 2)
+
+    def test_batch(self):
+        import json
+        import os
+        import tempfile
+        from solar_eclipse_animation.jobs import read_manifest, run_batch
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/cities.csv', 'w') as f:
+                f.write('name,lat,lon,ele\n"Raleigh, NC",35.78255,-78.63899,97\n"Richfield, UT",38.57264,-112.24428,\n'
+                        'Nowhere,95,0,0\n')
+            with open(f'{tmpdir}/cities.ini', 'w') as f:
+                f.write('[raleigh]\ncity = Raleigh, NC\nlat = 35.78255\nlon = -78.63899\nele = 97\n')
+            with open(f'{tmpdir}/cities.json', 'w') as f:
+                json.dump({'Raleigh, NC': {'lat': 35.78255, 'lon': -78.63899, 'ele': 97, 'date': '20240408'}}, f)
+            cities = read_manifest(f'{tmpdir}/cities.csv')
+            self.assertEqual(cities[1], {'name': 'Richfield, UT', 'lat': 38.57264, 'lon': -112.24428, 'date': '20231014'})
+            self.assertEqual(read_manifest(f'{tmpdir}/cities.ini')[0], dict(cities[0]))
+            self.assertEqual(read_manifest(f'{tmpdir}/cities.json')[0]['date'], '20240408')
+            with self.assertRaises(ValueError):
+                read_manifest(f'{tmpdir}/cities.txt')
+
+            imagedir = make_images(f'{tmpdir}/images', (640, 360))
+            results = run_batch(cities, workers=2, basedir=tmpdir, imagedir=imagedir, quality='draft',
+                                compositor='disk', summary=f'{tmpdir}/summary.json')
+            # the city that can't be done is reported, the others still are
+            self.assertEqual([r['status'] for r in results], ['ok', 'ok', 'failed'])
+            self.assertIn('latitude', results[2]['error'])
+            for r in results[:2]:
+                self.assertTrue(os.path.getsize(r['mp4']) > 0)
+                self.assertTrue(os.path.isfile(f"{r['mp4'][:-4]}.plan.json"))
+                self.assertGreater(r['seconds']['render'], 0)
+                with open(f"{r['mp4'][:-4]}.report.json") as f:
+                    report = json.load(f)
+                self.assertEqual(report['counters']['frames_rendered'], report['counters']['frames'])
+                self.assertEqual(report['counters']['mp4_bytes'], os.path.getsize(r['mp4']))
+                self.assertIn('render', report['stages'])
+            with open(f'{tmpdir}/summary.json') as f:
+                self.assertEqual(json.load(f)['failed'], 1)
+
+    def test_run_report(self):
+        import json
+        import os
+        import tempfile
+        import tracemalloc
+        from solar_eclipse_animation.instrument import RunReport
+        with self.assertRaises(ValueError):
+            RunReport(profile='perf')
+        for profile in [None, 'cprofile', 'tracemalloc']:
+            report = RunReport(profile=profile, name='test')
+            for _ in range(2):
+                with report.stage('work'):
+                    sum(range(10000))
+            report.count('frames', 3)
+            report.count('frames')
+            with tempfile.TemporaryDirectory() as tmpdir:
+                report.save(f'{tmpdir}/run.report.json')
+                with open(f'{tmpdir}/run.report.json') as f:
+                    saved = json.load(f)
+                self.assertEqual(os.path.isfile(f'{tmpdir}/run.report.prof'), profile == 'cprofile')
+            self.assertEqual((saved['name'], saved['counters']), ('test', {'frames': 4}))
+            self.assertEqual(saved['stages']['work']['calls'], 2)
+            self.assertGreater(saved['memory']['peak_rss_bytes'], 0)
+            self.assertEqual('profile' in saved, profile is not None)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_render_frames_parallel(self):
+        import os
+        import tempfile
+        from solar_eclipse_animation.rendering import render_frames
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imagedir = make_images(f'{tmpdir}/images', (640, 360))
+            outputs = {}
+            for workers in [1, 2]:
+                frames = [dict(title=f'workers{workers}', iso=f'20231014T1200{n:02d}', sun_radius=.267, moon_radius=.253,
+                               moon_alt_delta_deg=n / 100, frame=True, basedir=tmpdir) for n in range(4)]
+                dirnames = render_frames(frames, workers=workers, imagedir=imagedir)
+                self.assertEqual(len(set(dirnames)), 1)
+                outputs[workers] = {f: open(f'{dirnames[0]}/{f}', 'rb').read() for f in sorted(os.listdir(dirnames[0]))}
+            self.assertEqual(list(outputs[1]), list(outputs[2]))
+            self.assertEqual(list(outputs[1].values()), list(outputs[2].values()))
+
+    def test_concurrent_renders(self):
+        # two animations drawn at once in one process, as the service's jobs are, each as it would be alone
+        import tempfile
+        import threading
+        from solar_eclipse_animation.rendering import render_frames
+
+        class Frames:
+            def __init__(self):
+                self.frames = []
+
+            def write(self, pixels):
+                self.frames.append(bytes(pixels))
+
+        def frames(direction):
+            return [dict(iso=f'20231014T12{n:02d}00', sun_radius=.267, moon_radius=.253,
+                         moon_alt_delta_deg=direction * n / 100, moon_az_delta_deg=n / 200) for n in range(40)]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imagedir = make_images(f'{tmpdir}/images', (320, 180))
+            serial, concurrent = [Frames(), Frames()], [Frames(), Frames()]
+            for direction, writer in zip([1, -1], serial):
+                render_frames(frames(direction), imagedir=imagedir, writer=writer, save=False, compositor='disk')
+            threads = [threading.Thread(target=render_frames, args=(frames(direction),),
+                                        kwargs=dict(imagedir=imagedir, writer=writer, save=False, compositor='disk'))
+                       for direction, writer in zip([1, -1], concurrent)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for alone, together in zip(serial, concurrent):
+            self.assertEqual(len(together.frames), 40)
+            self.assertTrue(alone.frames == together.frames)
+
+    def test_ffmpeg_writer(self):
+        import os
+        import tempfile
+        from PIL import Image
+        from solar_eclipse_animation.encoding import FFmpegError, FFmpegWriter
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with FFmpegWriter(f'{tmpdir}/ok.mp4', (64, 48)) as writer:
+                for n in range(5):
+                    writer.write(Image.new('RGB', (64, 48), (n * 50, 0, 0)))
+                writer.write(np.zeros((48, 64, 3), dtype=np.uint8))
+            self.assertEqual(writer.frames, 6)
+            self.assertGreater(os.path.getsize(f'{tmpdir}/ok.mp4'), 0)
+            with self.assertRaises(ValueError):
+                with FFmpegWriter(f'{tmpdir}/size.mp4', (64, 48)) as writer:
+                    writer.write(Image.new('RGB', (32, 32)))
+            with self.assertRaises(ValueError):
+                with FFmpegWriter(f'{tmpdir}/shape.mp4', (64, 48)) as writer:
+                    writer.write(np.zeros((64, 48, 3), dtype=np.uint8))
+            with self.assertRaises(FFmpegError):
+                with FFmpegWriter(f'{tmpdir}/bad.mp4', (64, 48), output_args=('-c:v', 'no-such-encoder')) as writer:
+                    for n in range(50):
+                        writer.write(Image.new('RGB', (64, 48)))
+
+    def test_fan_out_writer(self):
+        # one pass of frames into an MP4, a GIF and a thumbnail strip, the frame buffer redrawn under the queues
+        import os
+        import tempfile
+        from PIL import Image
+        from solar_eclipse_animation.encoding import FanOutWriter, FFmpegError, FFmpegWriter, output_args, parse_output
+        from solar_eclipse_animation.main import strip_picks
+        self.assertEqual(parse_output('gif:640@12'), ('gif', {'extension': '.gif', 'width': 640, 'fps': 12.0}))
+        self.assertEqual(parse_output('webm')[1]['width'], 1280)
+        with self.assertRaises(ValueError):
+            parse_output('avi')
+        with self.assertRaises(ValueError):
+            parse_output('gif:big')
+        with self.assertRaises(ValueError):
+            parse_output('strip:320@5')
+        self.assertEqual(strip_picks([0, 5, 0, 10, 0], 10), [0, 1, 7, 8, 19])
+        self.assertEqual(strip_picks([0, 5, 0, 10, 0], 3), [0, 7, 19])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outputs = [parse_output(spec) for spec in ['mp4', 'gif:32@5', 'strip:16']]
+            outputs[2][1]['count'] = 4
+            writers = [FFmpegWriter(f'{tmpdir}/out{settings["extension"]}', (64, 48),
+                                    output_args=output_args(name, settings, 'ultrafast', [0, 10, 20, 29]))
+                       for name, settings in outputs]
+            frame = np.zeros((48, 64, 3), dtype=np.uint8)
+            with FanOutWriter(writers, buffer=2) as writer:
+                for n in range(30):
+                    frame[:] = n * 8
+                    writer.write(frame)
+            self.assertEqual(writer.frames, 30)
+            self.assertTrue(all(w.frames == 30 for w in writers))
+            for name in ['out.mp4', 'out.gif', 'out_strip.png']:
+                self.assertGreater(os.path.getsize(f'{tmpdir}/{name}'), 0)
+            strip = np.asarray(Image.open(f'{tmpdir}/out_strip.png').convert('RGB'))
+            self.assertEqual(strip.shape, (12, 64, 3))
+            # the picked frames, in order, not copies of the last one drawn
+            self.assertEqual([int(strip[6, 2 + 16 * n, 0]) // 8 for n in range(4)], [0, 10, 20, 29])
+            with self.assertRaises(FFmpegError):
+                writers = [FFmpegWriter(f'{tmpdir}/ok.mp4', (64, 48)),
+                           FFmpegWriter(f'{tmpdir}/bad.mp4', (64, 48), output_args=('-c:v', 'no-such-encoder'))]
+                with FanOutWriter(writers, buffer=2) as writer:
+                    for n in range(200):
+                        writer.write(frame)
+
+    def test_outputs_from_pngs(self):
+        # --no-stream, every output's ffmpeg from the same PNGs, one that fails isn't reported as written
+        import os
+        import sys
+        import tempfile
+        from unittest import mock
+        main_module = sys.modules[main.__module__]
+        FFmpegError, output_args = main_module.FFmpegError, main_module.output_args
+        spk = os.path.abspath('benchmarks/data/de421_20231014.bsp')
+
+        def broken_gif(name, settings, preset='medium', picks=None):
+            return ('-c:v', 'no-such-encoder') if name == 'gif' else output_args(name, settings, preset, picks)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imagedir = make_images(f'{tmpdir}/images', (320, 180))
+            options = dict(name='Raleigh', lat=35.78, lon=-78.64, ele=97, ephfilename=spk, cache=False,
+                           basedir=tmpdir, imagedir=imagedir, quality='draft', stream=False)
+            mp4 = main(outputs=['mp4', 'strip'], **options)
+            self.assertTrue(os.path.getsize(mp4) > 0 and os.path.getsize(f'{mp4[:-4]}_strip.png') > 0)
+            with mock.patch.object(main_module, 'output_args', broken_gif):
+                with self.assertRaisesRegex(FFmpegError, 'status'):
+                    main(outputs=['mp4', 'gif'], **options)
+
+    def test_incremental_frames(self):
+        import os
+        import tempfile
+        from solar_eclipse_animation.rendering import render_frames
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imagedir = make_images(f'{tmpdir}/images', (320, 180))
+
+            def frames(minutes, label=None):
+                return [dict(title='inc', iso=f'20231014T12{n:02d}00', sun_radius=.267, moon_radius=.253,
+                             moon_alt_delta_deg=n / 100, label_ll=label, frame=True, basedir=tmpdir) for n in minutes]
+
+            dirname = render_frames(frames(range(0, 4)), imagedir=imagedir)[0]
+            mtimes = {f: os.stat(f'{dirname}/{f}').st_mtime_ns for f in os.listdir(dirname) if f.endswith('.png')}
+            # shift the window a minute, one frame is new, one is dropped, the rest are left alone
+            render_frames(frames(range(1, 5)), imagedir=imagedir)
+            pngs = sorted(f for f in os.listdir(dirname) if f.endswith('.png'))
+            self.assertEqual(pngs, [f'20231014T12{n:02d}00.png' for n in range(1, 5)])
+            for f in pngs[:3]:
+                self.assertEqual(os.stat(f'{dirname}/{f}').st_mtime_ns, mtimes[f])
+            # a changed label re-renders just that frame
+            changed = frames(range(1, 5))
+            changed[2]['label_lr'] = 'maximum eclipse'
+            render_frames(changed, imagedir=imagedir)
+            self.assertNotEqual(os.stat(f'{dirname}/{pngs[2]}').st_mtime_ns, mtimes[pngs[2]])
+            self.assertEqual(os.stat(f'{dirname}/{pngs[1]}').st_mtime_ns, mtimes[pngs[1]])
+
+    def test_concat_list(self):
+        import tempfile
+        from solar_eclipse_animation.encoding import write_concat_list
+        with tempfile.NamedTemporaryFile('r', suffix='.txt') as f:
+            write_concat_list(f.name, [('a.png', 1), ("it's.png", 101), ('c.png', 1)], fps=25)
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'ffconcat version 1.0')
+        self.assertEqual(lines[3:5], ["file 'it'\\''s.png'", 'duration 4.040000'])
+        self.assertEqual(lines[-2:], ['duration 0.040000', "file 'c.png'"])
+
     def test_Raleigh(self):
         main()
 
@@ -66,6 +762,15 @@ class MyTestCase(unittest.TestCase):
                                  )
         print(foo2)
 
+    def test_fraction_array(self):
+        from solar_eclipse_animation.skyfieldcalcs import eclipse_fraction_array
+        rng = np.random.default_rng(20231014)
+        s = np.concatenate([rng.uniform(0, 0.6, 5000), [0.0, 0.001384, 0.6]])
+        moon_r = np.concatenate([rng.uniform(0.24, 0.28, 5000), [0.24, 0.253048, 0.25]])
+        sun_r = np.concatenate([rng.uniform(0.24, 0.28, 5000), [0.26, 0.267121, 0.25]])
+        expected = [eclipse_fraction(*x) for x in zip(s, moon_r, sun_r)]
+        np.testing.assert_allclose(eclipse_fraction_array(s, moon_r, sun_r), expected, atol=1e-12)
+
     def test_images(self):
         import configparser
         config = configparser.ConfigParser()
@@ -108,6 +813,21 @@ class MyTestCase(unittest.TestCase):
             #                       imagedir='/Users/trice/PyCharmProjects/sandbox/solar_eclipse_animation/images')
             #
 
+def make_images(imagedir, size):
+    '''
+    a flat blue sky of size with the repo's Sun and Moon, what the renderer tests draw with
+    :return: imagedir
+    '''
+    import os
+    import shutil
+    from PIL import Image
+    os.makedirs(imagedir, exist_ok=True)
+    Image.new('RGB', size, '#87CEEB').save(f'{imagedir}/bluesky_4k.png')
+    for name in ['sun.png', 'newmoon.png']:
+        shutil.copyfile(f'images/{name}', f'{imagedir}/{name}')
+    return imagedir
+
+
 def obs(d, R, r):
     return (1 - intersection_area(d, R, r))
 